@@ -1,14 +1,30 @@
+import html
+import json
+import os
+import threading
+import time
+import uuid
+from functools import partial
 import streamlit as st
-import anthropic
 from datetime import datetime
-import io
-from docx import Document
-from docx.shared import Inches, Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import config
+import metrics
+from export_cache import ExportCache, ExportFiles, export_settings
+from exporters import render_export, load_backends, EXPORT_FORMATS
+from generation import (
+    create_response, generate_document, find_section_starts, response_cache_key,
+    apply_input_budget, estimate_prompt_tokens, route_tier, refine_document, MODEL, DRAFT_MODEL,
+    generate_sections_parallel, reusable_sections, draft_sections, changed_fields, SECTION_TITLES, INPUT_FIELDS,
+    TEMPERATURE
+)
+from response_cache import ResponseCache
+from rate_limit import AdmissionTimeout
+from history_store import HistoryStore
+from document_store import DocumentStore
+from archive import ARCHIVE_FORMATS, write_archive
+from jobs import JobQueue, run_generation_job, run_scenario_job, QUEUED, RUNNING, DONE, FAILED, FINISHED_STATES
+from scenarios import compare_sections, new_variant, word_diff
 
 # Page configuration
 st.set_page_config(
@@ -18,26 +34,98 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Choices offered for config.MODEL_TIER in the form
+TIER_LABELS = {
+    "quality": "Full quality",
+    "draft": "Fast draft",
+    "refine": "Fast draft, then refine",
+    "auto": "Automatic (by input size)"
+}
+
 # Initialize session state
 def initialize_session_state():
-    if 'collected_data' not in st.session_state:
-        st.session_state.collected_data = {}
-    if 'final_document' not in st.session_state:
-        st.session_state.final_document = None
+    # Documents and inputs live in the shared document store and session state keeps their
+    # hashes; values put into session state directly (as the benchmark does) are moved there
+    for slot in ('final_document', 'collected_data'):
+        if slot in st.session_state:
+            value = st.session_state[slot]
+            del st.session_state[slot]
+            if slot == 'collected_data':
+                set_session_data(slot, value)
+            else:
+                set_session_text(slot, value)
+    store = get_document_store()
+    store.touch(current_session_id())
+    store.sweep()
     if 'show_document' not in st.session_state:
         st.session_state.show_document = False
-    if 'document_history' not in st.session_state:
-        st.session_state.document_history = []
+    if 'job_ids' not in st.session_state:
+        st.session_state.job_ids = []
+    if 'current_job_id' not in st.session_state:
+        st.session_state.current_job_id = None
+    if 'budget_notices' not in st.session_state:
+        st.session_state.budget_notices = {}
+    if 'history_page' not in st.session_state:
+        st.session_state.history_page = 0
+    if 'history_last_query' not in st.session_state:
+        st.session_state.history_last_query = ""
+    if 'confirm_clear_history' not in st.session_state:
+        st.session_state.confirm_clear_history = False
+    if 'generation_stats' not in st.session_state:
+        st.session_state.generation_stats = None
+    if 'similar_matches' not in st.session_state:
+        st.session_state.similar_matches = None
+    if 'archive_selection' not in st.session_state:
+        st.session_state.archive_selection = set()
+    if 'archive' not in st.session_state:
+        st.session_state.archive = None
+    if 'similar_choice' not in st.session_state:
+        st.session_state.similar_choice = None
+    if 'scenarios' not in st.session_state:
+        st.session_state.scenarios = None
     # Initialize form inputs
-    sections = [
-        "negotiation_subject", "project_value", "company_profile", 
-        "scope_description", "targets", "vendors", "interests", 
-        "advantages", "disadvantages"
-    ]
-    for section in sections:
+    for section in INPUT_FIELDS:
         if f"input_{section}" not in st.session_state:
             st.session_state[f"input_{section}"] = ""
 
+# Documents and inputs shown by every session, each stored once per process
+@st.cache_resource
+def get_document_store():
+    store = DocumentStore(
+        config.DOCUMENT_STORE_MAX_BYTES,
+        os.path.join(config.DATA_DIR, "documents"),
+        config.DOCUMENT_STORE_HOLDER_TTL
+    )
+    metrics.REGISTRY.register_gauges("document_store", store.stats)
+    return store
+
+def session_text(slot):
+    """The text this session's slot refers to, or None"""
+    digest = st.session_state.get(f"{slot}_ref")
+    return get_document_store().get(digest) if digest else None
+
+def set_session_text(slot, text):
+    """Keep text in the document store and only its hash in session state (None clears the slot)"""
+    st.session_state[f"{slot}_ref"] = get_document_store().assign(current_session_id(), slot, text)
+
+def session_data(slot):
+    text = session_text(slot)
+    return json.loads(text) if text else {}
+
+def set_session_data(slot, data):
+    set_session_text(slot, json.dumps(data) if data else None)
+
+# One pooled client per process, reused by every session and rerun. The SDK is
+# imported here rather than at the top so the form page renders without it.
+@st.cache_resource
+def get_shared_client(api_key):
+    from llm_client import client_from_config
+
+    client = client_from_config(api_key)
+    metrics.REGISTRY.register_gauges("client", client.metrics.snapshot)
+    metrics.REGISTRY.register_gauges("admission", client.limiter.stats)
+    return client
+
 # Initialize the Anthropic client
 def init_client():
     try:
@@ -47,8 +135,7 @@ def init_client():
             st.stop()
             return None
             
-        client = anthropic.Anthropic(api_key=api_key)
-        return client
+        return get_shared_client(api_key)
     except KeyError:
         st.error("'ANTHROPIC_API_KEY' not found in Streamlit secrets. Please check your secrets configuration.")
         st.stop()
@@ -60,261 +147,660 @@ def init_client():
 
 def get_assistant_response(client, prompt):
     try:
-        response = client.messages.create(
-            model="claude-3-opus-20240229",
-            messages=[{
-                "role": "user",
-                "content": prompt
-            }],
-            max_tokens=4096,
-            temperature=0.7
-        )
-        return response.content[0].text
+        return create_response(client, prompt)
+    except AdmissionTimeout as e:
+        st.warning(str(e))
+        return None
     except Exception as e:
-        st.error(f"Error getting response from Claude 3 Opus: {str(e)}")
+        st.error(f"Error getting response from Claude: {str(e)}")
         st.write("Detailed error:", str(e))
         return None
 
+def stream_assistant_response(client, data, model=MODEL):
+    """Stream the document onto the page section by section as tokens arrive"""
+    container = st.container()
+    # Finished sections are written once; only the section in progress is re-rendered
+    live = {'current': "", 'placeholder': container.empty()}
+
+    def on_text(delta):
+        live['current'] += delta
+        if '\n' not in delta:
+            return
+        starts = [offset for offset, _ in find_section_starts(live['current']) if offset > 0]
+        if starts:
+            live['placeholder'].markdown(live['current'][:starts[-1]])
+            live['current'] = live['current'][starts[-1]:]
+            live['placeholder'] = container.empty()
+        live['placeholder'].markdown(live['current'])
+
+    try:
+        return generate_document(client, data, on_text, config.PARALLEL_MAX_WORKERS, model)
+    except AdmissionTimeout as e:
+        st.warning(str(e))
+        return None, None
+    except Exception as e:
+        st.error(f"Error getting response from Claude: {str(e)}")
+        st.write("Detailed error:", str(e))
+        return None, None
+
+# Response cache shared by every session and persisted across restarts
+@st.cache_resource
+def get_response_cache():
+    cache = ResponseCache(
+        os.path.join(config.DATA_DIR, "responses.sqlite3"),
+        config.RESPONSE_CACHE_TTL,
+        config.RESPONSE_CACHE_MAX_BYTES
+    )
+    metrics.REGISTRY.register_gauges("response_cache", cache.stats)
+    return cache
+
+def generate_sections_on_page(client, data, reuse=None, references=None, model=MODEL, draft=None):
+    """Generate sections concurrently, filling each placeholder as its section arrives.
+
+    With draft (document, stats) the sections are a refinement of that draft.
+    """
+    container = st.container()
+    placeholders = {}
+    for number, title in enumerate(SECTION_TITLES, start=1):
+        placeholders[number] = container.empty()
+        placeholders[number].caption(f"Writing {number}. {title}...")
+
+    def on_section(number, text):
+        placeholders[number].markdown(text)
+
+    try:
+        if draft:
+            return refine_document(client, data, draft[0], draft[1], config.PARALLEL_MAX_WORKERS, on_section)
+        return generate_sections_parallel(client, data, config.PARALLEL_MAX_WORKERS, on_section, reuse, references, model)
+    except AdmissionTimeout as e:
+        st.warning(str(e))
+        return None, None
+    except Exception as e:
+        st.error(f"Error getting response from Claude: {str(e)}")
+        st.write("Detailed error:", str(e))
+        return None, None
+
+# Worker pool running generations off the script thread, shared by every session
+@st.cache_resource
+def get_job_queue():
+    queue = JobQueue(config.JOB_WORKERS, config.JOB_RETENTION, get_document_store())
+    metrics.REGISTRY.register_gauges("jobs", queue.stats)
+    return queue
+
+def session_jobs():
+    """This session's jobs that the queue still knows about, newest first"""
+    queue = get_job_queue()
+    jobs = [queue.get(job_id) for job_id in reversed(st.session_state.job_ids)]
+    return [job for job in jobs if job is not None]
+
+def open_job_result(job):
+    if job.variants is not None:
+        open_scenarios(job)
+        return
+    entry = history_store().get(job.entry_id) if job.entry_id else None
+    if entry:
+        set_session_text('final_document', entry['document'])
+        set_session_data('collected_data', entry['metadata']['data'])
+        st.session_state.generation_stats = job.stats
+        st.session_state.show_document = True
+    st.session_state.current_job_id = None
+
+def cancel_job(job_id):
+    job = get_job_queue().get(job_id)
+    if job:
+        job.cancel()
+    if st.session_state.current_job_id == job_id:
+        st.session_state.current_job_id = None
+
+def watch_job(job_id):
+    st.session_state.current_job_id = job_id
+    st.session_state.show_document = False
+
+def dismiss_job(job_id):
+    if job_id in st.session_state.job_ids:
+        st.session_state.job_ids.remove(job_id)
+    st.session_state.budget_notices.pop(job_id, None)
+
+def get_current_job():
+    """The job this session is watching while it is in flight; finished jobs are resolved here"""
+    job_id = st.session_state.current_job_id
+    job = get_job_queue().get(job_id) if job_id else None
+    if job is not None and job.status not in FINISHED_STATES:
+        return job
+
+    st.session_state.current_job_id = None
+    if job is not None:
+        st.session_state.budget_notices.pop(job.id, None)
+    if job is not None and job.status == DONE:
+        open_job_result(job)
+    elif job is not None and job.status == FAILED:
+        if isinstance(job.exception, AdmissionTimeout):
+            st.warning(job.error)
+        else:
+            st.error(f"Error getting response from Claude: {job.error}")
+    return None
+
+def render_sidebar_jobs():
+    jobs = session_jobs()
+    if not jobs:
+        return
+    with st.sidebar:
+        st.title("Generation Jobs")
+        for job in jobs[:5]:
+            st.write(f"**{job.description[:40]}** · {job.status}")
+            col1, col2 = st.columns(2)
+            with col1:
+                if job.status == DONE:
+                    st.button("Open", key=f"open_job_{job.id}", use_container_width=True,
+                              on_click=open_job_result, args=(job,))
+                elif job.status in (QUEUED, RUNNING):
+                    st.button("Watch", key=f"watch_job_{job.id}", use_container_width=True,
+                              on_click=watch_job, args=(job.id,))
+            with col2:
+                if job.status in FINISHED_STATES:
+                    st.button("Dismiss", key=f"dismiss_job_{job.id}", use_container_width=True,
+                              on_click=dismiss_job, args=(job.id,))
+                else:
+                    st.button("Cancel", key=f"cancel_job_{job.id}", use_container_width=True,
+                              on_click=cancel_job, args=(job.id,))
+        st.markdown("---")
+
+def render_job_progress(job):
+    """Show a queued or running job; the page polls until it finishes"""
+    if job.variants is not None:
+        render_scenario_progress(job)
+        return
+    st.header("📄 Generating BATNA Document")
+    render_budget_notice(st.session_state.budget_notices.get(job.id))
+    limiter = init_client().limiter
+    position = limiter.position(current_session_id())
+    if job.status == QUEUED:
+        st.info("Waiting for a free worker...")
+    elif position:
+        waiting = limiter.stats()['waiting']
+        st.info(f"The API is busy: your next request is number {position} of {waiting} in the queue.")
+    elif job.draft:
+        st.info(f"Showing the fast draft. It will be replaced by the refined version when that is ready "
+                f"({len(job.partial)} of {len(SECTION_TITLES)} sections refined).")
+    else:
+        elapsed = time.time() - (job.started or time.time())
+        st.caption(f"Running for {elapsed:.0f}s. You can start another document meanwhile; it will appear under Recent Documents.")
+    st.markdown(job.draft or job.partial_text)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("Back to Form", use_container_width=True, on_click=watch_job, args=(None,))
+    with col2:
+        st.button("Cancel Generation", use_container_width=True, on_click=cancel_job, args=(job.id,))
+
+# Durable history shared by every session in this process
+@st.cache_resource
+def get_history_store():
+    return HistoryStore(os.path.join(config.DATA_DIR, "history.sqlite3"))
+
+def history_owner():
+    """Whose history this browser sees: a random id kept in the page URL, so reloads and bookmarks keep it"""
+    owner = st.query_params.get("owner")
+    if not owner:
+        owner = uuid.uuid4().hex
+        st.query_params["owner"] = owner
+    return owner
+
+def history_store():
+    """The history store limited to this browser's documents, or all of it with a shared history"""
+    if config.HISTORY_SCOPE == "shared":
+        return get_history_store()
+    return get_history_store().for_owner(history_owner())
+
 def save_to_history(document, data):
-    """Save generated document to history with timestamp"""
-    # Keep only the 10 most recent documents
-    if len(st.session_state.document_history) >= 10:
-        st.session_state.document_history.pop(0)  # Remove oldest document
-        
-    history_entry = {
-        'timestamp': datetime.now(),
-        'document': document,
-        'metadata': {
-            'subject': data.get('negotiation_subject', 'Untitled'),
-            'value': data.get('project_value', 'N/A'),
-            'data': data.copy()
-        }
-    }
-    st.session_state.document_history.append(history_entry)
+    """Save generated document to the persistent history store"""
+    return history_store().add(document, data)
+
+def set_history_page(page):
+    st.session_state.history_page = page
 
 def render_sidebar_history():
     with st.sidebar:
         st.title("Recent Documents")
-        
-        if not st.session_state.document_history:
-            st.info("No documents generated yet")
+        store = history_store()
+
+        query = st.text_input("Search documents", key="history_query", placeholder="Subject or content")
+        if query != st.session_state.history_last_query:
+            st.session_state.history_last_query = query
+            st.session_state.history_page = 0
+
+        total = store.count(query)
+        if not total:
+            st.info("No matching documents" if query else "No documents generated yet")
             return
 
+        # Only the current page is loaded; bodies are fetched when "View" is clicked
+        page_size = config.HISTORY_PAGE_SIZE
+        pages = (total + page_size - 1) // page_size
+        page = min(st.session_state.history_page, pages - 1)
+        entries = store.list(page * page_size, page_size, query)
+
         # Display documents from newest to oldest
-        for idx, entry in enumerate(reversed(st.session_state.document_history)):
+        for entry in entries:
             with st.expander(
-                f"📄 {entry['metadata']['subject'][:40]}... \n"
+                f"📄 {entry['subject'][:40]}... \n"
                 f"{entry['timestamp'].strftime('%Y-%m-%d %H:%M')}"
             ):
-                st.write(f"**Project Value:** {entry['metadata']['value']}")
+                st.write(f"**Project Value:** {entry['value']}")
+                st.checkbox("Include in archive", value=entry['id'] in st.session_state.archive_selection,
+                            key=f"archive_{entry['id']}", on_change=toggle_archive_selection, args=(entry['id'],))
                 
                 col1, col2 = st.columns(2)
                 with col1:
-                    if st.button("View", key=f"view_{idx}", use_container_width=True):
-                        st.session_state.final_document = entry['document']
-                        st.session_state.collected_data = entry['metadata']['data']
-                        st.session_state.show_document = True
+                    if st.button("View", key=f"view_{entry['id']}", use_container_width=True):
+                        full_entry = store.get(entry['id'])
+                        if full_entry:
+                            set_session_text('final_document', full_entry['document'])
+                            set_session_data('collected_data', full_entry['metadata']['data'])
+                            st.session_state.generation_stats = None
+                            st.session_state.current_job_id = None
+                            st.session_state.show_document = True
                         st.rerun()
                 
                 with col2:
-                    if st.button("Delete", key=f"delete_{idx}", use_container_width=True):
-                        st.session_state.document_history.remove(entry)
+                    if st.button("Delete", key=f"delete_{entry['id']}", use_container_width=True):
+                        store.delete(entry['id'])
                         st.rerun()
+
+        if pages > 1:
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col1:
+                st.button("◀", key="history_prev", disabled=page == 0, use_container_width=True,
+                          on_click=set_history_page, args=(page - 1,))
+            with col2:
+                st.caption(f"Page {page + 1} of {pages} ({total} documents)")
+            with col3:
+                st.button("▶", key="history_next", disabled=page >= pages - 1, use_container_width=True,
+                          on_click=set_history_page, args=(page + 1,))
         
-        if st.session_state.document_history:
-            if st.button("Clear History", use_container_width=True):
-                st.session_state.document_history = []
+        render_archive_export(store, query, total)
+
+        if not st.session_state.confirm_clear_history:
+            st.button("Clear History", use_container_width=True, on_click=set_confirm_clear_history, args=(True,))
+            return
+        whose = "everyone's" if config.HISTORY_SCOPE == "shared" else "your"
+        st.warning(f"Delete all {store.count()} of {whose} documents? This cannot be undone.")
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Delete All", key="confirm_clear_history_button", type="primary", use_container_width=True):
+                store.clear()
+                st.session_state.archive_selection = set()
+                st.session_state.history_page = 0
+                st.session_state.confirm_clear_history = False
                 st.rerun()
+        with col2:
+            st.button("Cancel", key="cancel_clear_history", use_container_width=True,
+                      on_click=set_confirm_clear_history, args=(False,))
 
-# Document Generation Functions
-def generate_pdf(content, filename):
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(
-        buffer,
-        pagesize=letter,
-        rightMargin=72,
-        leftMargin=72,
-        topMargin=72,
-        bottomMargin=72
-    )
-    
-    styles = getSampleStyleSheet()
-    story = []
-    
-    # Add custom styles
-    styles.add(ParagraphStyle(
-        'CustomHeading',
-        parent=styles['Heading1'],
-        fontSize=14,
-        spaceAfter=16
-    ))
-    
-    styles.add(ParagraphStyle(
-        'CustomBody',
-        parent=styles['Normal'],
-        fontSize=10,
-        spaceAfter=12
-    ))
-    
-    # Add title
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Title'],
-        fontSize=24,
-        spaceAfter=30
-    )
-    story.append(Paragraph("BATNA Analysis Document", title_style))
-    story.append(Spacer(1, 12))
-    
-    try:
-        # Split content into sections
-        sections = content.split('\n')
-        current_text = ""
-        
-        for line in sections:
-            line = line.strip()
-            if not line:
-                if current_text:
-                    # Clean the text
-                    cleaned_text = (current_text
-                        .replace('|', ' - ')
-                        .replace('<br>', '\n')
-                        .replace('>', '')
-                        .replace('<', '')
-                    )
-                    
-                    # Check if it's a heading
-                    if cleaned_text.startswith(('1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.')):
-                        story.append(Paragraph(cleaned_text, styles['CustomHeading']))
-                    else:
-                        story.append(Paragraph(cleaned_text, styles['CustomBody']))
-                    
-                    story.append(Spacer(1, 8))
-                    current_text = ""
+def set_confirm_clear_history(value):
+    st.session_state.confirm_clear_history = value
+
+def toggle_archive_selection(entry_id):
+    st.session_state.archive_selection ^= {entry_id}
+
+def build_archive(entry_ids, formats):
+    """Write a ZIP of the entries under DATA_DIR/archives, showing progress, and keep it for download"""
+    folder = os.path.join(config.DATA_DIR, "archives")
+    os.makedirs(folder, exist_ok=True)
+    # Archives are kept only long enough to be downloaded
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if time.time() - os.path.getmtime(path) > config.ARCHIVE_RETENTION:
+            os.remove(path)
+    path = os.path.join(folder, f"{uuid.uuid4().hex}.zip")
+    progress = st.progress(0.0, text="Rendering documents...")
+    with open(path, 'wb') as f:
+        count = write_archive(
+            f, history_store(), entry_ids, formats, config.ARCHIVE_WORKERS,
+            lambda done, total: progress.progress(done / total, text=f"Rendered {done} of {total} documents")
+        )
+    progress.empty()
+    st.session_state.archive = {'path': path, 'count': count}
+
+def render_archive_export(store, query, matching):
+    """Sidebar panel exporting selected, matching or all history entries as one ZIP"""
+    with st.expander("Export Archive", expanded=False):
+        selected = len(st.session_state.archive_selection)
+        scopes = {
+            "Selected": lambda: [i for i in store.ids() if i in st.session_state.archive_selection],
+            "Search results": lambda: store.ids(query),
+            "All documents": lambda: store.ids()
+        }
+        scope = st.radio("Documents", list(scopes), index=0 if selected else 1 if query else 2, key="archive_scope")
+        st.caption(f"{selected} selected, {matching} matching the search")
+        formats = st.multiselect("Formats", ARCHIVE_FORMATS, default=["pdf", "docx"], key="archive_formats")
+        if st.button("Build Archive", use_container_width=True, disabled=not formats):
+            entry_ids = scopes[scope]()
+            if entry_ids:
+                build_archive(entry_ids, formats)
             else:
-                current_text += " " + line if current_text else line
-        
-        # Add any remaining text
-        if current_text:
-            cleaned_text = (current_text
-                .replace('|', ' - ')
-                .replace('<br>', '\n')
-                .replace('>', '')
-                .replace('<', '')
-            )
-            story.append(Paragraph(cleaned_text, styles['CustomBody']))
-    
-    except Exception as e:
-        st.error(f"Error processing content for PDF: {str(e)}")
-        return None
-    
-    try:
-        doc.build(story)
-        pdf = buffer.getvalue()
-        buffer.close()
-        return pdf
-    except Exception as e:
-        st.error(f"Error building PDF: {str(e)}")
-        return None
+                st.warning("No documents to export.")
 
-def generate_word_doc(content, filename):
-    """Generate a formatted Word document"""
-    doc = Document()
-    
-    # Add title
-    title = doc.add_heading('BATNA Analysis Document', 0)
-    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    
-    # Add date
-    date_paragraph = doc.add_paragraph()
-    date_paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    date_paragraph.add_run(datetime.now().strftime("%Y-%m-%d")).italic = True
-    
-    doc.add_paragraph()  # Add spacing
-    
-    try:
-        # Split content into sections
-        sections = content.split('\n')
-        current_text = ""
-        
-        for line in sections:
-            line = line.strip()
-            if not line:
-                if current_text:
-                    # Clean the text
-                    cleaned_text = (current_text
-                        .replace('|', ' - ')
-                        .replace('<br>', '\n')
-                        .replace('>', '')
-                        .replace('<', '')
-                    )
-                    
-                    # Check if it's a heading
-                    if cleaned_text.startswith(('1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.')):
-                        doc.add_heading(cleaned_text, level=1)
-                    else:
-                        doc.add_paragraph(cleaned_text)
-                    
-                    current_text = ""
+        archive = st.session_state.archive
+        if archive and os.path.exists(archive['path']):
+            with open(archive['path'], 'rb') as f:
+                st.download_button(
+                    f"Download ZIP ({archive['count']} document{'s' if archive['count'] != 1 else ''})",
+                    data=f,
+                    file_name=f"BATNA_archive_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+                    mime="application/zip",
+                    use_container_width=True
+                )
+
+# Metrics output is set up once per process
+@st.cache_resource
+def init_metrics():
+    metrics.configure(config.METRICS_LOG_FILE, config.METRICS_PROMETHEUS_FILE, config.METRICS_PORT)
+    metrics.REGISTRY.register_gauges("process", metrics.process_memory)
+
+# Imports the form page skips, done in the background once per process after the
+# first page is out, so the first submit and export do not wait for them
+@st.cache_resource
+def start_warmup():
+    def warm():
+        try:
+            with metrics.timed("warmup"):
+                load_backends()
+                import llm_client  # noqa: F401
+        except Exception as e:
+            metrics.logger.warning("Warm-up failed: %s", e)
+
+    thread = threading.Thread(target=warm, daemon=True, name="batna-warmup")
+    thread.start()
+    return thread
+
+def current_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+def render_sidebar_metrics():
+    """Stage percentiles, this session's totals and process gauges for operators"""
+    with st.sidebar:
+        with st.expander("Performance", expanded=False):
+            rows = metrics.REGISTRY.summary()
+            if rows:
+                st.dataframe(rows, hide_index=True, use_container_width=True)
             else:
-                current_text += " " + line if current_text else line
-        
-        # Add any remaining text
-        if current_text:
-            cleaned_text = (current_text
-                .replace('|', ' - ')
-                .replace('<br>', '\n')
-                .replace('>', '')
-                .replace('<', '')
-            )
-            doc.add_paragraph(cleaned_text)
-        
-        # Save to buffer
-        buffer = io.BytesIO()
-        doc.save(buffer)
-        buffer.seek(0)
-        return buffer.getvalue()
-        
-    except Exception as e:
-        st.error(f"Error generating Word document: {str(e)}")
-        return None
+                st.caption("No timings recorded yet.")
+            session = metrics.REGISTRY.session_summary(current_session_id())
+            if session:
+                st.markdown("**This session**")
+                st.json(session)
+            gauges = metrics.REGISTRY.gauges()
+            if gauges:
+                st.markdown("**Process**")
+                st.json(gauges)
 
-def generate_text_doc(content):
-    """Generate a plain text document"""
+# Export cache shared by every session in this process
+@st.cache_resource
+def get_export_cache():
+    cache = ExportCache(config.EXPORT_CACHE_MAX_ENTRIES, config.EXPORT_CACHE_MAX_BYTES, config.EXPORT_WORKERS)
+    metrics.REGISTRY.register_gauges("export_cache", cache.stats)
+    return cache
+
+# Exports of large documents: rendered by worker processes to files shared by every session
+@st.cache_resource
+def get_export_files():
+    files = ExportFiles(os.path.join(config.DATA_DIR, "exports"), config.EXPORT_FILES_MAX_BYTES,
+                        config.EXPORT_WORKERS)
+    metrics.REGISTRY.register_gauges("export_files", files.stats)
+    return files
+
+def is_large_document(content):
+    return len(content) >= config.LARGE_DOCUMENT_CHARS
+
+def prerender_exports(cache, files, content):
+    """Start rendering every export of content on the cache's worker pool, or as files for a large document.
+
+    Safe to call from any thread, so jobs call it as soon as a document is
+    finished; formats that are cached or already rendering are skipped.
+    """
+    if is_large_document(content):
+        return {fmt: files.render_async(content, fmt, export_settings(fmt)) for fmt in EXPORT_FORMATS}
+    return {fmt: cache.render_async(content, fmt, lambda fmt=fmt: render_export(content, fmt), export_settings(fmt))
+            for fmt in EXPORT_FORMATS}
+
+def ready_export(content, fmt):
+    """(export bytes, True) once rendered, or (None, False) while the background render runs"""
+    future = prerender_exports(get_export_cache(), get_export_files(), content)[fmt]
+    if not future.done():
+        st.session_state.exports_pending = True
+        return None, False
+    if future.exception() is not None:
+        # The cache remembers the failure for a while, so polling does not start the render again
+        st.error(f"Error building the {fmt.upper()} file: {future.exception()}")
+        return None, True
+    if not is_large_document(content):
+        return future.result(), True
+    # The download button needs the bytes; the renderer's working memory stayed in the worker
     try:
-        # Clean and format the content
-        cleaned_content = (content
-            .replace('|', ' - ')
-            .replace('<br>', '\n')
-            .replace('>', '')
-            .replace('<', '')
+        with open(future.result(), 'rb') as f:
+            return f.read(), True
+    except FileNotFoundError:
+        # Evicted by another process sharing the directory; the next run renders it again
+        st.session_state.exports_pending = True
+        return None, False
+
+def edit_inputs():
+    """Reopen the form with the shown document's inputs, keeping it as the base for a partial refresh"""
+    data = session_data('collected_data')
+    for key in INPUT_FIELDS:
+        st.session_state[f"input_{key}"] = data.get(key, "")
+    set_session_text('edit_base_document', session_text('final_document'))
+    set_session_data('edit_base_data', data)
+    st.session_state.show_document = False
+
+def submit_scenarios(base_document, base_data, variants, tier):
+    """Generate variants of the shown document's inputs as one background job"""
+    client = init_client()
+    if not client:
+        return
+    response_cache = get_response_cache() if config.RESPONSE_CACHE_ENABLED else None
+    job = get_job_queue().submit(
+        run_scenario_job, client, dict(base_data), variants, config.SCENARIO_MAX_CONCURRENCY,
+        config.PARALLEL_MAX_WORKERS, tier, response_cache, history_store(),
+        description=f"{len(variants)} scenarios: {base_data.get('negotiation_subject', 'Untitled')}"
+    )
+    # The comparison is against the document as it is now, whatever is opened meanwhile
+    set_session_text('scenario_base', base_document)
+    st.session_state.job_ids.append(job.id)
+    st.session_state.current_job_id = job.id
+    st.session_state.show_document = False
+    st.rerun()
+
+def render_scenario_builder(document, data):
+    """Define input variants of the shown document to generate side by side"""
+    with st.expander("Compare Scenarios", expanded=False):
+        st.caption("Change some inputs or the temperature for each scenario. All scenarios are generated "
+                   "at the same time and compared section by section with this document.")
+        labels = list(INPUT_FIELDS.values())
+        keys = dict(zip(labels, INPUT_FIELDS))
+        col1, col2 = st.columns(2)
+        with col1:
+            count = st.number_input("Number of scenarios", min_value=1, max_value=config.SCENARIO_MAX_VARIANTS,
+                                    value=min(2, config.SCENARIO_MAX_VARIANTS), key="scenario_count")
+        with col2:
+            tier_label = st.radio("Model", [TIER_LABELS['quality'], TIER_LABELS['draft']], horizontal=True,
+                                  key="scenario_tier")
+
+        variants = []
+        for columns_start in range(0, int(count), 2):
+            columns = st.columns(2)
+            for index in range(columns_start, min(columns_start + 2, int(count))):
+                with columns[index - columns_start]:
+                    name = st.text_input("Scenario name", value=f"Scenario {chr(ord('A') + index)}",
+                                         key=f"scenario_name_{index}")
+                    fields = st.multiselect("Inputs to change", labels, key=f"scenario_fields_{index}")
+                    overrides = {}
+                    for label in fields:
+                        key = keys[label]
+                        overrides[key] = st.text_area(label, value=data.get(key, ""), key=f"scenario_{index}_{key}")
+                    temperature = st.slider("Temperature", 0.0, 1.0, TEMPERATURE, 0.1,
+                                            key=f"scenario_temperature_{index}")
+                    variants.append(new_variant(name.strip() or f"Scenario {index + 1}", overrides, temperature))
+
+        if st.button("Generate Scenarios", type="primary", use_container_width=True):
+            tier = next(tier for tier, label in TIER_LABELS.items() if label == tier_label)
+            submit_scenarios(document, data, variants, tier)
+
+def render_scenario_progress(job):
+    st.header("🔀 Generating Scenarios")
+    finished = [variant for variant in job.variants if variant['status'] in (DONE, FAILED)]
+    st.progress(len(finished) / len(job.variants),
+                text=f"{len(finished)} of {len(job.variants)} scenarios finished")
+    elapsed = time.time() - (job.started or time.time())
+    st.caption(f"Running for {elapsed:.0f}s. The scenarios are generated at the same time "
+               f"(up to {config.SCENARIO_MAX_CONCURRENCY} at once).")
+    st.dataframe([{
+        'Scenario': variant['name'],
+        'Status': variant['status'],
+        'Seconds': round(variant['stats']['total_latency'], 1) if variant['stats'] else None
+    } for variant in job.variants], hide_index=True, use_container_width=True)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("Back to Form", use_container_width=True, on_click=watch_job, args=(None,))
+    with col2:
+        st.button("Cancel Generation", use_container_width=True, on_click=cancel_job, args=(job.id,))
+
+def open_scenarios(job):
+    """Show a finished scenario job's comparison; documents are read back from history"""
+    st.session_state.scenarios = {
+        'variants': [{key: variant[key] for key in ('name', 'overrides', 'temperature', 'status', 'error',
+                                                    'stats', 'entry_id')}
+                     for variant in job.variants],
+        'stats': job.stats
+    }
+    st.session_state.show_document = False
+    st.session_state.current_job_id = None
+
+def close_scenarios():
+    st.session_state.scenarios = None
+    st.session_state.show_document = bool(session_text('final_document'))
+
+def open_scenario_document(entry_id):
+    entry = history_store().get(entry_id)
+    if entry:
+        set_session_text('final_document', entry['document'])
+        set_session_data('collected_data', entry['metadata']['data'])
+        st.session_state.generation_stats = None
+        st.session_state.scenarios = None
+        st.session_state.show_document = True
+
+def diff_html(old, new):
+    """new with the words added since old highlighted and those removed struck through"""
+    parts = []
+    for op, text in word_diff(old, new):
+        text = html.escape(text)
+        if op == "insert":
+            parts.append(f"<ins style='background-color: #D5F5E3; text-decoration: none;'>{text}</ins>")
+        elif op == "delete":
+            parts.append(f"<del style='background-color: #FADBD8; color: #922B21;'>{text}</del>")
+        else:
+            parts.append(text)
+    return f"<div style='white-space: pre-wrap; font-size: 0.9em;'>{''.join(parts)}</div>"
+
+def render_scenarios():
+    """The base document and each scenario side by side, section by section"""
+    scenarios = st.session_state.scenarios
+    st.header("🔀 Scenario Comparison")
+    store = history_store()
+    columns = [("Current document", session_text('scenario_base') or "", None)]
+    for variant in scenarios['variants']:
+        entry = store.get(variant['entry_id']) if variant['entry_id'] else None
+        if entry:
+            columns.append((variant['name'], entry['document'], variant))
+        else:
+            st.warning(f"{variant['name']} could not be generated: {variant['error'] or 'it was deleted from history'}")
+
+    stats = scenarios['stats'] or {}
+    if stats:
+        st.caption(
+            f"{len(scenarios['variants'])} scenarios generated by {stats['model']} in {stats['wall_seconds']:.1f}s; "
+            f"one after another they would have taken {stats['sum_seconds']:.1f}s "
+            f"({stats['output_tokens']} output tokens, ${stats['cost_usd']:.3f})"
         )
-        
-        # Add header
-        text_content = f"""BATNA ANALYSIS DOCUMENT
-Generated on: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-{'='*50}\n\n"""
-        
-        text_content += cleaned_content
-        
-        return text_content.encode('utf-8')
-        
-    except Exception as e:
-        st.error(f"Error generating text document: {str(e)}")
+    st.dataframe([{
+        'Scenario': variant['name'],
+        'Changed inputs': ", ".join(INPUT_FIELDS[key] for key, value in variant['overrides'].items() if value.strip())
+                          or "none",
+        'Temperature': variant['temperature'],
+        'Seconds': round(variant['stats']['total_latency'], 1) if variant['stats'] else None,
+        'Cached': bool(variant['stats'] and variant['stats'].get('cached'))
+    } for variant in scenarios['variants']], hide_index=True, use_container_width=True)
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        only_changed = st.checkbox("Only sections that differ", value=True, key="scenario_only_changed")
+    with col2:
+        highlight = st.checkbox("Highlight changes from the current document", key="scenario_highlight")
+    with col3:
+        st.button("Back to Document", use_container_width=True, on_click=close_scenarios)
+
+    rows = compare_sections([document for _, document, _ in columns])
+    for row in rows:
+        if only_changed and not row['differs']:
+            continue
+        st.subheader(f"{row['number']}. {row['title']}")
+        for index, col in enumerate(st.columns(len(columns))):
+            text = row['texts'][index]
+            with col:
+                st.markdown(f"**{columns[index][0]}**")
+                if index:
+                    st.caption(f"{row['similarity'][index] * 100:.0f}% similar to the current document")
+                if index and highlight and text:
+                    st.markdown(diff_html(row['texts'][0], text), unsafe_allow_html=True)
+                else:
+                    st.markdown(text or "_Missing from this document_")
+    if only_changed and not any(row['differs'] for row in rows):
+        st.info("Every section is the same in all scenarios.")
+
+    st.markdown("---")
+    buttons = st.columns(max(len(columns) - 1, 1))
+    for button, (name, _, variant) in zip(buttons, columns[1:]):
+        with button:
+            st.button(f"Open {name}", key=f"open_scenario_{variant['entry_id']}", use_container_width=True,
+                      on_click=open_scenario_document, args=(variant['entry_id'],))
+
+def describe_compaction(notes):
+    return ", ".join(
+        f"{INPUT_FIELDS.get(key, key)} ({before:,} → {after:,} tokens, {method})"
+        for key, (before, after, method) in notes.items()
+    )
+
+def budget_notice(data):
+    """Estimated prompt size for the data about to be sent and what the budget policy will shorten.
+
+    Returns (is_warning, message), or None when there is nothing to say.
+    """
+    if config.INPUT_BUDGET_POLICY == "off" or not any(data.values()):
         return None
+    tokens = estimate_prompt_tokens(data)
+    _, budget = apply_input_budget(None, data, condense=False)
+    if budget['compacted']:
+        return True, (
+            f"The inputs come to about {tokens:,} prompt tokens (budget {config.PROMPT_TOKEN_BUDGET:,}). "
+            f"Before sending, these fields will be shortened ({config.INPUT_BUDGET_POLICY}): "
+            f"{describe_compaction(budget['compacted'])}"
+        )
+    return False, f"Estimated prompt size: about {tokens:,} tokens, up to {budget['max_tokens']:,} output tokens."
+
+def render_budget_notice(notice):
+    if notice is None:
+        return
+    is_warning, message = notice
+    if is_warning:
+        st.warning(message)
+    else:
+        st.caption(message)
 
 def render_input_form():
-    sections = {
-        "negotiation_subject": "Negotiation Subject",
-        "project_value": "Project Value",
-        "company_profile": "Company's Profile & Industry",
-        "scope_description": "Scope Description",
-        "targets": "Targets to be Achieved",
-        "vendors": "Vendors & Suppliers to be Invited",
-        "interests": "Client's & Vendor's Interests",
-        "advantages": "Client's & Vendors' Negotiation Advantages",
-        "disadvantages": "Client's & Vendors' Negotiation Disadvantages"
-    }
+    sections = INPUT_FIELDS
     
     # Create form for all inputs
     with st.form("batna_form"):
@@ -359,62 +845,193 @@ def render_input_form():
                     all_fields_filled = False
                 st.markdown("---")
         
+        force_regenerate = False
+        if config.RESPONSE_CACHE_ENABLED:
+            force_regenerate = st.checkbox(
+                "Force regenerate",
+                help="Ignore any cached document for identical inputs and request a fresh one."
+            )
+        tiers = list(TIER_LABELS)
+        tier_label = st.selectbox(
+            "Model",
+            list(TIER_LABELS.values()),
+            index=tiers.index(config.MODEL_TIER) if config.MODEL_TIER in tiers else 0,
+            help=f"Full quality writes with {MODEL}; a fast draft uses {DRAFT_MODEL}. "
+                 f"Draft-then-refine shows the draft first and replaces it with a {MODEL} revision."
+        )
+        tier = tiers[list(TIER_LABELS.values()).index(tier_label)]
+        parallel = st.checkbox(
+            "Generate sections in parallel",
+            value=config.PARALLEL_SECTIONS,
+            help="Write the sections as concurrent requests and the executive summary last. Usually faster."
+        )
+        incremental = False
+        if st.session_state.get('edit_base_document_ref'):
+            incremental = st.checkbox(
+                "Only regenerate sections affected by my edits",
+                value=True,
+                help="Keep the sections of the previous document that do not depend on the changed fields."
+            )
+
         # Submit button
         submitted = st.form_submit_button("Generate BATNA Document", use_container_width=True)
-        if submitted:
-            if all_fields_filled:
-                for key in sections.keys():
-                    st.session_state.collected_data[key] = st.session_state[f"input_{key}"]
-                generate_batna_document()
-            else:
-                st.error("Please fill in all fields before generating the BATNA document.")
+        if submitted and not all_fields_filled:
+            st.error("Please fill in all fields before generating the BATNA document.")
 
-def generate_batna_document():
-    client = init_client()
-    if not client:
-        return
+    # Generate outside the form so the streamed document renders below it
+    if submitted and all_fields_filled:
+        set_session_data('collected_data', {key: st.session_state[f"input_{key}"] for key in sections})
+        generate_batna_document(force_regenerate, parallel, incremental, tier=tier)
 
-    prompt = """Create a comprehensive BATNA document based on the following information:
+def use_similar_document(entry_id, score):
+    """Show a past analysis for the new inputs instead of generating one"""
+    entry = history_store().get(entry_id)
+    st.session_state.similar_matches = None
+    if entry:
+        set_session_text('final_document', entry['document'])
+        st.session_state.generation_stats = {'reused_entry': entry_id, 'score': score}
+        st.session_state.show_document = True
+        metrics.incr("generation_avoided_total", how="reused")
 
-    {input_data}
+def choose_similar(mode, entry_id=None):
+    """Generate after the similar analyses were shown: from scratch, or with a past one as the draft"""
+    offer = st.session_state.similar_matches
+    st.session_state.similar_choice = {'mode': mode, 'entry_id': entry_id,
+                                       'parallel': offer['parallel'], 'tier': offer['tier']}
+    st.session_state.similar_matches = None
+    if mode == "draft":
+        metrics.incr("generation_avoided_total", how="drafted")
+    else:
+        metrics.incr("similar_declined_total")
 
-    As an AI assistant, your task is to provide a comprehensive, well-structured analysis of a negotiation scenario between a client and a vendor. The analysis should cover various aspects, including the client's and vendor's Best Alternative To a Negotiated Agreement (BATNA), risk assessment and mitigation strategies, negotiation strategy and tactics, and an implementation roadmap. The analysis should be thorough, considering multiple scenarios and potential outcomes, and should include actionable recommendations for the client.
-    Please use for the final BATNA Document the structure below:
+def close_similar():
+    st.session_state.similar_matches = None
 
-    1. EXECUTIVE SUMMARY
-    [In this section, provide a concise yet comprehensive overview of the entire analysis, highlighting the key findings and critical recommendations. The summary should be engaging and persuasive, encouraging the reader to delve into the details of the analysis.]
+def render_similar_matches():
+    offer = st.session_state.similar_matches
+    store = history_store()
+    st.header("🔎 Similar Past Analyses")
+    st.write("These earlier BATNA documents were written for inputs close to yours. "
+             "Reuse one as it is, use it as a draft so only the sections your changes affect are rewritten, "
+             "or generate a new document from scratch.")
 
-    2. CLIENT'S BATNA ANALYSIS
-    [Format: table with following columns: Alternative Options, Strength Assessment, Risk Assessment. Instruction: Following the table, present a detailed analysis of each viable alternative available to the client. Consider factors such as implementation feasibility, cost implications, and strategic fit. The analysis should provide a clear understanding of the client's position and the potential outcomes of pursuing alternative options.]
+    data = session_data('collected_data')
+    for match in offer['matches']:
+        entry = store.get(match['id'])
+        if not entry:
+            continue
+        differing = [INPUT_FIELDS[key] for key in changed_fields(entry['metadata']['data'], data)]
+        with st.container(border=True):
+            st.markdown(f"**{match['subject'][:80]}** · {match['value']} · "
+                        f"{match['timestamp'].strftime('%Y-%m-%d %H:%M')} · **{match['score'] * 100:.0f}% similar**")
+            st.caption(f"Differs in: {', '.join(differing)}" if differing else "Same inputs")
+            with st.expander("Preview"):
+                st.markdown(entry['document'][:3000])
+            col1, col2 = st.columns(2)
+            with col1:
+                st.button("Use this document", key=f"similar_use_{match['id']}", use_container_width=True,
+                          on_click=use_similar_document, args=(match['id'], match['score']))
+            with col2:
+                st.button("Use as draft", key=f"similar_draft_{match['id']}", use_container_width=True,
+                          on_click=choose_similar, args=("draft", match['id']))
 
-    3. VENDOR'S BATNA ANALYSIS
-    [Format: table with following columns: Alternative Options, Strength Assessment, Risk Assessment. Instruction: After the table, analyze the vendor's alternatives, market position, and potential responses to different scenarios. This analysis should provide insights into the vendor's strengths, weaknesses, and likely negotiation strategies.]
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("Generate from scratch", use_container_width=True, on_click=choose_similar, args=("scratch",))
+    with col2:
+        st.button("Back to Form", use_container_width=True, on_click=close_similar)
 
-    4. RISK ASSESSMENT & MITIGATION
-    [Format: table with following columns: Risk Category, Mitigation Strategy, Contingency Plan. Instruction: Following the table, provide a comprehensive analysis of potential risks associated with the negotiation and the proposed mitigation strategies. Consider various risk categories, such as financial, operational, and reputational risks. The analysis should demonstrate a proactive approach to risk management and contingency planning.]
+    offers = metrics.REGISTRY.total("similar_offers_total")
+    avoided = metrics.REGISTRY.total("generation_avoided_total")
+    if offers:
+        st.caption(f"Since the server started, similar analyses avoided a full generation {avoided:.0f} times in {offers:.0f} offers.")
 
-    5. NEGOTIATION STRATEGY
-    [Present a detailed strategic approach to the negotiation, covering core objectives, non-negotiables, value creation opportunities, power dynamics, leverage points, and relationship management. The strategy should be well-reasoned and adaptable, taking into account the insights gained from the BATNA and risk analyses.]
+def generate_batna_document(force_regenerate=False, parallel=False, incremental=False,
+                            offer_similar=True, draft_entry_id=None, tier="quality"):
+    data = session_data('collected_data')
+    tier = route_tier(tier, data)
+    cache_key = response_cache_key(data, parallel, tier)
 
-    6. NEGOTIATION TACTICS
-    [Detail specific tactical recommendations for the negotiation, including type of the process (e.g. single source, RFx, auction...), opening positions, communication strategies, response scenarios, and timing considerations. The tactics should be aligned with the overall negotiation strategy and designed to maximize the client's chances of achieving a favorable outcome.]
+    reuse = references = None
+    base_document = session_text('edit_base_document')
+    if incremental and base_document:
+        reuse = reusable_sections(base_document, session_data('edit_base_data'), data)
+        if reuse is None:
+            st.warning("The previous document's sections could not be identified; regenerating it in full.")
+    set_session_text('edit_base_document', None)
+    set_session_data('edit_base_data', None)
 
-    7. RECOMMENDATIONS
-    [Provide clear, actionable recommendations for the client, including immediate next steps, critical success factors, resource requirements, and expected outcomes. The recommendations should be based on the insights gained from the analysis and designed to help the client achieve their objectives in the negotiation.]
-    
-    Formating:  
-    -heading"bold and larger than normal text
-    -devider after every of the 8 sections
-    """
-    
-    formatted_data = "\n\n".join([f"{k.replace('_', ' ').title()}: {v}" 
-                                 for k, v in st.session_state.collected_data.items()])
-    
+    if draft_entry_id is not None:
+        entry = history_store().get(draft_entry_id)
+        if entry:
+            reuse, references = draft_sections(entry['document'], entry['metadata']['data'], data)
+        if reuse is None:
+            st.warning("The past document's sections could not be identified; generating a new one.")
+
+    if config.RESPONSE_CACHE_ENABLED and not force_regenerate:
+        start = time.perf_counter()
+        cached = get_response_cache().get(cache_key)
+        if cached:
+            set_session_text('final_document', cached)
+            st.session_state.generation_stats = {'cached': True, 'total_latency': time.perf_counter() - start}
+            # A resubmitted form keeps its earlier history entry rather than adding the same document again
+            if history_store().find(cached) is None:
+                save_to_history(cached, data)
+            st.session_state.show_document = True
+            st.rerun()
+
+    if offer_similar and config.SIMILAR_SUGGESTIONS and reuse is None and not force_regenerate:
+        matches = history_store().similar(data, config.SIMILAR_MAX_RESULTS, config.SIMILAR_MIN_SCORE)
+        if matches:
+            metrics.incr("similar_offers_total")
+            st.session_state.similar_matches = {'matches': matches, 'parallel': parallel, 'tier': tier}
+            st.rerun()
+
+    client = init_client()
+    if not client:
+        return
+    # Estimated from the submitted data: form fields only reach session state on submit
+    notice = budget_notice(data)
+
+    # A partly reused document is not what a full generation would return, so it is not cached
+    use_response_cache = config.RESPONSE_CACHE_ENABLED and reuse is None
+
+    if config.BACKGROUND_JOBS:
+        response_cache = get_response_cache() if use_response_cache else None
+        job = get_job_queue().submit(
+            run_generation_job, client, dict(data), parallel, config.PARALLEL_MAX_WORKERS,
+            response_cache, cache_key, history_store(), reuse, references, tier,
+            partial(prerender_exports, get_export_cache(), get_export_files()),
+            description=data.get('negotiation_subject', 'Untitled')
+        )
+        st.session_state.job_ids.append(job.id)
+        st.session_state.current_job_id = job.id
+        if notice is not None:
+            st.session_state.budget_notices[job.id] = notice
+        st.rerun()
+
+    st.header("📄 Generating BATNA Document")
+    render_budget_notice(notice)
     with st.spinner("Generating BATNA document..."):
-        response = get_assistant_response(client, prompt.format(input_data=formatted_data))
+        refine = tier == "refine" and reuse is None
+        model = DRAFT_MODEL if tier == "draft" or refine else MODEL
+        if parallel or reuse is not None:
+            response, stats = generate_sections_on_page(client, data, reuse, references, model)
+        else:
+            response, stats = stream_assistant_response(client, data, model)
+        if response and refine:
+            st.info("Draft ready. Refining it section by section...")
+            refined, refined_stats = generate_sections_on_page(client, data, draft=(response, stats))
+            if refined:
+                response, stats = refined, refined_stats
+            else:
+                use_response_cache = False
         if response:
-            st.session_state.final_document = response
-            save_to_history(response, st.session_state.collected_data)
+            if use_response_cache:
+                get_response_cache().put(cache_key, response)
+            set_session_text('final_document', response)
+            st.session_state.generation_stats = stats
+            save_to_history(response, data)
             st.session_state.show_document = True
             st.rerun()
 
@@ -436,66 +1053,159 @@ def main():
     st.markdown("---")
     
     initialize_session_state()
+
+    current_job = get_current_job()
+    # Set again by the download buttons while their files are still rendering
+    st.session_state.exports_pending = False
+
+    render_sidebar_jobs()
     render_sidebar_history()
+    if config.ADMIN_PANEL:
+        render_sidebar_metrics()
     
-    if not st.session_state.show_document:
+    choice = st.session_state.similar_choice
+    if choice and not current_job:
+        st.session_state.similar_choice = None
+        generate_batna_document(parallel=choice['parallel'], offer_similar=False, draft_entry_id=choice['entry_id'],
+                                tier=choice['tier'])
+
+    if current_job:
+        render_job_progress(current_job)
+    elif st.session_state.scenarios is not None:
+        render_scenarios()
+    elif st.session_state.similar_matches:
+        render_similar_matches()
+    elif not st.session_state.show_document:
         render_input_form()
     else:
         # Display generated document
         st.header("📄 Generated BATNA Document")
         st.markdown("---")
         
-        if st.session_state.final_document:
+        document = session_text('final_document')
+        if document:
             # Add expander to show input data
             with st.expander("View Input Data", expanded=False):
-                for key, value in st.session_state.collected_data.items():
+                for key, value in session_data('collected_data').items():
                     st.markdown(f"**{key.replace('_', ' ').title()}:**")
                     st.markdown(f"{value}")
                     st.markdown("---")
             
-            st.markdown(st.session_state.final_document)
+            # Exports render in the background while the document is shown
+            prerender_exports(get_export_cache(), get_export_files(), document)
+            st.markdown(document)
+
+            stats = st.session_state.generation_stats
+            if stats and stats.get('reused_entry'):
+                st.caption(f"Reused a past analysis ({stats['score'] * 100:.0f}% similar inputs) instead of generating a new one")
+            elif stats and stats.get('cached'):
+                st.caption(f"Loaded from the response cache in {stats['total_latency'] * 1000:.0f} ms")
+            elif stats and stats.get('mode') == 'incremental':
+                st.caption(
+                    f"Regenerated {len(stats['regenerated'])} of {len(SECTION_TITLES)} sections "
+                    f"in {stats['total_latency']:.1f}s ({stats['output_tokens']} output tokens)"
+                )
+            elif stats and stats.get('mode') == 'refine':
+                st.caption(
+                    f"Drafted by {stats['draft_model']} in {stats['draft_latency']:.1f}s, then refined by "
+                    f"{stats['model']}: {stats['total_latency']:.1f}s in total "
+                    f"({stats['output_tokens']} output tokens, ${stats.get('cost_usd', 0):.3f})"
+                )
+            elif stats:
+                first = "first section" if stats.get('mode') == 'parallel' else "first token"
+                cached_tokens = stats.get('cache_read_input_tokens')
+                st.caption(
+                    f"Generated by {stats['model']} in {stats['total_latency']:.1f}s "
+                    f"({first} after {stats['time_to_first_token']:.1f}s, "
+                    f"{stats['output_tokens']} output tokens"
+                    + (f", {cached_tokens} prompt tokens read from cache" if cached_tokens else "")
+                    + (f", ${stats['cost_usd']:.3f}" if stats.get('cost_usd') else "") + ")"
+                )
+                if stats.get('refine_error'):
+                    st.warning(f"Refining the draft failed ({stats['refine_error']}); this is the fast draft.")
+                if stats.get('continuations') or stats.get('filled_sections'):
+                    st.caption(
+                        f"The response hit the length limit: continued {stats.get('continuations', 0)} time(s), "
+                        f"sections requested separately: {', '.join(map(str, stats.get('filled_sections', []))) or 'none'}"
+                    )
+            if stats and stats.get('budget', {}).get('compacted'):
+                st.caption(f"Inputs shortened to fit the prompt budget: {describe_compaction(stats['budget']['compacted'])}")
             
             # Export options
             st.markdown("---")
             st.subheader("Export Options")
             
-            col1, col2, col3, col4 = st.columns(4)
+            col1, col2, col3, col4, col5 = st.columns(5)
             
             with col1:
                 if st.button("Create New Document", use_container_width=True):
-                    st.session_state.collected_data = {}
+                    set_session_data('collected_data', None)
+                    set_session_text('edit_base_document', None)
+                    set_session_data('edit_base_data', None)
                     st.session_state.show_document = False
                     st.rerun()
-            
+
             with col2:
+                st.button("Edit Inputs", use_container_width=True, on_click=edit_inputs,
+                          help="Change some fields and regenerate only the sections they affect.")
+            
+            with col3:
+                data, ready = ready_export(document, "pdf")
                 if st.download_button(
-                    label="Download as PDF",
-                    data=generate_pdf(st.session_state.final_document, "BATNA_document.pdf"),
+                    label="Download as PDF" if ready else "Preparing PDF...",
+                    data=data or b"",
                     file_name=f"BATNA_document_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
                     mime="application/pdf",
-                    use_container_width=True
+                    use_container_width=True,
+                    disabled=data is None
                 ):
                     st.success("PDF downloaded successfully!")
             
-            with col3:
+            with col4:
+                data, ready = ready_export(document, "docx")
                 if st.download_button(
-                    label="Download as Word",
-                    data=generate_word_doc(st.session_state.final_document, "BATNA_document.docx"),
+                    label="Download as Word" if ready else "Preparing Word...",
+                    data=data or b"",
                     file_name=f"BATNA_document_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx",
                     mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    use_container_width=True
+                    use_container_width=True,
+                    disabled=data is None
                 ):
                     st.success("Word document downloaded successfully!")
             
-            with col4:
+            with col5:
+                data, ready = ready_export(document, "txt")
                 if st.download_button(
-                    label="Download as Text",
-                    data=generate_text_doc(st.session_state.final_document),
+                    label="Download as Text" if ready else "Preparing Text...",
+                    data=data or b"",
                     file_name=f"BATNA_document_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
                     mime="text/plain",
-                    use_container_width=True
+                    use_container_width=True,
+                    disabled=data is None
                 ):
                     st.success("Text document downloaded successfully!")
 
+            render_scenario_builder(document, session_data('collected_data'))
+
+def poll_jobs():
+    """Rerun after a short wait while this session has generations or exports in flight.
+
+    A watched job that finished after the page was drawn still needs one more
+    run to be opened, so it counts as in flight until get_current_job clears it.
+    """
+    if (st.session_state.get('exports_pending') or st.session_state.get('current_job_id')
+            or any(job.status not in FINISHED_STATES for job in session_jobs())):
+        time.sleep(config.JOB_POLL_INTERVAL)
+        st.rerun()
+
 if __name__ == "__main__":
-    main()
+    init_metrics()
+    metrics.set_session(current_session_id())
+    try:
+        with metrics.timed("page_render"):
+            main()
+        if config.WARMUP:
+            start_warmup()
+        poll_jobs()
+    finally:
+        metrics.write_prometheus_file()
@@ -0,0 +1,154 @@
+"""Bulk export of history entries as one ZIP archive.
+
+    python archive.py -o wave.zip --formats pdf,docx --query "logistics"
+
+Every entry gets its documents in the chosen formats ("md" is the model's
+text as generated) under <id>_<subject>/, and index.json lists the inputs,
+metadata and file names of all of them. Entries are rendered on a pool of
+worker processes and written to the archive as they finish, at most a few
+entries ahead of the writer, so memory stays flat however many there are.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+
+import config
+import metrics
+from exporters import EXPORT_FORMATS, render_export
+from history_store import HistoryStore
+
+ARCHIVE_FORMATS = ('md',) + tuple(EXPORT_FORMATS)
+INDEX_NAME = "index.json"
+
+# Entries rendered ahead of the one being written, per worker
+READ_AHEAD = 2
+
+
+def entry_folder(entry):
+    subject = re.sub(r'[^A-Za-z0-9._-]+', '_', entry['metadata']['subject']).strip('._')[:60]
+    return f"{entry['id']:05d}_{subject or 'document'}"
+
+
+def render_entry(document, formats):
+    """{format: bytes} for one document; runs in a worker process"""
+    return {fmt: document.encode('utf-8') if fmt == 'md' else render_export(document, fmt) for fmt in formats}
+
+
+def _completed(fn, *args):
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def write_archive(fileobj, store, entry_ids, formats=ARCHIVE_FORMATS, workers=None, on_progress=None):
+    """Write a ZIP of the given history entries to fileobj; returns the number archived.
+
+    workers is the number of rendering processes (default one per core,
+    1 renders in this thread). on_progress(done, total) is called after
+    each entry. Entries that were deleted are skipped; one whose render
+    fails is listed in the index with its error.
+    """
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    if workers > 1:
+        # spawn rather than fork: the app and the batch runner have other threads running
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    index = []
+    pending = deque()
+    start = time.perf_counter()
+
+    def write_next(archive):
+        entry, future = pending.popleft()
+        folder = entry_folder(entry)
+        record = {
+            'id': entry['id'],
+            'created': entry['timestamp'].isoformat(timespec='seconds'),
+            'subject': entry['metadata']['subject'],
+            'value': entry['metadata']['value'],
+            'inputs': entry['metadata']['data'],
+            'files': []
+        }
+        try:
+            files = future.result()
+        except Exception as e:
+            record['error'] = f"{type(e).__name__}: {e}"
+            files = {}
+        for fmt, data in files.items():
+            name = f"{folder}/{folder}.{fmt}"
+            archive.writestr(name, data)
+            record['files'].append(name)
+        index.append(record)
+        if on_progress:
+            on_progress(len(index), len(entry_ids))
+
+    try:
+        with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for entry_id in entry_ids:
+                entry = store.get(entry_id)
+                if entry is None:
+                    continue
+                if pool is None:
+                    future = _completed(render_entry, entry['document'], formats)
+                else:
+                    future = pool.submit(render_entry, entry['document'], formats)
+                # Only the document body goes to the worker; keep the rest for the index
+                del entry['document']
+                pending.append((entry, future))
+                while len(pending) > workers * READ_AHEAD:
+                    write_next(archive)
+            while pending:
+                write_next(archive)
+            archive.writestr(INDEX_NAME, json.dumps({
+                'exported': datetime.now().isoformat(timespec='seconds'),
+                'formats': list(formats),
+                'documents': index
+            }, indent=2, ensure_ascii=False))
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    metrics.observe("archive_export", time.perf_counter() - start)
+    metrics.incr("archived_documents_total", len(index))
+    return len(index)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export BATNA history entries as a ZIP archive")
+    parser.add_argument("-o", "--output", required=True, help="ZIP file to write")
+    parser.add_argument("--ids", help="comma separated entry ids (default: every entry)")
+    parser.add_argument("--query", help="only entries matching this history search")
+    parser.add_argument("--formats", default=",".join(ARCHIVE_FORMATS), help="comma separated formats")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="rendering processes")
+    args = parser.parse_args(argv)
+    args.formats = [fmt.strip() for fmt in args.formats.split(',') if fmt.strip()]
+    unknown = [fmt for fmt in args.formats if fmt not in ARCHIVE_FORMATS]
+    if unknown:
+        parser.error(f"unknown format(s): {', '.join(unknown)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    store = HistoryStore(os.path.join(config.DATA_DIR, "history.sqlite3"))
+    entry_ids = [int(i) for i in args.ids.split(',') if i.strip()] if args.ids else store.ids(args.query)
+    tmp_path = f"{args.output}.tmp"
+    with open(tmp_path, 'wb') as f:
+        count = write_archive(f, store, entry_ids, args.formats, args.workers,
+                              lambda done, total: print(f"\r{done}/{total}", end="", file=sys.stderr))
+    os.replace(tmp_path, args.output)
+    print(f"\nArchived {count} document(s) to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
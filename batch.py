@@ -0,0 +1,256 @@
+"""Generate BATNA documents for many negotiations without the Streamlit UI.
+
+Input is JSONL or CSV with one record per negotiation and the nine form
+fields as keys/columns (an optional "id" names the output files):
+
+    python batch.py negotiations.csv -o out/ --concurrency 4 --rpm 20
+
+Each record produces <id>.md plus the requested exports in the output
+directory; exports are rendered in a pool of --export-processes processes so
+the CPU-bound PDF and DOCX builds use every core. Progress is appended to out/manifest.jsonl; re-running the same
+command skips records that already finished, so an interrupted run resumes.
+"""
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import config
+from exporters import EXPORT_FORMATS, render_export
+from generation import INPUT_FIELDS, generate_document, generate_sections_parallel, response_cache_key
+from llm_client import client_from_config
+from response_cache import ResponseCache
+
+MANIFEST_NAME = "manifest.jsonl"
+# Largest CSV field accepted; csv's default of 128 KB is less than some pasted scopes and profiles
+CSV_FIELD_LIMIT = 16 * 1024 * 1024
+
+
+class RateLimiter:
+    """Spaces out calls so no more than per_minute start in any minute"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        time.sleep(max(slot - now, 0))
+
+
+def _parse_row(line):
+    try:
+        row = json.loads(line)
+    except ValueError as e:
+        return None, f"is not valid JSON: {e}"
+    if not isinstance(row, dict):
+        return None, "is not a JSON object"
+    return row, None
+
+
+def read_records(path):
+    """Yield (record_id, data, error) from a JSONL or CSV file.
+
+    A record that cannot be used has data None and says why in error, so it
+    is reported in the manifest without stopping the others. Ids are made
+    safe for file names; one that is then the same as an earlier record's
+    gets a -2, -3... suffix so their files do not overwrite each other.
+    """
+    if path.lower().endswith('.csv'):
+        csv.field_size_limit(max(csv.field_size_limit(), CSV_FIELD_LIMIT))
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = [(row, None) for row in csv.DictReader(f)]
+    else:
+        with open(path, encoding='utf-8') as f:
+            rows = [_parse_row(line) for line in f if line.strip()]
+
+    used = set()
+    for index, (row, error) in enumerate(rows, start=1):
+        record_id = safe_name(str((row or {}).get('id') or f"record-{index:04d}"))
+        unique_id, copy = record_id, 1
+        while unique_id in used:
+            copy += 1
+            unique_id = f"{record_id}-{copy}"
+        used.add(unique_id)
+
+        if error is None:
+            missing = [key for key in INPUT_FIELDS if not str(row.get(key) or '').strip()]
+            if missing:
+                error = f"is missing fields: {', '.join(missing)}"
+        if error is not None:
+            yield unique_id, None, f"Record {index} {error}"
+        else:
+            yield unique_id, {key: str(row[key]) for key in INPUT_FIELDS}, None
+
+
+def safe_name(value):
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', value).strip('._') or "record"
+
+
+def load_finished(manifest_path):
+    """Ids of records the manifest already marks as done"""
+    finished = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Partially written line from an interrupted run
+                if entry.get('status') == 'done':
+                    finished.add(entry['id'])
+    return finished
+
+
+def write_atomic(path, data):
+    # Write then rename so an interrupted run never leaves a truncated file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def process_record(record_id, data, args, client, cache, limiter, export_pool=None):
+    started = time.perf_counter()
+    entry = {
+        'id': record_id,
+        'subject': data['negotiation_subject'][:80],
+        'started_at': datetime.now().isoformat(timespec='seconds')
+    }
+    try:
+        cache_key = response_cache_key(data, args.parallel_sections)
+        document = cache.get(cache_key) if cache else None
+        if document:
+            entry['cached'] = True
+        else:
+            limiter.wait()
+            if args.parallel_sections:
+                document, stats = generate_sections_parallel(client, data, config.PARALLEL_MAX_WORKERS)
+            else:
+                document, stats = generate_document(client, data, max_workers=config.PARALLEL_MAX_WORKERS)
+            entry.update({
+                'cached': False,
+                'generation_seconds': round(stats['total_latency'], 3),
+                'input_tokens': stats['input_tokens'],
+                'output_tokens': stats['output_tokens'],
+                'stop_reason': stats['stop_reason']
+            })
+            if cache:
+                cache.put(cache_key, document)
+
+        files = [f"{record_id}.md"]
+        write_atomic(os.path.join(args.output, files[0]), document.encode('utf-8'))
+        export_started = time.perf_counter()
+        # All formats are submitted at once so they render on separate cores
+        renders = {fmt: export_pool.submit(render_export, document, fmt) for fmt in args.formats} if export_pool else {}
+        for fmt in args.formats:
+            name = f"{record_id}.{fmt}"
+            rendered = renders[fmt].result() if export_pool else render_export(document, fmt)
+            write_atomic(os.path.join(args.output, name), rendered)
+            files.append(name)
+        entry.update({
+            'status': 'done',
+            'files': files,
+            'export_seconds': round(time.perf_counter() - export_started, 3)
+        })
+    except Exception as e:
+        entry.update({'status': 'failed', 'error': f"{type(e).__name__}: {e}"})
+    entry['total_seconds'] = round(time.perf_counter() - started, 3)
+    return entry
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate BATNA documents in bulk")
+    parser.add_argument("input", help="JSONL or CSV file with one negotiation per record")
+    parser.add_argument("-o", "--output", required=True, help="directory for documents and manifest")
+    parser.add_argument("--concurrency", type=int, default=4, help="records generated at the same time")
+    parser.add_argument("--rpm", type=float, default=30, help="maximum generations started per minute (0 = unlimited)")
+    parser.add_argument("--formats", default="pdf,docx,txt", help="comma separated export formats")
+    parser.add_argument("--export-processes", type=int, default=os.cpu_count() or 1,
+                        help="processes rendering exports (0 = render in the generating threads)")
+    parser.add_argument("--parallel-sections", action="store_true", help="generate each document's sections concurrently")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the response cache")
+    parser.add_argument("--restart", action="store_true", help="regenerate records the manifest marks as done")
+    args = parser.parse_args(argv)
+    args.formats = [fmt.strip() for fmt in args.formats.split(',') if fmt.strip()]
+    unknown = [fmt for fmt in args.formats if fmt not in EXPORT_FORMATS]
+    if unknown:
+        parser.error(f"unknown export format(s): {', '.join(unknown)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        print("ANTHROPIC_API_KEY is not set", file=sys.stderr)
+        return 2
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest_path = os.path.join(args.output, MANIFEST_NAME)
+    finished = set() if args.restart else load_finished(manifest_path)
+    try:
+        records = [record for record in read_records(args.input) if record[0] not in finished]
+    except (OSError, ValueError, csv.Error) as e:
+        print(f"Cannot read {args.input}: {e}", file=sys.stderr)
+        return 2
+    invalid = [(record_id, error) for record_id, data, error in records if data is None]
+    records = [(record_id, data) for record_id, data, error in records if data is not None]
+    print(f"{len(records)} record(s) to generate, {len(finished)} already done"
+          + (f", {len(invalid)} invalid" if invalid else ""))
+
+    client = client_from_config(api_key)
+    cache = None
+    if config.RESPONSE_CACHE_ENABLED and not args.no_cache:
+        cache = ResponseCache(
+            os.path.join(config.DATA_DIR, "responses.sqlite3"),
+            config.RESPONSE_CACHE_TTL,
+            config.RESPONSE_CACHE_MAX_BYTES
+        )
+    limiter = RateLimiter(args.rpm)
+    export_pool = None
+    if args.export_processes > 0 and args.formats:
+        # spawn rather than fork: the parent already runs HTTP client threads
+        export_pool = ProcessPoolExecutor(max_workers=args.export_processes,
+                                          mp_context=multiprocessing.get_context("spawn"))
+
+    failures = 0
+    with open(manifest_path, 'a', encoding='utf-8') as manifest, \
+            ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as pool:
+        futures = [
+            pool.submit(process_record, record_id, data, args, client, cache, limiter, export_pool)
+            for record_id, data in records
+        ]
+        # Invalid records are reported like failed generations and retried on the next run
+        entries = [{'id': record_id, 'status': 'failed', 'error': error, 'total_seconds': 0.0}
+                   for record_id, error in invalid]
+        for entry in itertools.chain(entries, (future.result() for future in as_completed(futures))):
+            manifest.write(json.dumps(entry) + "\n")
+            manifest.flush()
+            if entry['status'] != 'done':
+                failures += 1
+            print(f"[{entry['status']}] {entry['id']} in {entry['total_seconds']:.1f}s"
+                  + (f" - {entry['error']}" if 'error' in entry else ""))
+
+    if export_pool is not None:
+        export_pool.shutdown()
+    client.close()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+"""Performance benchmarks that run against the local mock API instead of the real one.
+
+    python benchmark.py --pages 2,10,50,200 --output bench.json
+    python benchmark.py --baseline bench.json --tolerance 0.25
+
+Measures end-to-end generation through the pooled client, parsing and each
+exporter (time and peak memory, in memory and through the worker-process file
+path used for large documents), the rerun cost of the document view and
+cold start: importing the app and rendering its first page in a fresh
+interpreter.
+Results are written as JSON; with --baseline the run fails when any time or
+memory metric is worse than the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# Keep the benchmark's history and caches away from real data; set before config is imported
+os.environ.setdefault("BATNA_DATA_DIR", tempfile.mkdtemp(prefix="batna-bench-"))
+
+from export_cache import ExportFiles
+from exporters import parse_document, render_pdf, render_docx, render_text
+from generation import INPUT_FIELDS, build_prompt, create_response, stream_response, generate_sections_parallel
+from llm_client import PooledClient
+from mock_anthropic import MockAnthropicServer, document_for_pages
+
+RENDERERS = (('pdf', render_pdf), ('docx', render_docx), ('txt', render_text))
+
+# Modules the form page should not import; they load on first use or in the warm-up
+LAZY_MODULES = ('anthropic', 'docx', 'reportlab', 'llm_client')
+
+# Run in a fresh interpreter each time; streamlit is imported first, as the server has it loaded
+_IMPORT_PROBE = """
+import json, sys, time
+import streamlit
+start = time.perf_counter()
+import app
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'loaded': [m for m in sys.argv[1:] if m in sys.modules]}))
+"""
+
+_FIRST_PAGE_PROBE = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=300)
+start = time.perf_counter()
+at.run()
+seconds = time.perf_counter() - start
+if at.exception:
+    sys.exit(f"First page failed: {at.exception[0].value}")
+print(json.dumps({'seconds': seconds}))
+"""
+
+BENCH_DATA = {key: f"Benchmark {label.lower()}" for key, label in INPUT_FIELDS.items()}
+
+
+def median_time(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def peak_memory(fn):
+    """Peak Python heap allocated while fn runs, in bytes"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_generation(metrics, pages, args):
+    for page_count in pages:
+        server = MockAnthropicServer(
+            response_text=document_for_pages(page_count),
+            latency=args.latency,
+            tokens_per_second=args.tokens_per_second
+        ).start()
+        client = PooledClient("benchmark", base_url=server.base_url)
+        try:
+            prompt = build_prompt(BENCH_DATA)
+            streamed = []
+            metrics[f"generation.stream.seconds[pages={page_count}]"] = median_time(
+                lambda: streamed.append(stream_response(client, prompt)[1]), args.repeat
+            )
+            metrics[f"generation.stream.ttft_seconds[pages={page_count}]"] = statistics.median(
+                stats['time_to_first_token'] for stats in streamed
+            )
+            metrics[f"generation.blocking.seconds[pages={page_count}]"] = median_time(
+                lambda: create_response(client, prompt), args.repeat
+            )
+        finally:
+            client.close()
+            server.stop()
+
+    # Parallel sections only depend on per-section length, so measure them once
+    server = MockAnthropicServer(latency=args.latency, tokens_per_second=args.tokens_per_second).start()
+    client = PooledClient("benchmark", base_url=server.base_url)
+    try:
+        metrics["generation.parallel.seconds"] = median_time(
+            lambda: generate_sections_parallel(client, BENCH_DATA), args.repeat
+        )
+        metrics["client.connection_reuse_ratio"] = client.metrics.snapshot()['connection_reuse_ratio']
+    finally:
+        client.close()
+        server.stop()
+
+
+def bench_exports(metrics, pages, args):
+    for page_count in pages:
+        content = document_for_pages(page_count)
+        metrics[f"document.chars[pages={page_count}]"] = len(content)
+
+        def parse():
+            parse_document.cache_clear()
+            return parse_document(content)
+
+        metrics[f"parse.seconds[pages={page_count}]"] = median_time(parse, args.repeat)
+        blocks = parse()
+        for fmt, render in RENDERERS:
+            metrics[f"export.{fmt}.seconds[pages={page_count}]"] = median_time(lambda: render(blocks), args.repeat)
+            metrics[f"export.{fmt}.peak_bytes[pages={page_count}]"] = peak_memory(lambda: render(blocks))
+            metrics[f"export.{fmt}.size_bytes[pages={page_count}]"] = len(render(blocks))
+
+        # The large-document path: a worker process renders to a file. Peak memory is this
+        # process's, which should not grow with the document; a new directory keeps every run cold
+        for fmt, _ in RENDERERS:
+            def render_file():
+                with tempfile.TemporaryDirectory(prefix="batna-bench-files-") as directory:
+                    ExportFiles(directory, workers=1).render_async(content, fmt).result()
+
+            metrics[f"export.{fmt}.file_seconds[pages={page_count}]"] = median_time(render_file, args.repeat)
+            metrics[f"export.{fmt}.file_peak_bytes[pages={page_count}]"] = peak_memory(render_file)
+
+
+def bench_rerun(metrics, pages, args):
+    """Time full script runs of the document view, cold and with warm caches"""
+    from streamlit.testing.v1 import AppTest
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    for page_count in pages:
+        # A distinct document per size so the first run really is cold
+        content = document_for_pages(page_count) + f"\n\nBenchmark run {time.time()}"
+        at = AppTest.from_file(app_path, default_timeout=300)
+        at.session_state['final_document'] = content
+        at.session_state['collected_data'] = dict(BENCH_DATA)
+        at.session_state['show_document'] = True
+
+        start = time.perf_counter()
+        at.run()
+        metrics[f"rerun.cold_seconds[pages={page_count}]"] = time.perf_counter() - start
+        if at.exception:
+            raise RuntimeError(f"Document view failed: {at.exception[0].value}")
+        metrics[f"rerun.warm_seconds[pages={page_count}]"] = median_time(at.run, args.repeat)
+
+
+def _probe(code, *args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    # No warm-up thread: it would compete with the run being measured
+    env = dict(os.environ, BATNA_WARMUP="0")
+    result = subprocess.run([sys.executable, "-c", code, *args], cwd=here, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def bench_startup(metrics, pages, args):
+    """Cold start: importing the app and the first run of the form page, each in a new interpreter"""
+    imports = [_probe(_IMPORT_PROBE, *LAZY_MODULES) for _ in range(args.repeat)]
+    metrics["startup.import_seconds"] = statistics.median(probe['seconds'] for probe in imports)
+    # Should stay 0; anything listed here is back on the cold-start path
+    metrics["startup.lazy_modules_loaded"] = len(imports[0]['loaded'])
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    metrics["startup.first_page_seconds"] = statistics.median(
+        _probe(_FIRST_PAGE_PROBE, app_path)['seconds'] for _ in range(args.repeat)
+    )
+
+
+def compare(metrics, baseline, tolerance):
+    """Names of time/memory metrics that regressed by more than tolerance"""
+    regressions = []
+    for name, value in metrics.items():
+        old = baseline.get(name)
+        if old is None or not ('seconds' in name or 'bytes' in name) or 'size_bytes' in name:
+            continue
+        if old > 0 and value > old * (1 + tolerance):
+            regressions.append(f"{name}: {old:.4g} -> {value:.4g} (+{(value / old - 1) * 100:.0f}%)")
+    if metrics.get("startup.lazy_modules_loaded"):
+        regressions.append(f"startup.lazy_modules_loaded: {metrics['startup.lazy_modules_loaded']:g} of "
+                           f"{', '.join(LAZY_MODULES)} imported at startup")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark generation, exports and reruns against a mock API")
+    parser.add_argument("--pages", default="2,10,50,200", help="comma separated document sizes in pages")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement; the median is reported")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock API delay before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="mock API output pacing")
+    parser.add_argument("--skip", default="", help="comma separated groups to skip: generation,exports,rerun,startup")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    pages = [int(p) for p in args.pages.split(',') if p.strip()]
+    skip = {group.strip() for group in args.skip.split(',') if group.strip()}
+
+    metrics = {}
+    groups = (('generation', bench_generation), ('exports', bench_exports), ('rerun', bench_rerun),
+              ('startup', bench_startup))
+    for name, bench in groups:
+        if name in skip:
+            continue
+        start = time.perf_counter()
+        bench(metrics, pages, args)
+        print(f"{name}: {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pages': pages,
+            'repeat': args.repeat,
+            'latency': args.latency,
+            'tokens_per_second': args.tokens_per_second
+        },
+        'metrics': metrics
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(metrics, json.load(f)['metrics'], args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
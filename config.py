@@ -0,0 +1,125 @@
+import os
+from dotenv import load_dotenv
+
+# Settings come from the environment (or a .env file next to the app)
+load_dotenv()
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+# Directory for persistent caches and stores
+DATA_DIR = os.environ.get(
+    "BATNA_DATA_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".batna_data")
+)
+
+# Rendered export files kept in memory per process
+EXPORT_CACHE_MAX_ENTRIES = _env_int("BATNA_EXPORT_CACHE_MAX_ENTRIES", 64)
+EXPORT_CACHE_MAX_BYTES = _env_int("BATNA_EXPORT_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+# Threads rendering exports in the background as soon as a document is finished
+EXPORT_WORKERS = _env_int("BATNA_EXPORT_WORKERS", 2)
+# Documents of at least this many characters (about 30 pages) are rendered by worker processes
+# to files under .batna_data/exports instead, kept up to BATNA_EXPORT_FILES_MAX_BYTES on disk
+LARGE_DOCUMENT_CHARS = _env_int("BATNA_LARGE_DOCUMENT_CHARS", 100000)
+EXPORT_FILES_MAX_BYTES = _env_int("BATNA_EXPORT_FILES_MAX_BYTES", 512 * 1024 * 1024)
+
+# Documents and inputs open in sessions: compressed bytes kept in memory before the least
+# recently used spill to disk, and how long a silent session keeps its references
+DOCUMENT_STORE_MAX_BYTES = _env_int("BATNA_DOCUMENT_STORE_MAX_BYTES", 32 * 1024 * 1024)
+DOCUMENT_STORE_HOLDER_TTL = _env_float("BATNA_DOCUMENT_STORE_HOLDER_TTL", 12 * 3600)
+
+# Model responses cached on disk for identical inputs
+RESPONSE_CACHE_ENABLED = os.environ.get("BATNA_RESPONSE_CACHE", "1") != "0"
+RESPONSE_CACHE_TTL = _env_float("BATNA_RESPONSE_CACHE_TTL", 30 * 24 * 3600)
+RESPONSE_CACHE_MAX_BYTES = _env_int("BATNA_RESPONSE_CACHE_MAX_BYTES", 50 * 1024 * 1024)
+
+# Anthropic API client; point ANTHROPIC_BASE_URL at a local stub for testing
+ANTHROPIC_BASE_URL = os.environ.get("ANTHROPIC_BASE_URL") or None
+API_TIMEOUT = _env_float("BATNA_API_TIMEOUT", 120.0)
+API_CONNECT_TIMEOUT = _env_float("BATNA_API_CONNECT_TIMEOUT", 10.0)
+API_MAX_CONNECTIONS = _env_int("BATNA_API_MAX_CONNECTIONS", 20)
+API_MAX_RETRIES = _env_int("BATNA_API_MAX_RETRIES", 4)
+API_BACKOFF_BASE = _env_float("BATNA_API_BACKOFF_BASE", 1.0)
+API_BACKOFF_MAX = _env_float("BATNA_API_BACKOFF_MAX", 30.0)
+# Longest a request keeps retrying. A retry-after from the API is honoured in full when it
+# fits in what is left; when it does not, the request fails at once instead of waiting
+API_RETRY_DEADLINE = _env_float("BATNA_API_RETRY_DEADLINE", 120.0)
+
+# Process-wide admission control shared by every session (0 = no limit). Set the rates a
+# little under the organisation's limits; requests over them wait in a fair queue, and give
+# up with a "busy" message after BATNA_API_MAX_QUEUE_WAIT seconds
+API_REQUESTS_PER_MINUTE = _env_int("BATNA_API_REQUESTS_PER_MINUTE", 50)
+API_TOKENS_PER_MINUTE = _env_int("BATNA_API_TOKENS_PER_MINUTE", 0)
+API_MAX_CONCURRENCY = _env_int("BATNA_API_MAX_CONCURRENCY", 8)
+API_MAX_QUEUE_WAIT = _env_float("BATNA_API_MAX_QUEUE_WAIT", 300.0)
+
+# Model routing. BATNA_MODEL_TIER is the form's default: "quality" (BATNA_QUALITY_MODEL),
+# "draft" (BATNA_DRAFT_MODEL), "refine" (a draft shown at once, then revised by the quality
+# model) or "auto" (draft when the inputs are at most BATNA_AUTO_DRAFT_MAX_INPUT_TOKENS)
+QUALITY_MODEL = os.environ.get("BATNA_QUALITY_MODEL", "claude-3-opus-20240229")
+DRAFT_MODEL = os.environ.get("BATNA_DRAFT_MODEL", "claude-3-haiku-20240307")
+MODEL_TIER = os.environ.get("BATNA_MODEL_TIER", "quality")
+AUTO_DRAFT_MAX_INPUT_TOKENS = _env_int("BATNA_AUTO_DRAFT_MAX_INPUT_TOKENS", 600)
+
+# Prompt size control. Fields are deduplicated and, when the estimated prompt exceeds
+# BATNA_PROMPT_TOKEN_BUDGET, the longest ones are cut ("truncate") or condensed by a small
+# model ("summarize"); "off" sends inputs verbatim. max_tokens is sized from what is left
+# of BATNA_REQUEST_TOKEN_BUDGET (prompt plus output, 0 = only the context window).
+INPUT_BUDGET_POLICY = os.environ.get("BATNA_INPUT_BUDGET_POLICY", "truncate")
+PROMPT_TOKEN_BUDGET = _env_int("BATNA_PROMPT_TOKEN_BUDGET", 12000)
+FIELD_TOKEN_CAP = _env_int("BATNA_FIELD_TOKEN_CAP", 3000)
+REQUEST_TOKEN_BUDGET = _env_int("BATNA_REQUEST_TOKEN_BUDGET", 16000)
+
+# Mark the inputs shared by a document's section requests and continuations for the API's prompt cache
+PROMPT_CACHING = os.environ.get("BATNA_PROMPT_CACHING", "1") != "0"
+
+# Generate sections as concurrent requests instead of one long call
+PARALLEL_SECTIONS = os.environ.get("BATNA_PARALLEL_SECTIONS", "0") == "1"
+PARALLEL_MAX_WORKERS = _env_int("BATNA_PARALLEL_MAX_WORKERS", 4)
+
+# Documents per page in the sidebar history
+HISTORY_PAGE_SIZE = _env_int("BATNA_HISTORY_PAGE_SIZE", 10)
+# "browser": each browser sees and clears only its own history, identified by a random id in
+# the page URL; "shared": everyone sees the whole history, including entries from before owners
+HISTORY_SCOPE = os.environ.get("BATNA_HISTORY_SCOPE", "browser")
+
+# Offer similar past analyses (cosine similarity of the inputs, 0-1) before generating
+SIMILAR_SUGGESTIONS = os.environ.get("BATNA_SIMILAR_SUGGESTIONS", "1") != "0"
+SIMILAR_MIN_SCORE = _env_float("BATNA_SIMILAR_MIN_SCORE", 0.6)
+SIMILAR_MAX_RESULTS = _env_int("BATNA_SIMILAR_MAX_RESULTS", 3)
+
+# History archives: rendering processes (0 = one per core) and how long built ZIPs are kept
+ARCHIVE_WORKERS = _env_int("BATNA_ARCHIVE_WORKERS", 0)
+ARCHIVE_RETENTION = _env_float("BATNA_ARCHIVE_RETENTION", 3600)
+
+# Scenario comparison: variants one comparison may have and how many generate at the same time
+SCENARIO_MAX_VARIANTS = _env_int("BATNA_SCENARIO_MAX_VARIANTS", 4)
+SCENARIO_MAX_CONCURRENCY = _env_int("BATNA_SCENARIO_MAX_CONCURRENCY", 4)
+
+# Background generation jobs; with BATNA_BACKGROUND_JOBS=0 the form generates inline
+BACKGROUND_JOBS = os.environ.get("BATNA_BACKGROUND_JOBS", "1") != "0"
+JOB_WORKERS = _env_int("BATNA_JOB_WORKERS", 4)
+JOB_RETENTION = _env_float("BATNA_JOB_RETENTION", 3600)
+JOB_POLL_INTERVAL = _env_float("BATNA_JOB_POLL_INTERVAL", 1.0)
+
+# HTTP API (python http_api.py): address, requests handled at once (more get a 503 with
+# Retry-After) and how long an idle keep-alive connection stays open
+SERVICE_HOST = os.environ.get("BATNA_SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = _env_int("BATNA_SERVICE_PORT", 8766)
+SERVICE_MAX_REQUESTS = _env_int("BATNA_SERVICE_MAX_REQUESTS", 64)
+SERVICE_KEEP_ALIVE = _env_float("BATNA_SERVICE_KEEP_ALIVE", 75.0)
+
+# Import the export libraries and the API SDK in the background after the first page is served
+WARMUP = os.environ.get("BATNA_WARMUP", "1") != "0"
+
+# Timing and token metrics: JSON log lines, a Prometheus text file and an optional /metrics port
+METRICS_LOG_FILE = os.environ.get("BATNA_METRICS_LOG_FILE") or None
+METRICS_PROMETHEUS_FILE = os.environ.get("BATNA_METRICS_PROMETHEUS_FILE", os.path.join(DATA_DIR, "metrics.prom"))
+METRICS_PORT = _env_int("BATNA_METRICS_PORT", 0)
+ADMIN_PANEL = os.environ.get("BATNA_ADMIN_PANEL", "0") == "1"
@@ -0,0 +1,171 @@
+"""Process-wide, content-addressed store for the texts sessions are looking at.
+
+Sessions keep only the SHA-256 of their document and inputs; the bodies live
+here once, zlib-compressed, however many sessions hold them. Each
+(holder, slot) pair - a session and a name such as "final_document" - holds
+one reference. Bodies nobody references are dropped first when the store is
+over its memory budget; referenced ones are then spilled to disk and read
+back on the next access.
+"""
+import hashlib
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class DocumentStore:
+    """Ref-counted, compressed text blobs bounded by max_bytes of compressed data in memory"""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, spill_dir=None, holder_ttl=24 * 3600):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.holder_ttl = holder_ttl
+        self._lock = threading.Lock()
+        # digest -> compressed body, least recently used first; spilled bodies are not in here
+        self._blobs = OrderedDict()
+        self._raw_sizes = {}
+        self._refs = {}
+        self._spilled = set()
+        # holder -> {slot: digest}, and when each holder was last seen
+        self._holders = {}
+        self._seen = {}
+        self._bytes = 0
+        self._stats = {'puts': 0, 'dedup_hits': 0, 'evictions': 0, 'spills': 0, 'disk_reads': 0}
+
+    def assign(self, holder, slot, text):
+        """Point holder's slot at text (None clears it) and return the digest held"""
+        digest = None
+        with self._lock:
+            if text is not None:
+                digest = self._put(text)
+                self._refs[digest] = self._refs.get(digest, 0) + 1
+            slots = self._holders.setdefault(holder, {})
+            old = slots.pop(slot, None)
+            if digest is not None:
+                slots[slot] = digest
+            if old is not None:
+                self._release(old)
+            self._seen[holder] = time.time()
+            self._enforce_budget()
+        return digest
+
+    def get(self, digest):
+        """Text for digest, or None if it is no longer stored"""
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is not None:
+                self._blobs.move_to_end(digest)
+            elif digest in self._spilled:
+                blob = self._read_spilled(digest)
+        return zlib.decompress(blob).decode('utf-8') if blob is not None else None
+
+    def touch(self, holder):
+        """Mark holder as alive; holders not seen for holder_ttl are released by sweep()"""
+        with self._lock:
+            if holder in self._holders:
+                self._seen[holder] = time.time()
+
+    def release_holder(self, holder):
+        with self._lock:
+            for digest in self._holders.pop(holder, {}).values():
+                self._release(digest)
+            self._seen.pop(holder, None)
+
+    def sweep(self):
+        """Release every holder idle for longer than holder_ttl, e.g. closed browser sessions"""
+        cutoff = time.time() - self.holder_ttl
+        with self._lock:
+            idle = [holder for holder, seen in self._seen.items() if seen < cutoff]
+        for holder in idle:
+            self.release_holder(holder)
+        return len(idle)
+
+    def _put(self, text):
+        self._stats['puts'] += 1
+        digest = content_hash(text)
+        if digest in self._blobs or digest in self._spilled:
+            self._stats['dedup_hits'] += 1
+            if digest in self._blobs:
+                self._blobs.move_to_end(digest)
+            return digest
+        blob = zlib.compress(text.encode('utf-8'), 6)
+        self._blobs[digest] = blob
+        self._raw_sizes[digest] = len(text.encode('utf-8'))
+        self._bytes += len(blob)
+        return digest
+
+    def _release(self, digest):
+        self._refs[digest] -= 1
+        if self._refs[digest] <= 0:
+            del self._refs[digest]
+            if digest in self._spilled:
+                # Nobody needs it any more, and it is not worth keeping on disk
+                self._spilled.discard(digest)
+                self._raw_sizes.pop(digest, None)
+                self._remove_spilled(digest)
+
+    def _enforce_budget(self):
+        # Unreferenced bodies go first, then referenced ones move to disk, least recently used first
+        for digest in [d for d in self._blobs if d not in self._refs]:
+            if self._bytes <= self.max_bytes:
+                return
+            self._drop(digest)
+            self._stats['evictions'] += 1
+        for digest in list(self._blobs):
+            if self._bytes <= self.max_bytes or not self.spill_dir:
+                return
+            self._spill(digest)
+
+    def _drop(self, digest):
+        self._bytes -= len(self._blobs.pop(digest))
+        self._raw_sizes.pop(digest, None)
+
+    def _spill_path(self, digest):
+        return os.path.join(self.spill_dir, f"{digest}.z")
+
+    def _spill(self, digest):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = self._spill_path(digest)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self._blobs[digest])
+        os.replace(tmp_path, path)
+        self._bytes -= len(self._blobs.pop(digest))
+        self._spilled.add(digest)
+        self._stats['spills'] += 1
+
+    def _read_spilled(self, digest):
+        try:
+            with open(self._spill_path(digest), 'rb') as f:
+                self._stats['disk_reads'] += 1
+                return f.read()
+        except OSError:
+            return None
+
+    def _remove_spilled(self, digest):
+        try:
+            os.remove(self._spill_path(digest))
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            raw = sum(self._raw_sizes.get(digest, 0) for digest in self._blobs)
+            # What the sessions would hold if every reference were its own uncompressed copy
+            referenced = sum(self._raw_sizes.get(digest, 0) * count for digest, count in self._refs.items())
+            return {
+                'entries': len(self._blobs),
+                'spilled': len(self._spilled),
+                'references': sum(self._refs.values()),
+                'holders': len(self._holders),
+                'compressed_bytes': self._bytes,
+                'raw_bytes': raw,
+                'referenced_raw_bytes': referenced,
+                **self._stats
+            }
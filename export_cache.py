@@ -0,0 +1,341 @@
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from exporters import render_export_file
+
+# Bump whenever the output of an exporter changes so stale files are not served
+RENDERER_VERSION = "3"
+
+DEFAULT_MAX_ENTRIES = 64
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_WORKERS = 2
+DEFAULT_FILES_MAX_BYTES = 512 * 1024 * 1024
+# Seconds a failed render is reported as failed instead of being started again
+FAILURE_TTL = 60.0
+# Partial export files older than this are left over from a worker that died
+STALE_PARTIAL_AGE = 3600.0
+
+# A worker process per file, so the renderer's memory goes back to the system; before
+# Python 3.11 a worker stays until the pool is shut down once no render is pending
+_SINGLE_USE_WORKERS = {'max_tasks_per_child': 1} if sys.version_info >= (3, 11) else {}
+# Characters of a document written to its worker's input file at a time
+SOURCE_CHUNK = 64 * 1024
+
+
+def export_settings(fmt):
+    """Renderer settings that are part of an export's cache key; the app and the HTTP API share them"""
+    if fmt == "pdf":
+        return {'pagesize': 'letter', 'margin': 72}
+    return {'date': datetime.now().strftime("%Y-%m-%d")}
+
+
+def make_export_key(content, fmt, settings=None):
+    """Build a cache key from the document text, export format and renderer settings"""
+    digest = hashlib.sha256()
+    # In slices, so hashing a long document does not copy it
+    for offset in range(0, len(content), SOURCE_CHUNK):
+        digest.update(content[offset:offset + SOURCE_CHUNK].encode('utf-8'))
+    digest = digest.hexdigest()
+    settings_part = ",".join(f"{k}={v}" for k, v in sorted((settings or {}).items()))
+    return f"{RENDERER_VERSION}:{fmt}:{settings_part}:{digest}"
+
+
+def _recent_failure(failures, key, ttl):
+    """The failed future recorded for key if it is younger than ttl; older records are dropped.
+
+    Call with the owner's lock held.
+    """
+    now = time.monotonic()
+    for stale in [k for k, (failed_at, _) in failures.items() if now - failed_at >= ttl]:
+        del failures[stale]
+    record = failures.get(key)
+    return record[1] if record else None
+
+
+class ExportCache:
+    """Thread-safe LRU cache of rendered export files, bounded by entry count and total size.
+
+    render_async() builds files on a small worker pool so a page can show
+    the document while its exports are still being rendered.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, workers=DEFAULT_WORKERS,
+                 failure_ttl=FAILURE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.failure_ttl = failure_ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        # key -> (time, failed future) of recent background renders that raised
+        self._failures = {}
+        self._pool = None
+        self.hits = 0
+        self.misses = 0
+        self.background_renders = 0
+        self.failed_renders = 0
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        # Files larger than the whole budget are served but never stored
+        if data is None or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._failures.pop(key, None)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def get_or_render(self, content, fmt, render, settings=None):
+        """Return the cached export for content, calling render() only on a miss"""
+        key = make_export_key(content, fmt, settings)
+        data = self.get(key)
+        with self._lock:
+            pending = self._pending.get(key)
+        if data is None and pending is not None:
+            # Already being rendered in the background; a failure there is retried here
+            try:
+                data = pending.result()
+            except Exception:
+                data = None
+        if data is None:
+            # Render outside the lock so one slow build does not block other sessions
+            data = render()
+            self.put(key, data)
+        return data
+
+    def render_async(self, content, fmt, render, settings=None):
+        """Future for the export of content: already done on a hit, else render() runs on the pool.
+
+        Concurrent calls for the same file share one render. A render that
+        failed in the last failure_ttl seconds is not started again; its
+        failed future is returned instead.
+        """
+        key = make_export_key(content, fmt, settings)
+        with self._lock:
+            future = self._pending.get(key) or _recent_failure(self._failures, key, self.failure_ttl)
+        if future is not None:
+            return future
+        data = self.get(key)
+        if data is not None:
+            future = Future()
+            future.set_result(data)
+            return future
+        with self._lock:
+            future = self._pending.get(key) or _recent_failure(self._failures, key, self.failure_ttl)
+            if future is not None:
+                return future
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batna-export")
+            future = self._pool.submit(render)
+            self._pending[key] = future
+            self.background_renders += 1
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def _finish(self, key, future):
+        if future.exception() is None:
+            self.put(key, future.result())
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.exception() is not None:
+                self._failures[key] = (time.monotonic(), future)
+                self.failed_renders += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._failures.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'pending': len(self._pending),
+                'background_renders': self.background_renders,
+                'failed_renders': self.failed_renders
+            }
+
+
+def _render_source(source_path, fmt, path):
+    """Worker process: render the document text in source_path to path, then remove the source"""
+    try:
+        with open(source_path, encoding='utf-8') as f:
+            content = f.read()
+    finally:
+        os.remove(source_path)
+    return render_export_file(content, fmt, path)
+
+
+class ExportFiles:
+    """Exports of large documents kept as files on disk, each rendered in a short-lived worker process.
+
+    reportlab and python-docx hold the whole document model in memory, many
+    times the size of the file they write. A worker process that exits after
+    each file hands that memory back to the system at once, and the server
+    only ever holds a path; downloads are read from disk in chunks.
+
+    The directory may be shared by several server processes. Its contents are
+    the index: a file's modification time is its last use, and the files are
+    kept up to max_bytes in total over every process, least recently used
+    removed first.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_FILES_MAX_BYTES, workers=DEFAULT_WORKERS,
+                 failure_ttl=FAILURE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.failure_ttl = failure_ttl
+        self._lock = threading.Lock()
+        self._pending = {}
+        # file name -> (time, failed future) of recent renders that raised
+        self._failures = {}
+        self._pool = None
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.failed_renders = 0
+        os.makedirs(directory, exist_ok=True)
+        self._remove_stale_partials()
+
+    def _remove_stale_partials(self):
+        # Partial files of a worker that died. Recent ones may belong to a render still
+        # running in another process sharing the directory, so only old ones go
+        cutoff = time.time() - STALE_PARTIAL_AGE
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith('.tmp') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _usage(self):
+        """[(modification time, name, size)] of the finished files, least recently used first"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                info = entry.stat()
+            except OSError:
+                # Removed by another process meanwhile
+                continue
+            files.append((info.st_mtime, entry.name, info.st_size))
+        return sorted(files)
+
+    def path_for(self, content, fmt, settings=None):
+        key = make_export_key(content, fmt, settings)
+        return os.path.join(self.directory, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()[:40]}.{fmt}")
+
+    def render_async(self, content, fmt, settings=None):
+        """Future for the path of content's export: done at once if the file exists, else rendered by a worker.
+
+        Concurrent calls for the same file share one render. A render that
+        failed in the last failure_ttl seconds is not started again; its
+        failed future is returned instead.
+        """
+        path = self.path_for(content, fmt, settings)
+        name = os.path.basename(path)
+        with self._lock:
+            future = self._pending.get(name) or _recent_failure(self._failures, name, self.failure_ttl)
+            if future is not None:
+                return future
+            future = Future()
+            try:
+                # Marks it as recently used for every process sharing the directory
+                os.utime(path)
+                self.hits += 1
+                future.set_result(path)
+                return future
+            except FileNotFoundError:
+                pass
+            self.misses += 1
+            if self._pool is None:
+                # spawn rather than fork: the server has other threads running
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"),
+                                                 **_SINGLE_USE_WORKERS)
+            # The text goes to the worker through a file written in slices, not pickled in one piece
+            source_path = f"{path}.{os.getpid()}.{self.renders}.src.tmp"
+            with open(source_path, 'w', encoding='utf-8') as f:
+                for offset in range(0, len(content), SOURCE_CHUNK):
+                    f.write(content[offset:offset + SOURCE_CHUNK])
+            worker = self._pool.submit(_render_source, source_path, fmt, path)
+            self._pending[name] = future
+            self.renders += 1
+        worker.add_done_callback(lambda done: self._finish(name, path, done, future))
+        return future
+
+    def _finish(self, name, path, worker, future):
+        error = worker.exception()
+        with self._lock:
+            self._pending.pop(name, None)
+            if error is None:
+                self._evict(keep=name)
+            else:
+                self._failures[name] = (time.monotonic(), future)
+                self.failed_renders += 1
+            if not self._pending:
+                # No idle worker is left waiting, holding memory, until the next large export
+                self._pool.shutdown(wait=False)
+                self._pool = None
+        if error is None:
+            future.set_result(path)
+        else:
+            future.set_exception(error)
+
+    def _evict(self, keep):
+        files = self._usage()
+        size = sum(file_size for _, _, file_size in files)
+        for _, name, file_size in files:
+            if size <= self.max_bytes:
+                return
+            if name == keep:
+                continue
+            try:
+                # A download already reading it keeps its open handle
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            size -= file_size
+
+    def stats(self):
+        files = self._usage()
+        with self._lock:
+            return {
+                'files': len(files),
+                'bytes': sum(file_size for _, _, file_size in files),
+                'hits': self.hits,
+                'misses': self.misses,
+                'pending': len(self._pending),
+                'renders': self.renders,
+                'failed_renders': self.failed_renders
+            }
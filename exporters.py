@@ -0,0 +1,384 @@
+import io
+import os
+import re
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+import metrics
+
+# reportlab and python-docx are imported by the backends on first use, so pages
+# that never export do not pay for them; load_backends() imports them ahead of time
+
+# One parsed element of a BATNA document: kind is heading, paragraph, table or divider
+Block = namedtuple('Block', ['kind', 'text', 'level', 'rows'])
+
+DOCUMENT_TITLE = "BATNA Analysis Document"
+
+_BR_RE = re.compile(r'<br\s*/?>', re.IGNORECASE)
+_BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+_DIVIDER_RE = re.compile(r'^(?:-{3,}|\*{3,}|_{3,})$')
+_TABLE_SEPARATOR_RE = re.compile(r'^\|?\s*:?-{2,}:?\s*(?:\|\s*:?-{2,}:?\s*)*\|?$')
+_MD_HEADING_RE = re.compile(r'^(#{1,6})\s+(.*)$')
+_SECTION_RE = re.compile(r'^[1-8]\.\s+(\S.*)$')
+# Words a title-case heading may keep in lowercase
+_MINOR_WORDS = {'a', 'an', 'and', 'as', 'at', 'by', 'for', 'in', 'of', 'on', 'or', 'the', 'to', 'vs', 'with'}
+_LIST_ITEM_RE = re.compile(r'^(?:[-*•]\s+|\d+[.)]\s+)')
+
+
+def _clean_line(line):
+    line = line.strip()
+    if line.startswith('>'):
+        line = line.lstrip('>').strip()
+    return _BR_RE.sub('\n', line)
+
+
+def _heading(line):
+    """Return (level, text) if line is a heading, otherwise None"""
+    match = _MD_HEADING_RE.match(line)
+    if match:
+        return len(match.group(1)), match.group(2).strip('*# ').strip()
+    plain = line.strip('*').strip()
+    # Numbered section titles such as "1. EXECUTIVE SUMMARY" or "1. Executive Summary";
+    # a sentence, like most numbered list items, is not one
+    match = _SECTION_RE.match(plain)
+    if match and _is_title(match.group(1)):
+        return 1, plain
+    return None
+
+
+def _is_title(text):
+    words = text.split()
+    if len(words) > 10 or text[-1] in '.,:;!?':
+        return False
+    return all(not word[0].isalpha() or word[0].isupper() or word.lower() in _MINOR_WORDS for word in words)
+
+
+def _table_row(line):
+    return tuple(cell.strip().replace('\n', ' ') for cell in line.strip().strip('|').split('|'))
+
+
+@lru_cache(maxsize=32)
+def parse_document(content):
+    """Parse model output once into a tuple of Blocks shared by every exporter"""
+    blocks = []
+    paragraph = []
+    table = []
+
+    def flush_paragraph():
+        if paragraph:
+            blocks.append(Block('paragraph', " ".join(paragraph), 0, ()))
+            paragraph.clear()
+
+    def flush_table():
+        if table:
+            width = max(len(row) for row in table)
+            rows = tuple(row + ('',) * (width - len(row)) for row in table)
+            blocks.append(Block('table', '', 0, rows))
+            table.clear()
+
+    for raw in content.split('\n'):
+        line = _clean_line(raw)
+
+        if line.startswith('|'):
+            flush_paragraph()
+            if not _TABLE_SEPARATOR_RE.match(line):
+                table.append(_table_row(line))
+            continue
+        flush_table()
+
+        if not line:
+            flush_paragraph()
+            continue
+
+        if _DIVIDER_RE.match(line):
+            flush_paragraph()
+            blocks.append(Block('divider', '', 0, ()))
+            continue
+
+        heading = _heading(line)
+        if heading:
+            flush_paragraph()
+            blocks.append(Block('heading', heading[1], heading[0], ()))
+            continue
+
+        # List items keep their own paragraph instead of being run together
+        if _LIST_ITEM_RE.match(line):
+            flush_paragraph()
+        paragraph.append(line)
+
+    flush_paragraph()
+    flush_table()
+    return tuple(blocks)
+
+
+def _strip_bold(text):
+    return _BOLD_RE.sub(r'\1', text)
+
+
+# PDF backend
+def _pdf_markup(text):
+    return _BOLD_RE.sub(r'<b>\1</b>', escape(text)).replace('\n', '<br/>')
+
+
+def _pdf_styles():
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Title'],
+        fontSize=24,
+        spaceAfter=30
+    ))
+    styles.add(ParagraphStyle(
+        'CustomHeading',
+        parent=styles['Heading1'],
+        fontSize=14,
+        spaceAfter=16
+    ))
+    styles.add(ParagraphStyle(
+        'CustomSubheading',
+        parent=styles['Heading2'],
+        fontSize=12,
+        spaceAfter=10
+    ))
+    styles.add(ParagraphStyle(
+        'CustomBody',
+        parent=styles['Normal'],
+        fontSize=10,
+        spaceAfter=12
+    ))
+    styles.add(ParagraphStyle(
+        'CustomCell',
+        parent=styles['Normal'],
+        fontSize=9,
+        leading=11
+    ))
+    return styles
+
+
+def _pdf_table(rows, styles, width):
+    from reportlab.lib import colors
+    from reportlab.platypus import Paragraph, Table, TableStyle
+
+    data = [[Paragraph(_pdf_markup(cell), styles['CustomCell']) for cell in row] for row in rows]
+    # splitInRow lets a cell taller than a page continue on the next one
+    table = Table(data, colWidths=[width / len(rows[0])] * len(rows[0]), repeatRows=1, splitInRow=1)
+    table.setStyle(TableStyle([
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#D4E6F1')),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ]))
+    return table
+
+
+def _pdf_story(blocks, styles, width, flat_tables=False):
+    from reportlab.lib import colors
+    from reportlab.platypus import Paragraph, Spacer, HRFlowable
+
+    story = [Paragraph(DOCUMENT_TITLE, styles['CustomTitle']), Spacer(1, 12)]
+    for block in blocks:
+        if block.kind == 'heading':
+            style = styles['CustomHeading'] if block.level <= 2 else styles['CustomSubheading']
+            story.append(Paragraph(_pdf_markup(block.text), style))
+        elif block.kind == 'paragraph':
+            story.append(Paragraph(_pdf_markup(block.text), styles['CustomBody']))
+            story.append(Spacer(1, 8))
+        elif block.kind == 'table' and flat_tables:
+            # One paragraph per row, cells separated by dashes
+            for row in block.rows:
+                story.append(Paragraph(_pdf_markup(" - ".join(cell for cell in row if cell)), styles['CustomBody']))
+            story.append(Spacer(1, 12))
+        elif block.kind == 'table':
+            story.append(_pdf_table(block.rows, styles, width))
+            story.append(Spacer(1, 12))
+        elif block.kind == 'divider':
+            story.append(HRFlowable(width="100%", thickness=0.5, color=colors.grey, spaceBefore=4, spaceAfter=12))
+    return story
+
+
+def render_pdf(blocks, out=None):
+    """Render parsed blocks to PDF, written to the binary file out or else returned as bytes"""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate
+    from reportlab.platypus.doctemplate import LayoutError
+
+    buffer = io.BytesIO() if out is None else out
+    start = buffer.tell()
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=letter,
+        rightMargin=72,
+        leftMargin=72,
+        topMargin=72,
+        bottomMargin=72
+    )
+    styles = _pdf_styles()
+
+    try:
+        doc.build(_pdf_story(blocks, styles, doc.width))
+    except LayoutError:
+        # A table row that cannot be split to fit a page, such as a header cell taller
+        # than one: the tables are written as plain paragraphs instead
+        buffer.seek(start)
+        buffer.truncate()
+        doc.build(_pdf_story(blocks, styles, doc.width, flat_tables=True))
+    return buffer.getvalue() if out is None else None
+
+
+# Word backend
+def _docx_add_text(paragraph, text):
+    # Odd-numbered parts sit between ** markers
+    for i, part in enumerate(_BOLD_RE.split(text)):
+        if part:
+            run = paragraph.add_run(part)
+            if i % 2 == 1:
+                run.bold = True
+
+
+def _docx_divider(doc):
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    paragraph = doc.add_paragraph()
+    borders = OxmlElement('w:pBdr')
+    bottom = OxmlElement('w:bottom')
+    bottom.set(qn('w:val'), 'single')
+    bottom.set(qn('w:sz'), '6')
+    bottom.set(qn('w:space'), '1')
+    bottom.set(qn('w:color'), 'auto')
+    borders.append(bottom)
+    paragraph._p.get_or_add_pPr().append(borders)
+
+
+def _docx_table(doc, rows):
+    from docx.shared import Pt
+
+    table = doc.add_table(rows=len(rows), cols=len(rows[0]))
+    table.style = 'Table Grid'
+    for r, row in enumerate(rows):
+        for c, value in enumerate(row):
+            cell = table.cell(r, c)
+            if r == 0:
+                cell.paragraphs[0].add_run(_strip_bold(value)).bold = True
+            else:
+                _docx_add_text(cell.paragraphs[0], value)
+            for run in cell.paragraphs[0].runs:
+                run.font.size = Pt(9)
+    doc.add_paragraph()
+
+
+def render_docx(blocks, out=None):
+    """Render parsed blocks to a Word document, written to the binary file out or else returned as bytes"""
+    from docx import Document
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+    doc = Document()
+
+    title = doc.add_heading(DOCUMENT_TITLE, 0)
+    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+    date_paragraph = doc.add_paragraph()
+    date_paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    date_paragraph.add_run(datetime.now().strftime("%Y-%m-%d")).italic = True
+
+    doc.add_paragraph()  # Add spacing
+
+    for block in blocks:
+        if block.kind == 'heading':
+            doc.add_heading(_strip_bold(block.text), level=min(block.level, 3))
+        elif block.kind == 'paragraph':
+            _docx_add_text(doc.add_paragraph(), block.text)
+        elif block.kind == 'table':
+            _docx_table(doc, block.rows)
+        elif block.kind == 'divider':
+            _docx_divider(doc)
+
+    if out is not None:
+        doc.save(out)
+        return None
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+# Plain text backend
+def _text_table(rows):
+    rows = [[_strip_bold(cell) for cell in row] for row in rows]
+    widths = [min(max(len(row[c]) for row in rows), 40) for c in range(len(rows[0]))]
+    lines = []
+    for r, row in enumerate(rows):
+        lines.append(" | ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+        if r == 0:
+            lines.append("-+-".join('-' * width for width in widths))
+    return "\n".join(lines)
+
+
+def _text_parts(blocks):
+    yield f"""BATNA ANALYSIS DOCUMENT
+Generated on: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+{'='*50}"""
+    for block in blocks:
+        if block.kind == 'heading':
+            text = _strip_bold(block.text)
+            yield f"{text}\n{'-' * len(text)}"
+        elif block.kind == 'paragraph':
+            yield _strip_bold(block.text)
+        elif block.kind == 'table':
+            yield _text_table(block.rows)
+        elif block.kind == 'divider':
+            yield '-' * 50
+
+
+def render_text(blocks, out=None):
+    """Render parsed blocks to plain text, written to the binary file out or else returned as UTF-8 bytes"""
+    if out is None:
+        return ("\n\n".join(_text_parts(blocks)) + "\n").encode('utf-8')
+    # Block by block, so the text is never held in one piece
+    for index, part in enumerate(_text_parts(blocks)):
+        out.write((f"\n\n{part}" if index else part).encode('utf-8'))
+    out.write(b"\n")
+    return None
+
+
+# Export format (also the file extension) -> (renderer, MIME type)
+EXPORT_FORMATS = {
+    'pdf': (render_pdf, "application/pdf"),
+    'docx': (render_docx, "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    'txt': (render_text, "text/plain")
+}
+
+
+def load_backends():
+    """Import the PDF and Word libraries now instead of on the first export"""
+    with metrics.timed("export_backends_import"):
+        import docx  # noqa: F401
+        import docx.oxml  # noqa: F401
+        import reportlab.platypus  # noqa: F401
+        import reportlab.lib.styles  # noqa: F401
+
+
+def render_export(content, fmt):
+    """Render document text to one of EXPORT_FORMATS and return the bytes"""
+    with metrics.timed("export_render", format=fmt):
+        return EXPORT_FORMATS[fmt][0](parse_document(content))
+
+
+def render_export_file(content, fmt, path):
+    """Render document text to one of EXPORT_FORMATS straight into the file at path; returns its size.
+
+    Used for large documents: nothing is buffered besides what the PDF or Word
+    library itself keeps, and the file appears under path only once complete.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with metrics.timed("export_render", format=fmt, target="file"), open(tmp_path, 'wb') as f:
+            # Not through parse_document's cache: a large document is rendered once per format
+            EXPORT_FORMATS[fmt][0](parse_document.__wrapped__(content), f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return os.path.getsize(path)
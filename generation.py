@@ -0,0 +1,654 @@
+import contextvars
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import config
+import metrics
+from response_cache import make_response_key, normalize_field
+from token_budget import compact_inputs, estimate_tokens, output_budget
+
+# Full-quality model, and the faster, cheaper one used for drafts
+MODEL = config.QUALITY_MODEL
+DRAFT_MODEL = config.DRAFT_MODEL
+MAX_TOKENS = 4096
+TEMPERATURE = 0.7
+CONTEXT_WINDOW = 200000
+
+# Smallest max_tokens a request is sized down to, however large the prompt
+MIN_OUTPUT_TOKENS = 1024
+
+# Cheap model that condenses oversized inputs under the "summarize" input budget policy
+CONDENSE_MODEL = "claude-3-haiku-20240307"
+
+# Model tiers: "quality" writes with MODEL, "draft" with DRAFT_MODEL, and "refine" shows a
+# DRAFT_MODEL document first, then has MODEL revise it section by section. "auto" picks
+# "draft" for short inputs and "quality" otherwise.
+TIERS = ("quality", "draft", "refine", "auto")
+
+# USD per million input and output tokens; cache writes cost 25% more than input, reads 10% of it
+MODEL_PRICES = {
+    "claude-3-opus-20240229": (15.0, 75.0),
+    "claude-3-sonnet-20240229": (3.0, 15.0),
+    "claude-3-5-sonnet-20240620": (3.0, 15.0),
+    "claude-3-haiku-20240307": (0.25, 1.25)
+}
+
+# Form fields collected for every negotiation, in prompt order
+INPUT_FIELDS = {
+    "negotiation_subject": "Negotiation Subject",
+    "project_value": "Project Value",
+    "company_profile": "Company's Profile & Industry",
+    "scope_description": "Scope Description",
+    "targets": "Targets to be Achieved",
+    "vendors": "Vendors & Suppliers to be Invited",
+    "interests": "Client's & Vendor's Interests",
+    "advantages": "Client's & Vendors' Negotiation Advantages",
+    "disadvantages": "Client's & Vendors' Negotiation Disadvantages"
+}
+
+# Bump whenever the prompt templates change so cached responses are not reused
+PROMPT_VERSION = "2"
+
+# Output budget for one section when sections are generated separately
+SECTION_MAX_TOKENS = 1536
+
+# Follow-up requests made when a response stops at max_tokens
+MAX_CONTINUATIONS = 2
+
+# Static instructions sent as the system prompt of every document and section request; only
+# the user message carrying the inputs changes between negotiations. At about 860 tokens they are
+# under the API's caching minimum (CACHE_MIN_TOKENS), so they are only cached with the inputs
+SYSTEM_PROMPT = """As an AI assistant, your task is to provide a comprehensive, well-structured analysis of a negotiation scenario between a client and a vendor. The analysis should cover various aspects, including the client's and vendor's Best Alternative To a Negotiated Agreement (BATNA), risk assessment and mitigation strategies, negotiation strategy and tactics, and an implementation roadmap. The analysis should be thorough, considering multiple scenarios and potential outcomes, and should include actionable recommendations for the client.
+    Please use for the final BATNA Document the structure below:
+
+    1. EXECUTIVE SUMMARY
+    [In this section, provide a concise yet comprehensive overview of the entire analysis, highlighting the key findings and critical recommendations. The summary should be engaging and persuasive, encouraging the reader to delve into the details of the analysis.]
+
+    2. CLIENT'S BATNA ANALYSIS
+    [Format: table with following columns: Alternative Options, Strength Assessment, Risk Assessment. Instruction: Following the table, present a detailed analysis of each viable alternative available to the client. Consider factors such as implementation feasibility, cost implications, and strategic fit. The analysis should provide a clear understanding of the client's position and the potential outcomes of pursuing alternative options.]
+
+    3. VENDOR'S BATNA ANALYSIS
+    [Format: table with following columns: Alternative Options, Strength Assessment, Risk Assessment. Instruction: After the table, analyze the vendor's alternatives, market position, and potential responses to different scenarios. This analysis should provide insights into the vendor's strengths, weaknesses, and likely negotiation strategies.]
+
+    4. RISK ASSESSMENT & MITIGATION
+    [Format: table with following columns: Risk Category, Mitigation Strategy, Contingency Plan. Instruction: Following the table, provide a comprehensive analysis of potential risks associated with the negotiation and the proposed mitigation strategies. Consider various risk categories, such as financial, operational, and reputational risks. The analysis should demonstrate a proactive approach to risk management and contingency planning.]
+
+    5. NEGOTIATION STRATEGY
+    [Present a detailed strategic approach to the negotiation, covering core objectives, non-negotiables, value creation opportunities, power dynamics, leverage points, and relationship management. The strategy should be well-reasoned and adaptable, taking into account the insights gained from the BATNA and risk analyses.]
+
+    6. NEGOTIATION TACTICS
+    [Detail specific tactical recommendations for the negotiation, including type of the process (e.g. single source, RFx, auction...), opening positions, communication strategies, response scenarios, and timing considerations. The tactics should be aligned with the overall negotiation strategy and designed to maximize the client's chances of achieving a favorable outcome.]
+
+    7. RECOMMENDATIONS
+    [Provide clear, actionable recommendations for the client, including immediate next steps, critical success factors, resource requirements, and expected outcomes. The recommendations should be based on the insights gained from the analysis and designed to help the client achieve their objectives in the negotiation.]
+    
+    Formating:  
+    -heading"bold and larger than normal text
+    -devider after every of the 8 sections
+    """
+
+INPUT_TEMPLATE = """The negotiation is described by the following information:
+
+{input_data}"""
+
+DOCUMENT_TASK = "Create a comprehensive BATNA document based on this information, following the structure and formatting above."
+
+# Beta that enables cache_control blocks on this API version
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+EPHEMERAL = {"type": "ephemeral"}
+# Shortest prefix the API caches for Opus and Sonnet, in tokens; shorter ones are sent uncached
+CACHE_MIN_TOKENS = 1024
+
+# (title, instruction) of each numbered section, read from the template so it stays the single source
+SECTIONS = tuple(
+    (title, instruction)
+    for title, instruction in re.findall(r'^ *[1-7]\. (.+)\n *\[(.+)\]$', SYSTEM_PROMPT, re.MULTILINE)
+)
+SECTION_TITLES = tuple(title for title, _ in SECTIONS)
+
+SECTION_TASK_TEMPLATE = """This request is for one section of the document only.
+
+Write only section {number}. {title}.
+{instruction}
+
+Start with the heading "## {number}. {title}" and do not write any other section.{context}"""
+
+SUMMARY_CONTEXT_TEMPLATE = """
+
+The remaining sections of the document have already been written. Base the summary on them:
+
+{sections}"""
+
+REFERENCE_DRAFT_TEMPLATE = """
+
+Below is this section from the BATNA document of a similar past negotiation. Use it as a draft: keep what still applies and revise everything the information above changes.
+
+{reference}"""
+
+CONDENSE_PROMPT_TEMPLATE = """The following notes were given as "{label}" for a negotiation analysis. Condense them to at most {words} words. Keep every figure, name, date, requirement and constraint; drop repetition, boilerplate and formatting. Reply with the condensed notes only.
+
+{text}"""
+
+# Sections 2-7 whose content draws on each form field; the executive summary follows whichever change
+SECTION_DEPENDENCIES = {
+    "negotiation_subject": (2, 3, 4, 5, 6, 7),
+    "project_value": (2, 3, 4, 5, 7),
+    "company_profile": (2, 3, 5, 7),
+    "scope_description": (2, 3, 4, 6, 7),
+    "targets": (2, 5, 6, 7),
+    "vendors": (3, 4, 6),
+    "interests": (2, 3, 5),
+    "advantages": (2, 3, 5, 6),
+    "disadvantages": (2, 3, 4, 5, 6)
+}
+
+# A numbered section heading: markdown "## 2. ...", a fully bold "**2. ...**" line, "2. UPPERCASE TITLE"
+# or a plain "2. Client's BATNA Analysis" in any case; any other plain numbered line is a list item
+SECTION_HEADING_RE = re.compile(
+    r'^(?:#{1,6}\s*\**\s*([1-8])\.\s.*'
+    r'|\*\*\s*([1-8])\.\s[^*\n]*\*\*:?\s*'
+    r'|([1-8])\.\s+(?:[^a-z\n]+|(?i:' + "|".join(re.escape(title).replace("'", "['’]").replace(r"\&", "(?:&|and)") for title in SECTION_TITLES) + r')\s*:?))$',
+    re.MULTILINE
+)
+
+
+def format_input_data(data):
+    """Format the collected form fields for the prompt"""
+    return "\n\n".join([f"{k.replace('_', ' ').title()}: {v}"
+                         for k, v in data.items()])
+
+
+def _text_block(text):
+    return {"type": "text", "text": text}
+
+
+def build_prompt(data):
+    """User message content for the whole document: the inputs, then the task"""
+    with metrics.timed("prompt_build"):
+        return [_text_block(INPUT_TEMPLATE.format(input_data=format_input_data(data))), _text_block(DOCUMENT_TASK)]
+
+
+def build_section_prompt(data, number, context_sections=None, reference=None):
+    """User message content for a single section.
+
+    The summary is given the finished sections as context; reference is an
+    earlier version of the section to revise rather than start from scratch.
+    """
+    title, instruction = SECTIONS[number - 1]
+    context = ""
+    if context_sections:
+        context = SUMMARY_CONTEXT_TEMPLATE.format(sections=context_sections)
+    if reference:
+        context += REFERENCE_DRAFT_TEMPLATE.format(reference=reference)
+    return [
+        _text_block(INPUT_TEMPLATE.format(input_data=format_input_data(data))),
+        _text_block(SECTION_TASK_TEMPLATE.format(number=number, title=title, instruction=instruction, context=context))
+    ]
+
+
+def _request_params(prompt, prefill=None, system=SYSTEM_PROMPT, cache_input=False):
+    """messages/system/extra_headers for one request, with prompt-caching breakpoints when enabled.
+
+    A breakpoint is a cache write at 1.25 times the input price, so it is only
+    set where a later request reads it back. The input block that opens the
+    user message is marked when cache_input is set - the sections and summary
+    of one document all start with it - and on continuations, which re-send
+    the prompt. The system prompt gets its own breakpoint only once it reaches
+    CACHE_MIN_TOKENS; it is currently shorter and cached as part of the input
+    block's prefix.
+    """
+    content = prompt
+    params = {}
+    if config.PROMPT_CACHING:
+        if (cache_input or prefill) and isinstance(prompt, list) and len(prompt) > 1:
+            content = [dict(prompt[0], cache_control=EPHEMERAL)] + prompt[1:]
+        if system and estimate_tokens(system) >= CACHE_MIN_TOKENS:
+            params['system'] = [dict(_text_block(system), cache_control=EPHEMERAL)]
+        params['extra_headers'] = {"anthropic-beta": PROMPT_CACHING_BETA}
+    if system and 'system' not in params:
+        params['system'] = system
+    params['messages'] = [{"role": "user", "content": content}]
+    if prefill:
+        # Prefill the reply with what was already written so the model carries on from the cut;
+        # the API rejects a prefill that ends in whitespace
+        params['messages'].append({"role": "assistant", "content": prefill.rstrip()})
+    return params
+
+
+def _usage(usage):
+    """Token counts of a response, including prompt-cache reads and writes"""
+    return {
+        'input_tokens': usage.input_tokens or 0,
+        'output_tokens': getattr(usage, 'output_tokens', 0) or 0,
+        'cache_creation_input_tokens': getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+        'cache_read_input_tokens': getattr(usage, 'cache_read_input_tokens', 0) or 0
+    }
+
+
+def request_cost(model, usage):
+    """Price of one request in USD, 0 for models without a known price"""
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (usage.get('input_tokens', 0) * input_price
+            + usage.get('cache_creation_input_tokens', 0) * input_price * 1.25
+            + usage.get('cache_read_input_tokens', 0) * input_price * 0.1
+            + usage.get('output_tokens', 0) * output_price) / 1e6
+
+
+def _add_usage(total, usage):
+    for key, value in usage.items():
+        total[key] = total.get(key, 0) + value
+
+
+def budget_signature():
+    """The input budget settings, which change the prompt sent for the same inputs"""
+    if config.INPUT_BUDGET_POLICY == "off":
+        return ""
+    return (f"{config.INPUT_BUDGET_POLICY}-{config.PROMPT_TOKEN_BUDGET}"
+            f"-{config.FIELD_TOKEN_CAP}-{config.REQUEST_TOKEN_BUDGET}")
+
+
+def route_tier(tier, data):
+    """Resolve "auto" to the tier for these inputs; other tiers are returned as they are"""
+    if tier != "auto":
+        return tier
+    input_tokens = estimate_tokens(format_input_data(data))
+    return "draft" if input_tokens <= config.AUTO_DRAFT_MAX_INPUT_TOKENS else "quality"
+
+
+def response_cache_key(data, parallel=False, tier="quality", temperature=TEMPERATURE):
+    prompt_version = f"{PROMPT_VERSION}-sections" if parallel else PROMPT_VERSION
+    model = DRAFT_MODEL if tier == "draft" else MODEL
+    if tier == "refine":
+        prompt_version, model = f"{PROMPT_VERSION}-refined", f"{DRAFT_MODEL}+{MODEL}"
+    if budget_signature():
+        prompt_version = f"{prompt_version}-{budget_signature()}"
+    max_tokens = SECTION_MAX_TOKENS if parallel or tier == "refine" else MAX_TOKENS
+    return make_response_key(data, prompt_version, model, temperature, max_tokens)
+
+
+def find_section_starts(text):
+    """Return (offset, section number) for every numbered section heading in text"""
+    return [(m.start(), int(m.group(1) or m.group(2) or m.group(3)))
+            for m in SECTION_HEADING_RE.finditer(text)]
+
+
+def format_section(number, text):
+    """Give a separately generated section its canonical heading and drop a trailing divider"""
+    body = text.strip()
+    starts = find_section_starts(body)
+    if starts and starts[0][0] == 0:
+        body = body.split('\n', 1)[1] if '\n' in body else ""
+    body = re.sub(r'\n\s*(?:-{3,}|\*{3,}|_{3,})\s*$', '', body.strip()).strip()
+    return f"## {number}. {SECTIONS[number - 1][0]}\n\n{body}"
+
+
+def assemble_document(sections):
+    """Join sections (number -> text) in document order with a divider after each"""
+    return "".join(f"{sections[number]}\n\n---\n\n" for number in sorted(sections)).rstrip()
+
+
+def split_sections(document):
+    """Map section number to its canonical text for every section heading found in document.
+
+    Headings must appear in ascending order, so numbered list items inside a
+    section are not mistaken for an earlier section.
+    """
+    starts = []
+    for offset, number in find_section_starts(document):
+        if number <= len(SECTIONS) and (not starts or number > starts[-1][1]):
+            starts.append((offset, number))
+    ends = [offset for offset, _ in starts[1:]] + [len(document)]
+    return {number: format_section(number, document[offset:end])
+            for (offset, number), end in zip(starts, ends)}
+
+
+def changed_fields(old_data, new_data):
+    return [key for key in INPUT_FIELDS
+            if normalize_field(old_data.get(key, "")) != normalize_field(new_data.get(key, ""))]
+
+
+def draft_sections(previous_document, previous_data, data):
+    """Seed a generation from a similar past document: (reuse, references) for generate_sections_parallel.
+
+    Sections unaffected by the differing fields are reused as they are; the
+    others are sent to the model as reference drafts. Returns (None, None)
+    when the past document cannot be split into its sections.
+    """
+    reuse = reusable_sections(previous_document, previous_data, data)
+    if reuse is None:
+        return None, None
+    sections = split_sections(previous_document)
+    return reuse, {number: text for number, text in sections.items() if number not in reuse}
+
+
+def reusable_sections(previous_document, previous_data, data):
+    """Sections of previous_document still valid for data, for generate_sections_parallel(reuse=...).
+
+    Returns None when the previous document cannot be split into its sections.
+    """
+    sections = split_sections(previous_document)
+    if len(sections) < len(SECTIONS):
+        return None
+    affected = set()
+    for key in changed_fields(previous_data, data):
+        affected.update(SECTION_DEPENDENCIES[key])
+    if affected:
+        affected.add(1)
+    return {number: text for number, text in sections.items() if number not in affected}
+
+
+def _request(client, prompt, max_tokens, mode='blocking', model=MODEL, system=SYSTEM_PROMPT,
+             temperature=TEMPERATURE, cache_input=False):
+    """Blocking request, continued while it stops at max_tokens.
+
+    Returns (text, usage, stop_reason) with usage summed over the original
+    request and its continuations. cache_input marks the prompt's input block
+    for the prompt cache, for requests that share it.
+    """
+    text = ""
+    usage = {}
+    stop_reason = None
+    for attempt in range(MAX_CONTINUATIONS + 1):
+        start = time.perf_counter()
+        message = client.messages.create(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **_request_params(prompt, text, system, cache_input)
+        )
+        message_usage = _usage(message.usage)
+        message_usage['cost_usd'] = request_cost(model, message_usage)
+        metrics.record_api_call(dict(
+            message_usage,
+            request_id=metrics.new_request_id(),
+            model=model,
+            total_latency=time.perf_counter() - start,
+            stop_reason=message.stop_reason
+        ), mode if not attempt else 'continuation')
+        text = (text.rstrip() if attempt else "") + message.content[0].text
+        _add_usage(usage, message_usage)
+        stop_reason = message.stop_reason
+        if stop_reason != 'max_tokens':
+            break
+    return text, usage, stop_reason
+
+
+def create_response(client, prompt, model=MODEL):
+    """Send prompt in one blocking request and return the text"""
+    return _request(client, prompt, MAX_TOKENS, model=model)[0]
+
+
+def condense_field(client, key, text, max_tokens):
+    """Have CONDENSE_MODEL shorten one form field to about max_tokens"""
+    prompt = CONDENSE_PROMPT_TEMPLATE.format(label=INPUT_FIELDS.get(key, key), words=int(max_tokens * 0.7), text=text)
+    return _request(client, prompt, max_tokens, 'condense', CONDENSE_MODEL, system=None)[0].strip()
+
+
+def estimate_prompt_tokens(data):
+    return estimate_tokens(SYSTEM_PROMPT + INPUT_TEMPLATE.format(input_data=format_input_data(data)) + DOCUMENT_TASK)
+
+
+def apply_input_budget(client, data, condense=True, previous=None):
+    """Fit data into the configured prompt budget and size max_tokens from what is left.
+
+    Returns the data to build prompts from and a dict with the estimated
+    prompt tokens, max_tokens, the fields that were shortened (see
+    token_budget.compact_inputs) and the text of those that were condensed.
+    With condense=False the "summarize" policy is only estimated and no
+    request is made. previous is the budget of an earlier call for the same
+    data; its condensed fields are reused instead of being condensed again.
+    """
+    condensed = {}
+    reused = dict(previous.get('condensed', {})) if previous else {}
+
+    def condense_once(key, text, limit):
+        if key not in reused:
+            reused[key] = condense_field(client, key, text, limit)
+        condensed[key] = reused[key]
+        return condensed[key]
+
+    with metrics.timed("input_budget"):
+        compacted, notes = compact_inputs(
+            data,
+            estimate_prompt_tokens({key: "" for key in data}),
+            config.PROMPT_TOKEN_BUDGET,
+            config.FIELD_TOKEN_CAP,
+            config.INPUT_BUDGET_POLICY,
+            condense_once if condense else None
+        )
+    prompt_tokens = estimate_prompt_tokens(compacted)
+    budget = {
+        'prompt_tokens': prompt_tokens,
+        'max_tokens': output_budget(prompt_tokens, MAX_TOKENS, config.REQUEST_TOKEN_BUDGET,
+                                    CONTEXT_WINDOW, MIN_OUTPUT_TOKENS),
+        'compacted': notes,
+        'condensed': condensed
+    }
+    return compacted, budget
+
+
+def generate_sections_parallel(client, data, max_workers=4, on_section=None, reuse=None, references=None,
+                               model=MODEL, temperature=TEMPERATURE, budget=None):
+    """Generate sections 2-7 as concurrent requests, then the executive summary from them.
+
+    on_section(number, text) is called from the calling thread as each section
+    finishes. Sections in reuse (number -> text) are kept instead of being
+    requested again; those in references (number -> text) are generated with
+    the given text as a draft. budget is that of an earlier generation from
+    the same data, whose condensed inputs are reused. Returns the assembled
+    document and a stats dict shaped like the one from stream_response.
+    """
+    start = time.perf_counter()
+    data, budget = apply_input_budget(client, data, previous=budget)
+    section_max_tokens = min(SECTION_MAX_TOKENS, budget['max_tokens'])
+    first_section = None
+    sections = {}
+    usage = {}
+    stop_reason = 'end_turn'
+
+    def record(number, response):
+        nonlocal stop_reason
+        text, section_usage, section_stop_reason = response
+        _add_usage(usage, section_usage)
+        if section_stop_reason == 'max_tokens':
+            stop_reason = 'max_tokens'
+        sections[number] = format_section(number, text)
+        if on_section:
+            on_section(number, sections[number])
+
+    reuse = reuse or {}
+    references = references or {}
+    for number in sorted(reuse):
+        sections[number] = reuse[number]
+        if on_section:
+            on_section(number, reuse[number])
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {
+            pool.submit(
+                contextvars.copy_context().run,
+                _request, client, build_section_prompt(data, number, reference=references.get(number)),
+                section_max_tokens, 'section', model, SYSTEM_PROMPT, temperature, True
+            ): number
+            for number in range(2, len(SECTIONS) + 1)
+            if number not in reuse
+        }
+        for future in as_completed(futures):
+            record(futures[future], future.result())
+            if first_section is None:
+                first_section = time.perf_counter()
+    finally:
+        # Do not wait for queued sections if one of them failed
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    if 1 not in reuse:
+        summary_prompt = build_section_prompt(data, 1, assemble_document(sections), references.get(1))
+        record(1, _request(client, summary_prompt, section_max_tokens, 'section', model, SYSTEM_PROMPT, temperature,
+                           True))
+    end = time.perf_counter()
+
+    stats = {
+        'request_id': metrics.new_request_id(),
+        'model': model,
+        'mode': 'incremental' if reuse else 'parallel',
+        'time_to_first_token': (first_section or end) - start,
+        'total_latency': end - start,
+        'input_tokens': usage.get('input_tokens', 0),
+        'output_tokens': usage.get('output_tokens', 0),
+        'cache_creation_input_tokens': usage.get('cache_creation_input_tokens', 0),
+        'cache_read_input_tokens': usage.get('cache_read_input_tokens', 0),
+        'cost_usd': usage.get('cost_usd', 0.0),
+        'stop_reason': stop_reason,
+        'regenerated': [number for number in range(1, len(SECTIONS) + 1) if number not in reuse],
+        'budget': budget
+    }
+    # Token counts were recorded per section request; only the overall timing is added here
+    metrics.observe("generation", stats['total_latency'], mode=stats['mode'], model=model)
+    return assemble_document(sections), stats
+
+
+def _stream(client, prompt, prefill=None, on_text=None, max_tokens=MAX_TOKENS, model=MODEL, temperature=TEMPERATURE):
+    """One streamed request; returns (text, usage, stop_reason, time of the first token)"""
+    start = time.perf_counter()
+    first_token = None
+    stop_reason = None
+    usage = {}
+    chunks = []
+    with client.messages.stream(
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        **_request_params(prompt, prefill)
+    ) as stream:
+        # Walk raw events: this SDK version does not copy message_delta usage into the final message
+        for event in stream:
+            if event.type == 'message_start':
+                usage = _usage(event.message.usage)
+            elif event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                if first_token is None:
+                    first_token = time.perf_counter()
+                chunks.append(event.delta.text)
+                if on_text:
+                    on_text(event.delta.text)
+            elif event.type == 'message_delta':
+                usage['output_tokens'] = event.usage.output_tokens
+                stop_reason = event.delta.stop_reason
+    end = time.perf_counter()
+    usage['cost_usd'] = request_cost(model, usage)
+    metrics.record_api_call(dict(
+        usage,
+        request_id=metrics.new_request_id(),
+        model=model,
+        time_to_first_token=(first_token or end) - start,
+        total_latency=end - start,
+        stop_reason=stop_reason
+    ), 'continuation' if prefill else 'stream')
+    return "".join(chunks), usage, stop_reason, first_token
+
+
+def stream_response(client, prompt, on_text=None, max_tokens=MAX_TOKENS, model=MODEL, temperature=TEMPERATURE):
+    """Stream a response, calling on_text(delta) as tokens arrive.
+
+    A response cut off at max_tokens is continued with up to MAX_CONTINUATIONS
+    follow-up requests. Returns the full text and a stats dict with
+    time-to-first-token, total latency, token usage (including prompt-cache
+    reads and writes), stop reason and the number of continuations.
+    """
+    start = time.perf_counter()
+    text, usage, stop_reason, first_token = _stream(client, prompt, None, on_text, max_tokens, model, temperature)
+    continuations = 0
+    while stop_reason == 'max_tokens' and continuations < MAX_CONTINUATIONS:
+        continuations += 1
+        more, more_usage, stop_reason, _ = _stream(client, prompt, text, on_text, max_tokens, model, temperature)
+        text = text.rstrip() + more
+        _add_usage(usage, more_usage)
+    end = time.perf_counter()
+
+    stats = {
+        'request_id': metrics.new_request_id(),
+        'model': model,
+        'time_to_first_token': (first_token or end) - start,
+        'total_latency': end - start,
+        'input_tokens': usage.get('input_tokens', 0),
+        'output_tokens': usage.get('output_tokens', 0),
+        'cache_creation_input_tokens': usage.get('cache_creation_input_tokens', 0),
+        'cache_read_input_tokens': usage.get('cache_read_input_tokens', 0),
+        'cost_usd': usage.get('cost_usd', 0.0),
+        'stop_reason': stop_reason,
+        'continuations': continuations
+    }
+    return text, stats
+
+
+# Stats entries summed when a document is put together from several generations
+USAGE_KEYS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'cost_usd')
+
+
+def generate_document(client, data, on_text=None, max_workers=4, model=MODEL, temperature=TEMPERATURE):
+    """Stream the whole document, then request any of the seven sections it lacks.
+
+    Inputs are first fitted into the configured prompt budget, which also
+    sizes max_tokens.
+
+    Sections are only filled in when the response was cut off or its headings
+    show that some are missing; a finished response without any recognisable
+    heading is returned as it is.
+
+    A section still cut off after the continuations is requested again on its
+    own. Sections that came back complete are kept, so no paid-for output is
+    thrown away. Returns the document and the stats of stream_response, with
+    token counts and latency covering the extra requests.
+    """
+    data, budget = apply_input_budget(client, data)
+    document, stats = stream_response(client, build_prompt(data), on_text, budget['max_tokens'], model, temperature)
+    stats['budget'] = budget
+    sections = split_sections(document)
+    if stats['stop_reason'] != 'max_tokens' and not sections:
+        # Finished, but in a layout whose headings are not recognised: nothing shows what is missing
+        return document, stats
+    if stats['stop_reason'] == 'max_tokens' and sections:
+        del sections[max(sections)]
+    if len(sections) == len(SECTIONS):
+        return document, stats
+
+    def on_section(number, text):
+        if on_text and number not in sections:
+            on_text(f"\n\n{text}")
+
+    start = time.perf_counter()
+    document, fill_stats = generate_sections_parallel(client, data, max_workers, on_section, sections, model=model,
+                                                      temperature=temperature)
+    for key in USAGE_KEYS:
+        stats[key] += fill_stats[key]
+    stats.update({
+        'total_latency': stats['total_latency'] + time.perf_counter() - start,
+        'stop_reason': fill_stats['stop_reason'],
+        'filled_sections': fill_stats['regenerated']
+    })
+    return document, stats
+
+
+def refine_document(client, data, draft, draft_stats, max_workers=4, on_section=None):
+    """Have MODEL revise a DRAFT_MODEL document, each section with its draft as reference.
+
+    Returns the refined document and the stats of generate_sections_parallel
+    with the draft's tokens and cost added and its model and latency under
+    draft_model and draft_latency. Inputs condensed for the draft are not
+    condensed again.
+    """
+    start = time.perf_counter()
+    document, stats = generate_sections_parallel(
+        client, data, max_workers, on_section, references=split_sections(draft), model=MODEL,
+        budget=draft_stats.get('budget')
+    )
+    for key in USAGE_KEYS:
+        stats[key] += draft_stats.get(key, 0)
+    stats.update({
+        'mode': 'refine',
+        'draft_model': draft_stats['model'],
+        'draft_latency': draft_stats['total_latency'],
+        'total_latency': draft_stats['total_latency'] + time.perf_counter() - start
+    })
+    return document, stats
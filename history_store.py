@@ -0,0 +1,294 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+from similarity import DIM, SimilarityIndex, vectorize
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _compress(text):
+    return zlib.compress(text.encode('utf-8'), 6)
+
+
+def _decompress(blob):
+    return zlib.decompress(blob).decode('utf-8')
+
+
+def _document_hash(document):
+    return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+
+def _match_query(query):
+    """Turn free text into an FTS5 query: every word must match as a prefix"""
+    tokens = _TOKEN_RE.findall(query or "")
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+class HistoryStore:
+    """Durable document history in SQLite with compressed bodies and full-text search.
+
+    Each entry has an owner. Methods given an owner only see and change that
+    owner's entries; owner=None, as the command-line tools use, means all of
+    them. for_owner() returns a view of the store bound to one owner.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                created REAL NOT NULL,
+                subject TEXT NOT NULL,
+                value TEXT NOT NULL,
+                document BLOB NOT NULL,
+                data BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS documents_created ON documents(created);
+            CREATE INDEX IF NOT EXISTS documents_subject ON documents(subject);
+            CREATE INDEX IF NOT EXISTS documents_value ON documents(value);
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(subject, document, content='');
+            CREATE TABLE IF NOT EXISTS document_vectors (
+                id INTEGER PRIMARY KEY,
+                vector BLOB NOT NULL
+            );
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(documents)")]
+        if 'owner' not in columns:
+            # Entries of stores created before owners have none, and are only listed with owner=None
+            self._conn.execute("ALTER TABLE documents ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+        if 'document_hash' not in columns:
+            # Older entries are not found by find(); only new ones are looked up
+            self._conn.execute("ALTER TABLE documents ADD COLUMN document_hash TEXT NOT NULL DEFAULT ''")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS documents_owner ON documents(owner, created)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS documents_hash ON documents(document_hash)")
+        # Built on the first similarity search, then kept in step by add/delete/clear
+        self._index = None
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def for_owner(self, owner):
+        return OwnedHistory(self, owner)
+
+    def add(self, document, data, timestamp=None, owner=""):
+        """Store a document and its inputs; returns the new entry id"""
+        created = (timestamp or datetime.now()).timestamp()
+        subject = data.get('negotiation_subject', 'Untitled')
+        value = data.get('project_value', 'N/A')
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO documents (created, subject, value, document, data, owner, document_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (created, subject, value, _compress(document), _compress(json.dumps(data)), owner,
+                 _document_hash(document))
+            )
+            conn.execute(
+                "INSERT INTO documents_fts (rowid, subject, document) VALUES (?, ?, ?)",
+                (cursor.lastrowid, subject, document)
+            )
+            vector = vectorize(data)
+            conn.execute(
+                "INSERT INTO document_vectors (id, vector) VALUES (?, ?)",
+                (cursor.lastrowid, vector.tobytes())
+            )
+            if self._index is not None:
+                self._index.add(cursor.lastrowid, vector)
+            return cursor.lastrowid
+
+    def _where(self, query, owner=None):
+        conditions, params = [], ()
+        match = _match_query(query)
+        if match:
+            conditions.append("id IN (SELECT rowid FROM documents_fts WHERE documents_fts MATCH ?)")
+            params += (match,)
+        if owner is not None:
+            conditions.append("owner = ?")
+            params += (owner,)
+        return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+    def count(self, query=None, owner=None):
+        where, params = self._where(query, owner)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM documents {where}", params).fetchone()[0]
+
+    def list(self, offset=0, limit=10, query=None, owner=None):
+        """Newest-first page of entry summaries; bodies are not loaded"""
+        where, params = self._where(query, owner)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, created, subject, value FROM documents {where} "
+                "ORDER BY created DESC, id DESC LIMIT ? OFFSET ?",
+                params + (limit, offset)
+            ).fetchall()
+        return [
+            {'id': row[0], 'timestamp': datetime.fromtimestamp(row[1]), 'subject': row[2], 'value': row[3]}
+            for row in rows
+        ]
+
+    def ids(self, query=None, owner=None):
+        """Ids of every entry matching query, newest first"""
+        where, params = self._where(query, owner)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id FROM documents {where} ORDER BY created DESC, id DESC", params
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def find(self, document, owner=None):
+        """Id of the newest entry holding exactly document, or None"""
+        where, params = self._where(None, owner)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT id FROM documents {where} {'AND' if where else 'WHERE'} document_hash = ? "
+                "ORDER BY created DESC, id DESC LIMIT 1",
+                params + (_document_hash(document),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get(self, entry_id, owner=None):
+        """Full entry in the shape save_to_history used to keep in session state"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created, subject, value, document, data, owner FROM documents WHERE id = ?", (entry_id,)
+            ).fetchone()
+        if row is None or (owner is not None and row[5] != owner):
+            return None
+        return {
+            'id': entry_id,
+            'timestamp': datetime.fromtimestamp(row[0]),
+            'document': _decompress(row[3]),
+            'metadata': {
+                'subject': row[1],
+                'value': row[2],
+                'data': json.loads(_decompress(row[4]))
+            }
+        }
+
+    def delete(self, entry_id, owner=None):
+        where, params = self._where(None, owner)
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f"SELECT id, subject, document FROM documents {where} {'AND' if where else 'WHERE'} id = ?",
+                params + (entry_id,)
+            ).fetchall()
+            self._delete_rows(conn, rows)
+
+    def clear(self, owner=None):
+        """Delete every entry, or only owner's"""
+        with self._transaction() as conn:
+            if owner is None:
+                conn.execute("DELETE FROM documents")
+                conn.execute("INSERT INTO documents_fts (documents_fts) VALUES ('delete-all')")
+                conn.execute("DELETE FROM document_vectors")
+                if self._index is not None:
+                    self._index.clear()
+                return
+            rows = conn.execute("SELECT id, subject, document FROM documents WHERE owner = ?", (owner,)).fetchall()
+            self._delete_rows(conn, rows)
+
+    def _delete_rows(self, conn, rows):
+        # Contentless FTS rows are removed by replaying the indexed values
+        conn.executemany(
+            "INSERT INTO documents_fts (documents_fts, rowid, subject, document) VALUES ('delete', ?, ?, ?)",
+            [(entry_id, subject, _decompress(document)) for entry_id, subject, document in rows]
+        )
+        conn.executemany("DELETE FROM documents WHERE id = ?", [(row[0],) for row in rows])
+        conn.executemany("DELETE FROM document_vectors WHERE id = ?", [(row[0],) for row in rows])
+        if self._index is not None:
+            for row in rows:
+                self._index.remove(row[0])
+
+    def _load_index(self):
+        with self._lock:
+            # Entries stored before vectors were kept get theirs now
+            missing = self._conn.execute(
+                "SELECT id, data FROM documents WHERE id NOT IN (SELECT id FROM document_vectors)"
+            ).fetchall()
+            if missing:
+                self._conn.executemany(
+                    "INSERT INTO document_vectors (id, vector) VALUES (?, ?)",
+                    [(entry_id, vectorize(json.loads(_decompress(data))).tobytes()) for entry_id, data in missing]
+                )
+            rows = self._conn.execute("SELECT id, vector FROM document_vectors").fetchall()
+            index = SimilarityIndex()
+            index.load(
+                [row[0] for row in rows],
+                np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(-1, DIM)
+            )
+            self._index = index
+
+    def similar(self, data, limit=3, min_score=0.0, owner=None):
+        """Summaries of the entries whose inputs are closest to data, with a 'score' from 0 to 1"""
+        if self._index is None:
+            self._load_index()
+        among = None if owner is None else self.ids(owner=owner)
+        matches = self._index.search(vectorize(data), limit, min_score, among)
+        if not matches:
+            return []
+        scores = dict(matches)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, created, subject, value FROM documents WHERE id IN ({','.join('?' * len(scores))})",
+                tuple(scores)
+            ).fetchall()
+        entries = [
+            {'id': row[0], 'timestamp': datetime.fromtimestamp(row[1]), 'subject': row[2], 'value': row[3],
+             'score': scores[row[0]]}
+            for row in rows
+        ]
+        return sorted(entries, key=lambda entry: entry['score'], reverse=True)
+
+
+class OwnedHistory:
+    """A HistoryStore seen by one owner: the same methods, limited to the owner's entries"""
+
+    def __init__(self, store, owner):
+        self.store = store
+        self.owner = owner
+
+    def add(self, document, data, timestamp=None):
+        return self.store.add(document, data, timestamp, self.owner)
+
+    def count(self, query=None):
+        return self.store.count(query, self.owner)
+
+    def list(self, offset=0, limit=10, query=None):
+        return self.store.list(offset, limit, query, self.owner)
+
+    def ids(self, query=None):
+        return self.store.ids(query, self.owner)
+
+    def find(self, document):
+        return self.store.find(document, self.owner)
+
+    def get(self, entry_id):
+        return self.store.get(entry_id, self.owner)
+
+    def delete(self, entry_id):
+        self.store.delete(entry_id, self.owner)
+
+    def clear(self):
+        self.store.clear(self.owner)
+
+    def similar(self, data, limit=3, min_score=0.0):
+        return self.store.similar(data, limit, min_score, self.owner)
@@ -0,0 +1,489 @@
+"""HTTP API for generating and exporting BATNA documents from other tools.
+
+    python http_api.py --port 8766
+    python http_api.py --mock          # canned answers from mock_anthropic, no API key needed
+
+Endpoints (JSON unless noted):
+
+    POST   /v1/documents                   {"inputs": {<the nine form fields>}, "tier": "quality",
+                                            "parallel": false, "force": false} -> 202 and the job;
+                                           parallel and force must be JSON booleans
+    GET    /v1/jobs/<id>                   status, stats, history entry id and, once done, the document
+    GET    /v1/jobs/<id>/events            text/event-stream of the text as it is written
+    DELETE /v1/jobs/<id>                   cancel
+    GET    /v1/history?query=&offset=&limit=
+    GET    /v1/history/<id>                inputs, metadata and document
+    GET    /v1/history/<id>/export/<fmt>   md, pdf, docx or txt file, streamed in chunks
+    GET    /metrics, /healthz
+
+Generation runs on the same job queue, prompts, response cache and history
+store as the Streamlit form, and exports come from the same renderers through
+an export cache; those of large documents are files rendered by worker
+processes and sent from disk. Requests beyond --max-requests in flight are answered 503
+with Retry-After.
+
+History is scoped like the form's (BATNA_HISTORY_SCOPE): each caller names
+its owner with an "owner" query parameter or an X-Client-Id header, and only
+sees and adds documents of that owner. Pass the owner id from a browser's
+page URL to reach that browser's history. With BATNA_HISTORY_SCOPE=shared
+every caller sees the whole history and no owner is needed; there is no
+other unscoped view.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import time
+from functools import partial
+
+import tornado.web
+from tornado.iostream import StreamClosedError
+
+import config
+import metrics
+from archive import entry_folder
+from document_store import DocumentStore
+from export_cache import ExportCache, ExportFiles, export_settings
+from exporters import EXPORT_FORMATS, load_backends, render_export
+from generation import INPUT_FIELDS, TIERS, response_cache_key, route_tier
+from history_store import HistoryStore
+from jobs import FINISHED_STATES, JobQueue, run_generation_job
+from llm_client import client_from_config
+from response_cache import ResponseCache
+
+# Download formats -> MIME type; "md" is the document as the model wrote it
+DOWNLOAD_TYPES = {'md': "text/markdown; charset=utf-8", **{fmt: mime for fmt, (_, mime) in EXPORT_FORMATS.items()}}
+
+DOWNLOAD_CHUNK = 64 * 1024
+# How often an event stream looks for new text
+STREAM_INTERVAL = 0.2
+MAX_PAGE_SIZE = 100
+
+
+class Services:
+    """The stores, caches and client one API process shares between its requests"""
+
+    def __init__(self, client, max_requests=config.SERVICE_MAX_REQUESTS):
+        self.client = client
+        # Finished jobs' documents; spilled apart from the Streamlit server's, which removes its own files
+        self.documents = DocumentStore(
+            config.DOCUMENT_STORE_MAX_BYTES,
+            os.path.join(config.DATA_DIR, "api-documents"),
+            config.DOCUMENT_STORE_HOLDER_TTL
+        )
+        self.jobs = JobQueue(config.JOB_WORKERS, config.JOB_RETENTION, self.documents)
+        self.history = HistoryStore(os.path.join(config.DATA_DIR, "history.sqlite3"))
+        self.response_cache = None
+        if config.RESPONSE_CACHE_ENABLED:
+            self.response_cache = ResponseCache(
+                os.path.join(config.DATA_DIR, "responses.sqlite3"),
+                config.RESPONSE_CACHE_TTL,
+                config.RESPONSE_CACHE_MAX_BYTES
+            )
+        self.exports = ExportCache(config.EXPORT_CACHE_MAX_ENTRIES, config.EXPORT_CACHE_MAX_BYTES,
+                                   config.EXPORT_WORKERS)
+        self.export_files = ExportFiles(os.path.join(config.DATA_DIR, "exports"), config.EXPORT_FILES_MAX_BYTES,
+                                        config.EXPORT_WORKERS)
+        self.max_requests = max_requests
+        self.active_requests = 0
+        self.rejected_requests = 0
+
+    def render_async(self, content, fmt):
+        """Future for the export's bytes, or for the path of its file when the document is large"""
+        if len(content) >= config.LARGE_DOCUMENT_CHARS:
+            return self.export_files.render_async(content, fmt, export_settings(fmt))
+        return self.exports.render_async(content, fmt, partial(render_export, content, fmt), export_settings(fmt))
+
+    def prerender(self, content):
+        """Start rendering every export of a finished document before anyone asks for it"""
+        for fmt in EXPORT_FORMATS:
+            self.render_async(content, fmt)
+
+    def stats(self):
+        return {'active_requests': self.active_requests, 'rejected_requests': self.rejected_requests}
+
+    def register_gauges(self):
+        metrics.REGISTRY.register_gauges("http", self.stats)
+        metrics.REGISTRY.register_gauges("jobs", self.jobs.stats)
+        metrics.REGISTRY.register_gauges("document_store", self.documents.stats)
+        metrics.REGISTRY.register_gauges("export_cache", self.exports.stats)
+        metrics.REGISTRY.register_gauges("export_files", self.export_files.stats)
+        metrics.REGISTRY.register_gauges("client", self.client.metrics.snapshot)
+        metrics.REGISTRY.register_gauges("admission", self.client.limiter.stats)
+        if self.response_cache is not None:
+            metrics.REGISTRY.register_gauges("response_cache", self.response_cache.stats)
+
+
+def _cached_job(job, document, data, history_store, on_document):
+    """Job body for a response cache hit: no model call, and the history entry already made for it is reused"""
+    job.stats = {'cached': True, 'total_latency': 0.0}
+    job.partial.append(document)
+    job.entry_id = history_store.find(document) or history_store.add(document, data)
+    on_document(document)
+    return document
+
+
+def _timestamp(value):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(value)) if value else None
+
+
+def job_json(job, include_document=True):
+    body = {
+        'id': job.id,
+        'status': job.status,
+        'description': job.description,
+        'created': _timestamp(job.created),
+        'started': _timestamp(job.started),
+        'finished': _timestamp(job.finished),
+        'error': job.error,
+        'stats': job.stats,
+        'entry_id': job.entry_id,
+        'partial_chars': len(job.partial_text),
+        'events': f"/v1/jobs/{job.id}/events"
+    }
+    if job.entry_id is not None:
+        body['history'] = f"/v1/history/{job.entry_id}"
+        body['exports'] = {fmt: f"/v1/history/{job.entry_id}/export/{fmt}" for fmt in DOWNLOAD_TYPES}
+    if include_document and job.result is not None:
+        body['document'] = job.result
+    return body
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    route = "unknown"
+
+    def initialize(self, services):
+        self.services = services
+        self.admitted = False
+
+    def prepare(self):
+        if self.services.active_requests >= self.services.max_requests:
+            self.services.rejected_requests += 1
+            raise tornado.web.HTTPError(503, reason="Too many requests in flight")
+        self.services.active_requests += 1
+        self.admitted = True
+
+    def on_finish(self):
+        if self.admitted:
+            self.services.active_requests -= 1
+            self.admitted = False
+
+    def on_connection_close(self):
+        # A client that went away mid-stream no longer holds a request slot
+        self.on_finish()
+
+    def write_json(self, body, status=200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.finish(json.dumps(body, default=str))
+
+    def write_error(self, status_code, **kwargs):
+        if status_code == 503:
+            self.set_header("Retry-After", "1")
+        self.write_json({'error': self._reason}, status_code)
+
+    def json_body(self):
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, reason="Request body must be a JSON object")
+        return body
+
+    def run_blocking(self, fn, *args):
+        # SQLite reads and writes stay off the event loop
+        return asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def job_or_404(self, job_id):
+        job = self.services.jobs.get(job_id)
+        if job is None:
+            raise tornado.web.HTTPError(404, reason="Unknown or expired job")
+        return job
+
+    def history(self):
+        """The history this request may use: its owner's, or all of it with a shared history"""
+        if config.HISTORY_SCOPE == "shared":
+            return self.services.history
+        owner = self.get_argument('owner', None) or self.request.headers.get('X-Client-Id')
+        if not owner:
+            raise tornado.web.HTTPError(400, reason="Name the history owner with ?owner= or an X-Client-Id header")
+        return self.services.history.for_owner(owner)
+
+    async def entry_or_404(self, entry_id):
+        entry = await self.run_blocking(self.history().get, int(entry_id))
+        if entry is None:
+            raise tornado.web.HTTPError(404, reason="No such history entry")
+        return entry
+
+
+class DocumentsHandler(BaseHandler):
+    route = "documents"
+
+    async def post(self):
+        body = self.json_body()
+        inputs = body.get('inputs')
+        if not isinstance(inputs, dict):
+            raise tornado.web.HTTPError(400, reason="'inputs' must be an object with the form fields")
+        missing = [key for key in INPUT_FIELDS if not str(inputs.get(key) or '').strip()]
+        if missing:
+            raise tornado.web.HTTPError(400, reason=f"Missing inputs: {', '.join(missing)}")
+        data = {key: str(inputs[key]) for key in INPUT_FIELDS}
+        tier = body.get('tier', config.MODEL_TIER)
+        if tier not in TIERS:
+            raise tornado.web.HTTPError(400, reason=f"'tier' must be one of {', '.join(TIERS)}")
+        tier = route_tier(tier, data)
+        parallel = body.get('parallel', config.PARALLEL_SECTIONS)
+        force = body.get('force', False)
+        for name, value in (('parallel', parallel), ('force', force)):
+            if not isinstance(value, bool):
+                raise tornado.web.HTTPError(400, reason=f"'{name}' must be true or false")
+        cache_key = response_cache_key(data, parallel, tier)
+
+        services = self.services
+        history = self.history()
+        cached = None
+        if services.response_cache is not None and not force:
+            cached = await self.run_blocking(services.response_cache.get, cache_key)
+        if cached:
+            args = (_cached_job, cached, data, history, services.prerender)
+        else:
+            args = (run_generation_job, services.client, data, parallel, config.PARALLEL_MAX_WORKERS,
+                    services.response_cache, cache_key, history, None, None, tier, services.prerender)
+        # Jobs inherit the submitting context, so this caller gets its own turn in the admission queue
+        context = contextvars.copy_context()
+        context.run(metrics.set_session, f"api:{self.request.headers.get('X-Client-Id') or self.request.remote_ip}")
+        job = context.run(services.jobs.submit, *args, description=data['negotiation_subject'])
+        self.set_header("Location", f"/v1/jobs/{job.id}")
+        self.write_json(job_json(job), 202)
+
+
+class JobHandler(BaseHandler):
+    route = "job"
+
+    def get(self, job_id):
+        self.write_json(job_json(self.job_or_404(job_id)))
+
+    def delete(self, job_id):
+        job = self.job_or_404(job_id)
+        job.cancel()
+        self.write_json(job_json(job, include_document=False))
+
+
+class JobEventsHandler(BaseHandler):
+    """Server-sent events: "text" with each new piece of the document, "refining" when a
+    draft is complete and its revision starts, then one event named after the final status
+    with the job as in GET /v1/jobs/<id>"""
+    route = "job_events"
+
+    def send_event(self, event, body):
+        self.write(f"event: {event}\ndata: {json.dumps(body, default=str)}\n\n")
+
+    async def get(self, job_id):
+        job = self.job_or_404(job_id)
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        restarts, sent = job.partial_restarts, 0
+        try:
+            while True:
+                # Read the status first so text written just before the job finished is still sent
+                finished = job.status in FINISHED_STATES
+                if job.partial_restarts != restarts:
+                    self.send_event("refining", {'draft_chars': len(job.draft or "")})
+                    restarts, sent = job.partial_restarts, 0
+                text = job.partial_text
+                if len(text) > sent:
+                    self.send_event("text", {'text': text[sent:]})
+                    sent = len(text)
+                await self.flush()
+                if finished:
+                    break
+                await asyncio.sleep(STREAM_INTERVAL)
+            self.send_event(job.status, job_json(job))
+            self.finish()
+        except StreamClosedError:
+            pass
+
+
+class HistoryHandler(BaseHandler):
+    route = "history"
+
+    async def get(self):
+        query = self.get_argument('query', None) or None
+        try:
+            offset = max(int(self.get_argument('offset', 0)), 0)
+            limit = min(max(int(self.get_argument('limit', config.HISTORY_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="'offset' and 'limit' must be integers")
+        history = self.history()
+        total = await self.run_blocking(history.count, query)
+        entries = await self.run_blocking(history.list, offset, limit, query)
+        self.write_json({
+            'total': total,
+            'offset': offset,
+            'entries': [{
+                'id': entry['id'],
+                'created': entry['timestamp'].isoformat(timespec='seconds'),
+                'subject': entry['subject'],
+                'value': entry['value'],
+                'url': f"/v1/history/{entry['id']}"
+            } for entry in entries]
+        })
+
+
+class HistoryEntryHandler(BaseHandler):
+    route = "history_entry"
+
+    async def get(self, entry_id):
+        entry = await self.entry_or_404(entry_id)
+        self.write_json({
+            'id': entry['id'],
+            'created': entry['timestamp'].isoformat(timespec='seconds'),
+            'subject': entry['metadata']['subject'],
+            'value': entry['metadata']['value'],
+            'inputs': entry['metadata']['data'],
+            'document': entry['document'],
+            'exports': {fmt: f"/v1/history/{entry['id']}/export/{fmt}" for fmt in DOWNLOAD_TYPES}
+        })
+
+
+class ExportHandler(BaseHandler):
+    route = "export"
+
+    async def render(self, document, fmt):
+        try:
+            return await asyncio.wrap_future(self.services.render_async(document, fmt))
+        except Exception as e:
+            raise tornado.web.HTTPError(500, reason=f"Rendering {fmt} failed: {type(e).__name__}")
+
+    async def get(self, entry_id, fmt):
+        if fmt not in DOWNLOAD_TYPES:
+            raise tornado.web.HTTPError(404, reason=f"Formats are {', '.join(DOWNLOAD_TYPES)}")
+        entry = await self.entry_or_404(entry_id)
+        if fmt == 'md':
+            data = entry['document'].encode('utf-8')
+        else:
+            data = await self.render(entry['document'], fmt)
+            if isinstance(data, str):
+                try:
+                    data = open(data, 'rb')
+                except FileNotFoundError:
+                    # Evicted by another process sharing the directory since; rendered again
+                    data = open(await self.render(entry['document'], fmt), 'rb')
+        self.set_header("Content-Type", DOWNLOAD_TYPES[fmt])
+        self.set_header("Content-Disposition", f'attachment; filename="{entry_folder(entry)}.{fmt}"')
+        try:
+            if not isinstance(data, bytes):
+                # A large document's export is a file; it is read a chunk at a time
+                with data as f:
+                    self.set_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+                    for chunk in iter(partial(f.read, DOWNLOAD_CHUNK), b""):
+                        self.write(chunk)
+                        await self.flush()
+            else:
+                self.set_header("Content-Length", str(len(data)))
+                view = memoryview(data)
+                # Flushing each chunk waits for the socket, so slow clients do not buffer whole files
+                for offset in range(0, len(data), DOWNLOAD_CHUNK):
+                    self.write(bytes(view[offset:offset + DOWNLOAD_CHUNK]))
+                    await self.flush()
+            self.finish()
+        except StreamClosedError:
+            pass
+
+
+class MetricsHandler(BaseHandler):
+    route = "metrics"
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(metrics.REGISTRY.prometheus_text())
+
+
+class HealthHandler(BaseHandler):
+    route = "health"
+
+    def prepare(self):
+        # Answered even when every request slot is taken
+        pass
+
+    def get(self):
+        self.write_json({'status': 'ok', 'jobs': self.services.jobs.stats()})
+
+
+def _log_request(handler):
+    request = handler.request
+    metrics.observe("http_request", request.request_time(), route=getattr(handler, 'route', 'unknown'),
+                    method=request.method, status=handler.get_status())
+
+
+def make_app(services):
+    routes = [
+        (r"/v1/documents", DocumentsHandler),
+        (r"/v1/jobs/([0-9a-f]+)", JobHandler),
+        (r"/v1/jobs/([0-9a-f]+)/events", JobEventsHandler),
+        (r"/v1/history", HistoryHandler),
+        (r"/v1/history/([0-9]+)", HistoryEntryHandler),
+        (r"/v1/history/([0-9]+)/export/(\w+)", ExportHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/healthz", HealthHandler),
+    ]
+    return tornado.web.Application([(pattern, handler, {'services': services}) for pattern, handler in routes],
+                                   log_function=_log_request)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve BATNA generation and exports over HTTP")
+    parser.add_argument("--host", default=config.SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVICE_PORT)
+    parser.add_argument("--max-requests", type=int, default=config.SERVICE_MAX_REQUESTS,
+                        help="requests handled at once; more are answered 503")
+    parser.add_argument("--keep-alive", type=float, default=config.SERVICE_KEEP_ALIVE,
+                        help="seconds an idle connection is kept open")
+    parser.add_argument("--mock", action="store_true", help="answer from a local mock of the Anthropic API")
+    parser.add_argument("--mock-latency", type=float, default=0.0, help="mock delay before the first token")
+    parser.add_argument("--mock-tokens-per-second", type=float, default=0.0, help="mock output pacing")
+    return parser.parse_args(argv)
+
+
+async def serve(args):
+    mock = None
+    if args.mock:
+        from mock_anthropic import MockAnthropicServer
+
+        mock = MockAnthropicServer(latency=args.mock_latency, tokens_per_second=args.mock_tokens_per_second).start()
+        client = client_from_config("mock", base_url=mock.base_url)
+    else:
+        api_key = os.environ.get("ANTHROPIC_API_KEY")
+        if not api_key:
+            print("ANTHROPIC_API_KEY is not set (or use --mock)", file=sys.stderr)
+            return 2
+        client = client_from_config(api_key)
+    metrics.configure(config.METRICS_LOG_FILE, config.METRICS_PROMETHEUS_FILE, config.METRICS_PORT)
+    services = Services(client, args.max_requests)
+    services.register_gauges()
+    load_backends()
+
+    server = make_app(services).listen(args.port, args.host, idle_connection_timeout=args.keep_alive)
+    print(f"BATNA HTTP API listening on http://{args.host}:{args.port}"
+          + (f" (mock model at {mock.base_url})" if mock else ""), file=sys.stderr)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+        client.close()
+        if mock is not None:
+            mock.stop()
+
+
+def main(argv=None):
+    try:
+        return asyncio.run(serve(parse_args(argv)))
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+import contextvars
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from generation import (
+    DRAFT_MODEL, MODEL, generate_document, generate_sections_parallel, refine_document, response_cache_key
+)
+from scenarios import DONE as VARIANT_DONE, generate_variants
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """A unit of background work with status, partial output and a cancel flag.
+
+    With a document_store (see document_store.DocumentStore) the result,
+    draft and, once the job has finished, its partial text are kept there
+    under the job's id, so a finished job holds only their hashes and
+    identical texts are stored once with the sessions showing them.
+    """
+
+    def __init__(self, description="", document_store=None):
+        self.id = uuid.uuid4().hex
+        self.description = description
+        self.status = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stats = None
+        self.error = None
+        self.exception = None
+        self.entry_id = None
+        # Scenario states (see scenarios.new_variant) while a comparison is generated
+        self.variants = None
+        # Text produced so far, appended by the worker and read by the UI when polling
+        self.partial = []
+        # Bumped when partial starts over, e.g. when refining a draft begins
+        self.partial_restarts = 0
+        self.future = None
+        self._store = document_store
+        # slot -> text, or its digest in the document store
+        self._texts = {}
+        self._cancel = threading.Event()
+
+    def _get_text(self, slot):
+        value = self._texts.get(slot)
+        if self._store is None or value is None:
+            return value
+        return self._store.get(value)
+
+    def _set_text(self, slot, text):
+        if self._store is not None and isinstance(text, str):
+            self._texts[slot] = self._store.assign(self.id, slot, text)
+        else:
+            self._texts[slot] = text
+
+    @property
+    def result(self):
+        return self._get_text('result')
+
+    @result.setter
+    def result(self, value):
+        self._set_text('result', value)
+
+    @property
+    def draft(self):
+        """Fast draft shown while the "refine" tier revises it"""
+        return self._get_text('draft')
+
+    @draft.setter
+    def draft(self, value):
+        self._set_text('draft', value)
+
+    @property
+    def partial_text(self):
+        if 'partial' in self._texts:
+            return self._get_text('partial') or ""
+        return "".join(self.partial)
+
+    def restart_partial(self):
+        self.partial = []
+        self.partial_restarts += 1
+
+    def keep_partial(self):
+        """Move the partial text into the document store once nothing is appended to it any more"""
+        if self._store is not None and self.partial:
+            self._set_text('partial', "".join(self.partial))
+            self.partial = []
+
+    def release(self):
+        """Drop this job's texts from the document store"""
+        if self._store is not None:
+            self._store.release_holder(self.id)
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def cancel(self):
+        """Cancel a queued job outright, or ask a running one to stop at its next checkpoint"""
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            self.status = CANCELLED
+            self.finished = time.time()
+
+
+class JobQueue:
+    """Process-wide worker pool running jobs off the Streamlit script threads"""
+
+    def __init__(self, max_workers=4, retention=3600, document_store=None):
+        self.retention = retention
+        self.document_store = document_store
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batna-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, description=""):
+        """Queue fn(job, *args); its return value becomes job.result"""
+        job = Job(description, self.document_store)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        # Run in a copy of the caller's context so metrics stay attributed to its session
+        job.future = self._pool.submit(contextvars.copy_context().run, self._run, job, fn, args)
+        return job
+
+    def _run(self, job, fn, args):
+        if job.cancel_requested:
+            job.status = CANCELLED
+            job.finished = time.time()
+            return
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            job.result = fn(job, *args)
+            job.status = DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            job.error = str(e)
+            job.exception = e
+            job.status = FAILED
+        job.keep_partial()
+        job.finished = time.time()
+
+    def _prune(self):
+        # Forget finished jobs nobody has picked up within the retention window
+        cutoff = time.time() - self.retention
+        stale = [job_id for job_id, job in self._jobs.items()
+                 if job.status in FINISHED_STATES and (job.finished or 0) < cutoff]
+        for job_id in stale:
+            self._jobs.pop(job_id).release()
+        if self.document_store is not None:
+            # Keep the texts of retained jobs from being swept as idle holders
+            for job_id in self._jobs:
+                self.document_store.touch(job_id)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            counts = {state: 0 for state in (QUEUED, RUNNING) + FINISHED_STATES}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return counts
+
+
+def run_generation_job(job, client, data, parallel, max_workers, response_cache, cache_key, history_store,
+                       reuse=None, references=None, tier="quality", on_document=None):
+    """Job body: generate a document, then cache it and add it to history.
+
+    With reuse (section number -> text) only the remaining sections are
+    generated, using references (section number -> text) as drafts. With the
+    "refine" tier a draft is written first and published as job.draft while
+    it is revised; if the revision fails the draft is kept as the result.
+    on_document(document) is called with the finished document, e.g. to
+    start rendering its exports before anyone asks for them.
+    """
+
+    def on_text(delta):
+        job.check_cancelled()
+        job.partial.append(delta)
+
+    def on_section(number, text):
+        job.check_cancelled()
+        job.partial.append(f"{text}\n\n---\n\n")
+
+    # Only a complete document is drafted and refined; reused sections are completed by MODEL
+    refine = tier == "refine" and reuse is None
+    model = DRAFT_MODEL if tier == "draft" or refine else MODEL
+    if parallel or reuse is not None:
+        document, stats = generate_sections_parallel(client, data, max_workers, on_section, reuse, references, model)
+    else:
+        document, stats = generate_document(client, data, on_text, max_workers, model)
+
+    if refine:
+        job.check_cancelled()
+        job.draft = document
+        job.restart_partial()
+        try:
+            document, stats = refine_document(client, data, document, stats, max_workers, on_section)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            stats = dict(stats, refine_error=str(e))
+            response_cache = None
+    job.stats = stats
+
+    if response_cache is not None:
+        response_cache.put(cache_key, document)
+    job.entry_id = history_store.add(document, data)
+    if on_document is not None:
+        on_document(document)
+    return document
+
+
+def run_scenario_job(job, client, base_data, variants, max_concurrency, max_workers, tier, response_cache,
+                     history_store):
+    """Job body: generate scenario variants of base_data concurrently for a side-by-side comparison.
+
+    variants (see scenarios.new_variant) are published as job.variants and
+    filled in as they finish; each finished one is cached and added to
+    history like a single document. job.stats has the wall time next to the
+    sum of the variants' own generation times.
+    """
+    model = DRAFT_MODEL if tier == "draft" else MODEL
+    job.variants = variants
+
+    def on_text(delta):
+        job.check_cancelled()
+
+    def generate(variant, data):
+        cache_key = response_cache_key(data, False, tier, variant['temperature'])
+        document = response_cache.get(cache_key) if response_cache is not None else None
+        entry_id = None
+        if document:
+            stats = {'cached': True, 'model': model, 'total_latency': 0.0}
+            entry_id = history_store.find(document)
+        else:
+            document, stats = generate_document(client, data, on_text, max_workers, model, variant['temperature'])
+            if response_cache is not None:
+                response_cache.put(cache_key, document)
+        variant['entry_id'] = entry_id or history_store.add(document, data)
+        return document, stats
+
+    wall = generate_variants(client, base_data, variants, max_concurrency, model, generate)
+    # The documents are read back from history by entry_id
+    for variant in variants:
+        variant['document'] = None
+    job.check_cancelled()
+    done = [variant for variant in variants if variant['status'] == VARIANT_DONE]
+    if not done:
+        raise RuntimeError(variants[0]['error'] if variants else "No scenarios to generate")
+    job.stats = {
+        'model': model,
+        'wall_seconds': wall,
+        'sum_seconds': sum(variant['stats']['total_latency'] for variant in done),
+        'output_tokens': sum(variant['stats'].get('output_tokens', 0) for variant in done),
+        'cost_usd': sum(variant['stats'].get('cost_usd', 0.0) for variant in done)
+    }
+    return variants
@@ -0,0 +1,208 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import anthropic
+import httpx
+
+import config
+from rate_limit import AdmissionController
+from token_budget import estimate_tokens
+
+# Status codes worth retrying: rate limited, overloaded (529) and transient server errors
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class ClientMetrics:
+    """Counters for requests, retries and connection reuse of one pooled client"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.retries = 0
+        self.failures = 0
+        self.retry_wait = 0.0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def snapshot(self):
+        with self._lock:
+            reused = max(self.requests - self.connections_opened, 0)
+            return {
+                'requests': self.requests,
+                'connections_opened': self.connections_opened,
+                'connection_reuse_ratio': reused / self.requests if self.requests else 0.0,
+                'retries': self.retries,
+                'failures': self.failures,
+                'retry_wait_seconds': round(self.retry_wait, 3)
+            }
+
+
+def _retry_after(error):
+    """Seconds the server asked us to wait, if it sent a retry-after header"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after')
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _request_cost(kwargs):
+    """Tokens to reserve for a request: its estimated prompt plus the whole output allowance"""
+    system = kwargs.get('system') or ""
+    parts = [system] if isinstance(system, str) else [block.get('text', "") for block in system]
+    for message in kwargs.get('messages', []):
+        content = message.get('content', "")
+        parts.extend([content] if isinstance(content, str) else [block.get('text', "") for block in content])
+    return sum(estimate_tokens(part) for part in parts) + kwargs.get('max_tokens', 0)
+
+
+def _used_tokens(message):
+    """Tokens the API counted for a finished message, or None if it did not report usage"""
+    usage = getattr(message, 'usage', None)
+    if usage is None:
+        return None
+    return (usage.input_tokens + usage.output_tokens + (getattr(usage, 'cache_creation_input_tokens', 0) or 0)
+            + (getattr(usage, 'cache_read_input_tokens', 0) or 0))
+
+
+def _is_retryable(error):
+    if isinstance(error, (anthropic.APIConnectionError, anthropic.APITimeoutError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS
+    return False
+
+
+class RetryingMessages:
+    """Drop-in for client.messages that retries failed requests with jittered backoff.
+
+    A retry-after sent by the API is waited out in full, but no retry starts
+    later than retry_deadline seconds after the first attempt: if the wait
+    does not fit, the error is raised straight away. With a limiter every
+    attempt waits for admission first and holds its ticket until the
+    response is complete.
+    """
+
+    def __init__(self, messages, metrics, max_retries, backoff_base, backoff_max, limiter=None,
+                 retry_deadline=120.0):
+        self._messages = messages
+        self._metrics = metrics
+        self._limiter = limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_deadline = retry_deadline
+
+    def _call(self, fn, cost):
+        """(fn's result, admission ticket or None)"""
+        attempt = 0
+        deadline = time.monotonic() + self.retry_deadline
+        while True:
+            ticket = self._limiter.acquire(cost) if self._limiter else None
+            try:
+                return fn(), ticket
+            except Exception as e:
+                if ticket is not None:
+                    ticket.release()
+                    if isinstance(e, anthropic.RateLimitError):
+                        # Hold everyone back, not just this request
+                        self._limiter.pause(_retry_after(e) or self.backoff_base)
+                # Full jitter exponential backoff unless the server told us how long to wait
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if (attempt >= self.max_retries or not _is_retryable(e)
+                        or time.monotonic() + delay > deadline):
+                    self._metrics.incr('failures')
+                    raise
+                self._metrics.incr('retries')
+                self._metrics.incr('retry_wait', delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def create(self, **kwargs):
+        message, ticket = self._call(lambda: self._messages.create(**kwargs), _request_cost(kwargs))
+        if ticket is not None:
+            ticket.release(_used_tokens(message))
+        return message
+
+    @contextmanager
+    def stream(self, **kwargs):
+        # Only opening the stream is retried; a failure after tokens arrived is surfaced
+        stream, ticket = self._call(lambda: self._messages.stream(**kwargs).__enter__(), _request_cost(kwargs))
+        try:
+            yield stream
+        finally:
+            stream.close()
+            if ticket is not None:
+                try:
+                    snapshot = stream.current_message_snapshot
+                except AssertionError:
+                    # Closed before the message started
+                    snapshot = None
+                ticket.release(_used_tokens(snapshot))
+
+
+class PooledClient:
+    """One Anthropic client per process sharing a keep-alive connection pool"""
+
+    def __init__(self, api_key, base_url=None, timeout=120.0, connect_timeout=10.0,
+                 max_connections=20, max_retries=4, backoff_base=1.0, backoff_max=30.0, limiter=None,
+                 retry_deadline=120.0):
+        self.metrics = ClientMetrics()
+        self.limiter = limiter
+        self.http_client = httpx.Client(
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            event_hooks={'request': [self._trace_request]}
+        )
+        # Retries are handled by RetryingMessages so they can be counted and honour retry-after
+        self.client = anthropic.Anthropic(
+            api_key=api_key,
+            base_url=base_url or None,
+            http_client=self.http_client,
+            max_retries=0
+        )
+        self.messages = RetryingMessages(
+            self.client.messages, self.metrics, max_retries, backoff_base, backoff_max, limiter, retry_deadline
+        )
+
+    def _trace_request(self, request):
+        self.metrics.incr('requests')
+        request.extensions['trace'] = self._trace_event
+
+    def _trace_event(self, name, info):
+        if name == 'connection.connect_tcp.started':
+            self.metrics.incr('connections_opened')
+
+    def close(self):
+        self.http_client.close()
+
+
+def client_from_config(api_key, base_url=None):
+    """Build a pooled client from the connection and rate limit settings in config"""
+    return PooledClient(
+        api_key,
+        base_url=base_url or config.ANTHROPIC_BASE_URL,
+        timeout=config.API_TIMEOUT,
+        connect_timeout=config.API_CONNECT_TIMEOUT,
+        max_connections=config.API_MAX_CONNECTIONS,
+        max_retries=config.API_MAX_RETRIES,
+        backoff_base=config.API_BACKOFF_BASE,
+        backoff_max=config.API_BACKOFF_MAX,
+        retry_deadline=config.API_RETRY_DEADLINE,
+        limiter=AdmissionController(
+            config.API_REQUESTS_PER_MINUTE,
+            config.API_TOKENS_PER_MINUTE,
+            config.API_MAX_CONCURRENCY,
+            config.API_MAX_QUEUE_WAIT
+        )
+    )
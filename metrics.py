@@ -0,0 +1,264 @@
+"""Process-wide timing and token instrumentation.
+
+Stages are timed with observe() or the timed() context manager and counted
+with incr(). Every observation is also emitted as a JSON log line on the
+"batna.metrics" logger. prometheus_text() renders everything in the
+Prometheus text format, which configure() can write to a file and/or serve
+over HTTP at /metrics.
+"""
+import contextvars
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUANTILES = (0.5, 0.9, 0.99)
+MAX_SAMPLES = 2000
+MAX_SESSIONS = 1000
+
+logger = logging.getLogger("batna.metrics")
+
+# Streamlit session the current thread is working for, used to attribute samples
+current_session = contextvars.ContextVar("batna_session", default=None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:12]
+
+
+def set_session(session_id):
+    current_session.set(session_id)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _labels_text(pairs):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(q * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class Metrics:
+    """Thread-safe registry of stage timings, counters and per-session totals"""
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=max_samples))
+        self._counts = Counter()
+        self._sums = Counter()
+        self._counters = Counter()
+        self._sessions = OrderedDict()
+        self._gauge_providers = {}
+
+    def observe(self, stage, seconds, **labels):
+        """Record one duration for a stage"""
+        key = (stage, _label_key(labels))
+        session = current_session.get()
+        with self._lock:
+            self._samples[key].append(seconds)
+            self._counts[key] += 1
+            self._sums[key] += seconds
+            if session is not None:
+                totals = self._session_totals(session)
+                totals[f"{stage}_seconds"] = totals.get(f"{stage}_seconds", 0.0) + seconds
+                totals[f"{stage}_count"] = totals.get(f"{stage}_count", 0) + 1
+        self.log(stage, seconds=round(seconds, 6), **labels)
+
+    def incr(self, name, amount=1, **labels):
+        session = current_session.get()
+        with self._lock:
+            self._counters[(name, _label_key(labels))] += amount
+            if session is not None:
+                totals = self._session_totals(session)
+                totals[name] = totals.get(name, 0) + amount
+
+    def _session_totals(self, session):
+        totals = self._sessions.get(session)
+        if totals is None:
+            totals = self._sessions[session] = {}
+            while len(self._sessions) > MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session)
+        return totals
+
+    @contextmanager
+    def timed(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def log(self, event, **fields):
+        if logger.isEnabledFor(logging.INFO):
+            record = {'ts': round(time.time(), 3), 'event': event, 'session': current_session.get()}
+            record.update(fields)
+            logger.info(json.dumps(record, default=str))
+
+    def register_gauges(self, name, provider):
+        """provider() returns {key: number}, exported as gauges named <name>_<key>"""
+        with self._lock:
+            self._gauge_providers[name] = provider
+
+    def gauges(self):
+        with self._lock:
+            providers = list(self._gauge_providers.items())
+        values = {}
+        for name, provider in providers:
+            try:
+                values.update((f"{name}_{key}", value) for key, value in provider().items())
+            except Exception as e:
+                logger.warning("Gauge provider failed: %s", e)
+        return values
+
+    def summary(self):
+        """Per stage and label set: count, mean and percentiles in seconds"""
+        rows = []
+        for (stage, labels), values, count, total in self._snapshot():
+            row = {'stage': stage, 'labels': ", ".join(f"{k}={v}" for k, v in labels), 'count': count,
+                   'mean': total / count if count else 0.0}
+            for q in QUANTILES:
+                row[f"p{int(q * 100)}"] = _percentile(values, q)
+            rows.append(row)
+        return rows
+
+    def counters(self):
+        with self._lock:
+            return {(name, labels): value for (name, labels), value in self._counters.items()}
+
+    def total(self, name):
+        """Sum of a counter over all its label sets"""
+        with self._lock:
+            return sum(value for (counter_name, _), value in self._counters.items() if counter_name == name)
+
+    def session_summary(self, session):
+        with self._lock:
+            return dict(self._sessions.get(session, {}))
+
+    def prometheus_text(self):
+        lines = ["# TYPE batna_stage_seconds summary"]
+        for (stage, labels), values, count, total in self._snapshot():
+            base = (('stage', stage),) + labels
+            for q in QUANTILES:
+                lines.append(f"batna_stage_seconds{_labels_text(base + (('quantile', q),))} {_percentile(values, q):.6f}")
+            lines.append(f"batna_stage_seconds_count{_labels_text(base)} {count}")
+            lines.append(f"batna_stage_seconds_sum{_labels_text(base)} {total:.6f}")
+
+        counters = self.counters()
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE batna_{name} counter")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f"batna_{name}{_labels_text(labels)} {value}")
+
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE batna_{name} gauge")
+            lines.append(f"batna_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted((key, sorted(samples), self._counts[key], self._sums[key])
+                          for key, samples in self._samples.items())
+
+
+# The registry every module records into
+REGISTRY = Metrics()
+observe = REGISTRY.observe
+incr = REGISTRY.incr
+timed = REGISTRY.timed
+
+
+def record_api_call(stats, mode):
+    """Record latency, tokens and stop reason of one model call from its stats dict"""
+    labels = {'model': stats['model'], 'mode': mode}
+    observe("api_call", stats['total_latency'], **labels)
+    if stats.get('time_to_first_token') is not None:
+        observe("time_to_first_token", stats['time_to_first_token'], **labels)
+    incr("input_tokens_total", stats.get('input_tokens', 0), model=stats['model'])
+    incr("output_tokens_total", stats.get('output_tokens', 0), model=stats['model'])
+    incr("cache_read_input_tokens_total", stats.get('cache_read_input_tokens', 0), model=stats['model'])
+    incr("cache_creation_input_tokens_total", stats.get('cache_creation_input_tokens', 0), model=stats['model'])
+    incr("cost_usd_total", stats.get('cost_usd', 0.0), model=stats['model'])
+    incr("api_requests_total", 1, model=stats['model'], stop_reason=stats.get('stop_reason'))
+    REGISTRY.log("api_call_detail", **stats)
+
+
+def process_memory():
+    """Resident and peak resident memory of this process in bytes"""
+    values = {'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    try:
+        with open("/proc/self/statm") as f:
+            values['rss_bytes'] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    return values
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_configure_lock = threading.Lock()
+_state = {'configured': False, 'file': None, 'last_write': 0.0}
+
+
+def configure(log_file=None, prometheus_file=None, port=0, log_to_stderr=True):
+    """Set up JSON log output, the Prometheus file and the /metrics endpoint once per process"""
+    with _configure_lock:
+        if _state['configured']:
+            return
+        _state['configured'] = True
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        if log_file:
+            os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+            logger.addHandler(logging.FileHandler(log_file, encoding='utf-8'))
+        elif log_to_stderr:
+            logger.addHandler(logging.StreamHandler())
+        if prometheus_file:
+            os.makedirs(os.path.dirname(os.path.abspath(prometheus_file)), exist_ok=True)
+        _state['file'] = prometheus_file
+        if port:
+            server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True, name="batna-metrics").start()
+
+
+def write_prometheus_file(min_interval=5.0):
+    """Rewrite the configured Prometheus file, at most once every min_interval seconds"""
+    path = _state['file']
+    now = time.time()
+    if not path or now - _state['last_write'] < min_interval:
+        return
+    _state['last_write'] = now
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(REGISTRY.prometheus_text())
+    os.replace(tmp_path, path)
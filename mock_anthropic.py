@@ -0,0 +1,327 @@
+"""Local stand-in for the Anthropic Messages API.
+
+Run it and point the app at it:
+
+    python mock_anthropic.py --port 8765 --latency 1.5 --tokens-per-second 40 --pages 8
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 streamlit run app.py
+
+--latency delays the first token and --tokens-per-second paces the rest, so
+timings resemble a real model without spending API credits.
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from generation import SECTION_TITLES
+
+LOREM = (
+    "The client should weigh the cost of switching suppliers against the leverage gained "
+    "from a credible alternative, keeping delivery risk and contract terms in view."
+)
+
+
+_SECTION_REQUEST_RE = re.compile(r'Write only section (\d)\.')
+
+# Shortest prefix the API caches for Opus and Sonnet, in tokens
+MIN_CACHEABLE_TOKENS = 1024
+MAX_CACHE_BREAKPOINTS = 4
+
+
+def sample_section(number, paragraphs=2):
+    """One BATNA-shaped markdown section, with a table where the template asks for one"""
+    parts = [f"## {number}. {SECTION_TITLES[number - 1]}"]
+    if number in (2, 3, 4):
+        parts.append(
+            "| Alternative Options | Strength Assessment | Risk Assessment |\n"
+            "|---|---|---|\n"
+            "| Competing vendor | Strong | Medium |\n"
+            "| In-house delivery | Medium | High |"
+        )
+    parts.extend([LOREM] * paragraphs)
+    parts.append("---")
+    return "\n\n".join(parts)
+
+
+def sample_document(paragraphs_per_section=2):
+    """A BATNA-shaped markdown document with all seven sections"""
+    return "\n\n".join(
+        sample_section(number, paragraphs_per_section) for number in range(1, len(SECTION_TITLES) + 1)
+    )
+
+
+def document_for_pages(pages):
+    """A sample document of roughly the given number of printed pages (~3000 characters each)"""
+    paragraphs = max(1, round(pages * 3000 / (len(LOREM) + 2) / len(SECTION_TITLES)))
+    return sample_document(paragraphs)
+
+
+def _message_text(message):
+    content = message.get('content', '')
+    if isinstance(content, list):
+        content = " ".join(block.get('text', '') for block in content)
+    return content
+
+
+def _blocks(content):
+    if isinstance(content, str):
+        return [{'type': 'text', 'text': content}]
+    return list(content or [])
+
+
+def _prompt_blocks(request):
+    """System then message content blocks, in the order the API reads them for caching"""
+    blocks = _blocks(request.get('system'))
+    for message in request.get('messages', []):
+        blocks.extend(_blocks(message.get('content')))
+    return blocks
+
+
+def _estimate_tokens(blocks):
+    return max(sum(len(block.get('text', '')) for block in blocks) // 4, 1)
+
+
+class MockAnthropicServer:
+    """Threaded HTTP server answering /v1/messages with a canned response"""
+
+    def __init__(self, host="127.0.0.1", port=0, response_text=None, fail_first=0,
+                 fail_status=529, retry_after=None, latency=0.0, tokens_per_second=0.0, max_concurrent=0):
+        self.response_text = response_text or sample_document()
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.retry_after = retry_after
+        # Like an organisation concurrency limit: requests beyond it get 429
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.rate_limited = 0
+        self.requests = []
+        # Prompt prefixes written to the simulated cache, keyed by their serialized blocks
+        self.prompt_cache = set()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def cache_usage(self, request, headers):
+        """Validate cache_control use like the API does and simulate cache reads and writes.
+
+        Returns (error message or None, {'input_tokens', 'cache_creation_input_tokens',
+        'cache_read_input_tokens'}).
+        """
+        blocks = _prompt_blocks(request)
+        total = _estimate_tokens(blocks)
+        breakpoints = [index for index, block in enumerate(blocks) if 'cache_control' in block]
+        if not breakpoints:
+            return None, {'input_tokens': total}
+        if "prompt-caching" not in headers.get('anthropic-beta', ''):
+            return "cache_control requires the prompt-caching beta header", None
+        if len(breakpoints) > MAX_CACHE_BREAKPOINTS:
+            return f"A maximum of {MAX_CACHE_BREAKPOINTS} blocks with cache_control may be provided", None
+        if any(block['cache_control'] != {'type': 'ephemeral'} for block in blocks if 'cache_control' in block):
+            return "cache_control.type must be 'ephemeral'", None
+
+        read = written = 0
+        with self._lock:
+            for index in breakpoints:
+                prefix = blocks[:index + 1]
+                tokens = _estimate_tokens(prefix)
+                if tokens < MIN_CACHEABLE_TOKENS:
+                    continue
+                key = json.dumps([(block.get('type'), block.get('text')) for block in prefix])
+                if key in self.prompt_cache:
+                    read = tokens
+                else:
+                    self.prompt_cache.add(key)
+                    written = tokens - read
+        return None, {
+            'input_tokens': max(total - read - written, 1),
+            'cache_creation_input_tokens': written,
+            'cache_read_input_tokens': read
+        }
+
+    def _enter(self):
+        """Count a request in flight; False when it is over max_concurrent"""
+        with self._lock:
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                self.rate_limited += 1
+                return False
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def _leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _should_fail(self):
+        with self._lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                return True
+            return False
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, payload, headers=None):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_event(self, name, payload):
+                # Chunked encoding keeps the connection reusable after the stream ends
+                data = f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode('utf-8')
+                self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                with server._lock:
+                    server.requests.append({'path': self.path, 'headers': dict(self.headers), 'body': request})
+
+                if self.path.rstrip('/') != "/v1/messages":
+                    self._send_json(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': self.path}})
+                    return
+                if not server._enter():
+                    self._send_json(429, {
+                        'type': 'error',
+                        'error': {'type': 'rate_limit_error', 'message': 'Too many concurrent requests'}
+                    }, {'retry-after': "1"})
+                    return
+                try:
+                    self._respond(request)
+                finally:
+                    server._leave()
+
+            def _respond(self, request):
+                if server._should_fail():
+                    headers = {'retry-after': str(server.retry_after)} if server.retry_after is not None else None
+                    self._send_json(server.fail_status, {
+                        'type': 'error',
+                        'error': {'type': 'overloaded_error', 'message': 'Overloaded'}
+                    }, headers)
+                    return
+
+                error, usage = server.cache_usage(request, {k.lower(): v for k, v in self.headers.items()})
+                if error:
+                    self._send_json(400, {'type': 'error', 'error': {'type': 'invalid_request_error', 'message': error}})
+                    return
+
+                # Requests for a single section get just that section
+                messages = request.get('messages') or [{}]
+                text = server.response_text
+                match = _SECTION_REQUEST_RE.search(_message_text(messages[0]))
+                if match:
+                    text = sample_section(int(match.group(1)))
+                # A prefilled assistant turn is continued from where it ends
+                if messages[-1].get('role') == 'assistant':
+                    prefill = _message_text(messages[-1])
+                    text = text[len(prefill):] if text.startswith(prefill) else text
+                # About four characters per token; longer replies are cut at max_tokens
+                stop_reason = 'end_turn'
+                max_chars = request.get('max_tokens', 4096) * 4
+                if len(text) > max_chars:
+                    text, stop_reason = text[:max_chars], 'max_tokens'
+                output_tokens = max(len(text) // 4, 1)
+                message = {
+                    'id': 'msg_mock', 'type': 'message', 'role': 'assistant',
+                    'model': request.get('model', 'mock'),
+                    'content': [{'type': 'text', 'text': text}],
+                    'stop_reason': stop_reason, 'stop_sequence': None,
+                    'usage': dict(usage, output_tokens=output_tokens)
+                }
+                # Each streamed chunk is 64 characters, roughly 16 tokens
+                chunk_delay = 16 / server.tokens_per_second if server.tokens_per_second else 0.0
+                time.sleep(server.latency)
+                if not request.get('stream'):
+                    time.sleep(chunk_delay * (len(text) // 64))
+                    self._send_json(200, message)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                start = dict(message, content=[], stop_reason=None,
+                             usage=dict(usage, output_tokens=1))
+                self._send_event('message_start', {'type': 'message_start', 'message': start})
+                self._send_event('content_block_start', {
+                    'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}
+                })
+                for i in range(0, len(text), 64):
+                    if i and chunk_delay:
+                        time.sleep(chunk_delay)
+                    self._send_event('content_block_delta', {
+                        'type': 'content_block_delta', 'index': 0,
+                        'delta': {'type': 'text_delta', 'text': text[i:i + 64]}
+                    })
+                self._send_event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+                self._send_event('message_delta', {
+                    'type': 'message_delta',
+                    'delta': {'stop_reason': stop_reason, 'stop_sequence': None},
+                    'usage': {'output_tokens': output_tokens}
+                })
+                self._send_event('message_stop', {'type': 'message_stop'})
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Anthropic Messages API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fail-first", type=int, default=0, help="answer the first N requests with --fail-status")
+    parser.add_argument("--fail-status", type=int, default=529)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="output pacing (0 = as fast as possible)")
+    parser.add_argument("--max-concurrent", type=int, default=0, help="answer 429 above this many requests in flight")
+    parser.add_argument("--pages", type=float, default=None, help="length of the canned document in pages")
+    args = parser.parse_args()
+
+    response_text = document_for_pages(args.pages) if args.pages else None
+    server = MockAnthropicServer(args.host, args.port, response_text=response_text,
+                                 fail_first=args.fail_first, fail_status=args.fail_status,
+                                 retry_after=args.retry_after, latency=args.latency,
+                                 tokens_per_second=args.tokens_per_second, max_concurrent=args.max_concurrent)
+    print(f"Mock Anthropic API listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
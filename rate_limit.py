@@ -0,0 +1,193 @@
+"""Process-wide admission control for model calls.
+
+Every request first takes a ticket from the AdmissionController. A ticket is
+granted when a concurrency slot is free and the requests-per-minute and
+tokens-per-minute buckets can pay for it. Waiting tickets are served round
+robin across sessions, so one user's parallel sections cannot starve
+everyone else. A 429 pauses all admissions for the retry-after interval
+instead of letting each session hammer the API on its own.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import REGISTRY, current_session
+
+ANONYMOUS = "anonymous"
+
+
+class AdmissionTimeout(Exception):
+    """Raised when a request waited longer than the controller's max_wait"""
+
+
+class TokenBucket:
+    """Continuously refilled bucket holding at most one minute's allowance"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount can be taken; requests above capacity wait for a full bucket"""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+    def drain(self):
+        self.level = min(self.level, 0.0)
+
+
+class Ticket:
+    """Permission to send one request; release it when the response is complete"""
+
+    def __init__(self, controller, session, cost):
+        self.controller = controller
+        self.session = session
+        self.cost = cost
+        self.queued = time.monotonic()
+        self.granted = False
+        self.released = False
+
+    def release(self, used_tokens=None):
+        """Free the concurrency slot and return tokens that were reserved but not used"""
+        self.controller._release(self, used_tokens)
+
+
+class AdmissionController:
+    """Token-bucket limits, a concurrency cap and a fair queue shared by all sessions.
+
+    A limit of 0 disables it. Tickets are granted in round-robin order of the
+    sessions waiting, oldest ticket first within a session.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, max_concurrency=0, max_wait=300.0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self._active = 0
+        self._paused_until = 0.0
+        self._stats = {'admitted': 0, 'timeouts': 0, 'wait_seconds': 0.0, 'pauses': 0}
+
+    def acquire(self, cost=0, session=None):
+        """Block until a request costing cost tokens may be sent and return its Ticket"""
+        session = session or current_session.get() or ANONYMOUS
+        ticket = Ticket(self, session, cost)
+        with self._cond:
+            self._queues.setdefault(session, deque()).append(ticket)
+            deadline = ticket.queued + self.max_wait if self.max_wait else None
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._grant_delay(ticket, now)
+                    if delay == 0.0:
+                        break
+                    if deadline is not None and now >= deadline:
+                        self._stats['timeouts'] += 1
+                        raise AdmissionTimeout(
+                            f"The API is busy: no capacity became free within {self.max_wait:g}s "
+                            f"({self._waiting() - 1} other requests queued). Your inputs are kept, "
+                            f"please try again shortly."
+                        )
+                    if deadline is not None:
+                        delay = min(delay if delay is not None else deadline - now, deadline - now)
+                    self._cond.wait(delay)
+            finally:
+                self._dequeue(ticket)
+                self._cond.notify_all()
+            self._admit(ticket, now)
+        waited = now - ticket.queued
+        REGISTRY.observe("admission_wait", waited)
+        return ticket
+
+    def _grant_delay(self, ticket, now):
+        """0 when ticket may go now, else seconds to wait (None: until notified)"""
+        head = next(iter(self._queues))
+        if self._queues[head][0] is not ticket:
+            return None
+        if self.max_concurrency and self._active >= self.max_concurrency:
+            return None
+        delays = [max(self._paused_until - now, 0.0)]
+        if self.requests:
+            delays.append(self.requests.wait_time(1, now))
+        if self.tokens:
+            delays.append(self.tokens.wait_time(ticket.cost, now))
+        return max(delays)
+
+    def _dequeue(self, ticket):
+        queue = self._queues[ticket.session]
+        queue.remove(ticket)
+        del self._queues[ticket.session]
+        if queue:
+            # The session goes to the back of the line with its remaining tickets
+            self._queues[ticket.session] = queue
+
+    def _admit(self, ticket, now):
+        ticket.granted = True
+        self._active += 1
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(ticket.cost)
+        self._stats['admitted'] += 1
+        self._stats['wait_seconds'] += now - ticket.queued
+
+    def _release(self, ticket, used_tokens):
+        with self._cond:
+            if ticket.released or not ticket.granted:
+                return
+            ticket.released = True
+            self._active -= 1
+            if self.tokens and used_tokens is not None and used_tokens < ticket.cost:
+                self.tokens.refund(ticket.cost - used_tokens)
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        """Hold every admission for seconds, e.g. after the API answered 429"""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            # The API says we are over the limit, whatever the buckets think
+            if self.requests:
+                self.requests.drain()
+            self._stats['pauses'] += 1
+        REGISTRY.incr("admission_pauses_total")
+
+    def _waiting(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def position(self, session):
+        """1-based place of the session's next ticket in the grant order, or None if it is not waiting"""
+        with self._cond:
+            queues = [list(queue) for queue in self._queues.values()]
+            order = [ticket for round_ in itertools.zip_longest(*queues) for ticket in round_ if ticket]
+        for index, ticket in enumerate(order, start=1):
+            if ticket.session == session:
+                return index
+        return None
+
+    def stats(self):
+        with self._cond:
+            return {
+                'active': self._active,
+                'waiting': self._waiting(),
+                'sessions_waiting': len(self._queues),
+                'admitted': self._stats['admitted'],
+                'timeouts': self._stats['timeouts'],
+                'pauses': self._stats['pauses'],
+                'wait_seconds': round(self._stats['wait_seconds'], 3)
+            }
@@ -0,0 +1,115 @@
+"""Several variants of one negotiation, generated side by side and compared section by section.
+
+A scenario is the base inputs with some fields overridden - a different
+stance, target or project value - and optionally its own temperature. All
+scenarios are generated at the same time on a capped pool, so the wall time
+is close to the slowest one rather than the sum.
+"""
+import contextvars
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+
+from generation import MODEL, SECTION_TITLES, TEMPERATURE, generate_document, split_sections
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_TOKEN_RE = re.compile(r'\s+|[^\s]+')
+
+
+def scenario_inputs(base_data, overrides):
+    """The base inputs with a scenario's non-empty overrides applied"""
+    return dict(base_data, **{key: value for key, value in (overrides or {}).items() if str(value).strip()})
+
+
+def new_variant(name, overrides=None, temperature=None):
+    """A scenario's state, updated in place while it is generated"""
+    return {
+        'name': name,
+        'overrides': dict(overrides or {}),
+        'temperature': TEMPERATURE if temperature is None else temperature,
+        'status': PENDING,
+        'document': None,
+        'stats': None,
+        'error': None,
+        'entry_id': None
+    }
+
+
+def generate_variants(client, base_data, variants, max_concurrency=4, model=MODEL, generate=None):
+    """Generate every variant at the same time, at most max_concurrency at once.
+
+    generate(variant, data) returns (document, stats) and defaults to a plain
+    generate_document; the job passes one that also uses the response cache.
+    A failed variant keeps its error and does not stop the others.
+    Returns the wall time in seconds.
+    """
+    if generate is None:
+        def generate(variant, data):
+            return generate_document(client, data, model=model, temperature=variant['temperature'])
+
+    def run(variant):
+        variant['status'] = RUNNING
+        try:
+            variant['document'], variant['stats'] = generate(variant, scenario_inputs(base_data, variant['overrides']))
+            variant['status'] = DONE
+        except Exception as e:
+            variant['error'] = str(e)
+            variant['status'] = FAILED
+
+    start = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(variants))),
+                              thread_name_prefix="batna-scenario")
+    try:
+        for future in [pool.submit(contextvars.copy_context().run, run, variant) for variant in variants]:
+            future.result()
+    finally:
+        pool.shutdown(wait=True)
+    return time.perf_counter() - start
+
+
+def _section_body(text):
+    # The canonical heading is the same in every column
+    return text.split('\n', 1)[1].strip() if '\n' in text else ""
+
+
+def compare_sections(documents):
+    """One row per section: each document's text of it and its similarity (0-1) to the first document's.
+
+    A section a document lacks is "" with similarity 0.
+    """
+    sections = [split_sections(document or "") for document in documents]
+    rows = []
+    for number, title in enumerate(SECTION_TITLES, start=1):
+        texts = [_section_body(parts[number]) if number in parts else "" for parts in sections]
+        base = _TOKEN_RE.findall(texts[0])
+        similarity = [1.0] + [
+            SequenceMatcher(None, base, _TOKEN_RE.findall(text), autojunk=False).ratio() if text else 0.0
+            for text in texts[1:]
+        ]
+        rows.append({
+            'number': number,
+            'title': title,
+            'texts': texts,
+            'similarity': similarity,
+            'differs': any(text != texts[0] for text in texts[1:])
+        })
+    return rows
+
+
+def word_diff(old, new):
+    """[(op, text)] turning old into new word by word; op is "equal", "insert" or "delete" """
+    old_tokens, new_tokens = _TOKEN_RE.findall(old), _TOKEN_RE.findall(new)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_tokens, new_tokens, autojunk=False).get_opcodes():
+        if tag in ("delete", "replace"):
+            ops.append(("delete", "".join(old_tokens[i1:i2])))
+        if tag in ("insert", "replace"):
+            ops.append(("insert", "".join(new_tokens[j1:j2])))
+        if tag == "equal":
+            ops.append(("equal", "".join(old_tokens[i1:i2])))
+    return ops
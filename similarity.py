@@ -0,0 +1,116 @@
+import hashlib
+import math
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+# Width of the hashed feature vectors; 256 float32 values take 1 KB per document,
+# so 50,000 documents are searched in a 50 MB matrix
+DIM = 256
+
+# Fields that say most about whether two negotiations are alike count for more
+FIELD_WEIGHTS = {
+    "negotiation_subject": 3.0,
+    "scope_description": 2.0,
+    "vendors": 2.0,
+    "company_profile": 1.5,
+    "project_value": 0.5
+}
+
+STOPWORDS = frozenset("""
+a an and are as at be been but by can for from has have in into is it its of on or our that the their them
+they this to was we were will with within without which who would should shall not no all any each per
+""".split())
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def _features(data):
+    """Weighted unigram and bigram counts of the form fields"""
+    counts = Counter()
+    for key, value in data.items():
+        weight = FIELD_WEIGHTS.get(key, 1.0)
+        words = [word for word in _TOKEN_RE.findall(str(value).lower()) if word not in STOPWORDS]
+        terms = Counter(words)
+        terms.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+        for term, count in terms.items():
+            # Sublinear term frequency so long pasted lists do not drown out the rest
+            counts[term] += weight * (1.0 + math.log(count))
+    return counts
+
+
+def vectorize(data):
+    """Unit-length signed feature-hashing vector of the inputs; cosine similarity is a dot product"""
+    vector = np.zeros(DIM, dtype=np.float32)
+    for term, weight in _features(data).items():
+        digest = int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+        vector[digest % DIM] += weight if digest >> 63 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SimilarityIndex:
+    """In-memory matrix of document vectors searched with one matrix-vector product"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._vectors = np.zeros((0, DIM), dtype=np.float32)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def load(self, ids, vectors):
+        with self._lock:
+            # Copies: vectors read with np.frombuffer are read-only, and remove() writes in place
+            self._ids = np.array(ids, dtype=np.int64)
+            self._vectors = np.array(vectors, dtype=np.float32).reshape(-1, DIM)
+            self._size = len(self._ids)
+
+    def add(self, entry_id, vector):
+        with self._lock:
+            if self._size == len(self._ids):
+                # Grow by doubling so adding one document does not copy the whole matrix
+                capacity = max(64, 2 * len(self._ids))
+                ids = np.zeros(capacity, dtype=np.int64)
+                vectors = np.zeros((capacity, DIM), dtype=np.float32)
+                ids[:self._size] = self._ids[:self._size]
+                vectors[:self._size] = self._vectors[:self._size]
+                self._ids, self._vectors = ids, vectors
+            self._ids[self._size] = entry_id
+            self._vectors[self._size] = vector
+            self._size += 1
+
+    def remove(self, entry_id):
+        with self._lock:
+            positions = np.flatnonzero(self._ids[:self._size] == entry_id)
+            if not len(positions):
+                return
+            last = self._size - 1
+            # Move the last row into the hole
+            self._ids[positions[0]] = self._ids[last]
+            self._vectors[positions[0]] = self._vectors[last]
+            self._size = last
+
+    def clear(self):
+        self.load([], [])
+
+    def search(self, vector, limit=3, min_score=0.0, among=None):
+        """[(entry_id, cosine similarity)] of the closest documents, best first, only from among if given"""
+        with self._lock:
+            if not self._size:
+                return []
+            scores = self._vectors[:self._size] @ vector
+            ids = self._ids[:self._size]
+            if among is not None:
+                keep = np.isin(ids, np.fromiter(among, dtype=ids.dtype))
+                scores, ids = scores[keep], ids[keep]
+                if not len(ids):
+                    return []
+            count = min(limit, len(ids))
+            top = np.argpartition(-scores, count - 1)[:count]
+            top = top[np.argsort(-scores[top])]
+            return [(int(ids[i]), float(scores[i])) for i in top if scores[i] >= min_score]
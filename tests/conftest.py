@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Before config is imported: keep stores and metrics out of the working copy
+os.environ.setdefault("BATNA_DATA_DIR", tempfile.mkdtemp(prefix="batna-tests-"))
+os.environ.setdefault("BATNA_WARMUP", "0")
+os.environ.setdefault("BATNA_SIMILAR_SUGGESTIONS", "0")
+
+from mock_anthropic import MockAnthropicServer  # noqa: E402
+
+APP = os.path.join(ROOT, "app.py")
+
+
+@pytest.fixture
+def mock_server():
+    """A local stand-in for the Anthropic API, stopped after the test"""
+    servers = []
+
+    def start(**options):
+        server = MockAnthropicServer(**options).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def app_test(monkeypatch, tmp_path):
+    """AppTest of app.py talking to a mock server, with its own data directory"""
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+    import config
+
+    # Shared stores and queues are per process; each test starts with its own
+    st.cache_resource.clear()
+
+    def make(server):
+        monkeypatch.setattr(config, "ANTHROPIC_BASE_URL", server.base_url)
+        monkeypatch.setattr(config, "DATA_DIR", str(tmp_path))
+        monkeypatch.setattr(config, "JOB_POLL_INTERVAL", 0.05)
+        at = AppTest.from_file(APP, default_timeout=60)
+        at.secrets["ANTHROPIC_API_KEY"] = "test-key"
+        return at
+
+    return make
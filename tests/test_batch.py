@@ -0,0 +1,82 @@
+import csv
+import json
+
+import batch
+import config
+from generation import INPUT_FIELDS
+from mock_anthropic import sample_document
+
+
+def record(**fields):
+    return dict({key: f"Test {key}" for key in INPUT_FIELDS}, **fields)
+
+
+def write_jsonl(path, lines):
+    path.write_text("".join((line if isinstance(line, str) else json.dumps(line)) + "\n" for line in lines))
+    return str(path)
+
+
+def test_ids_that_collide_get_unique_names(tmp_path):
+    path = write_jsonl(tmp_path / "in.jsonl", [record(id="a/b"), record(id="a_b"), record(id="a_b"), record()])
+    ids = [record_id for record_id, data, error in batch.read_records(path)]
+    assert ids == ["a_b", "a_b-2", "a_b-3", "record-0004"]
+
+
+def test_invalid_records_do_not_stop_the_others(tmp_path):
+    incomplete = record(id="short")
+    del incomplete['vendors']
+    path = write_jsonl(tmp_path / "in.jsonl", [incomplete, "{not json", record(id="good")])
+    (short, data, error), (broken, broken_data, broken_error), (good, good_data, good_error) = batch.read_records(path)
+    assert (short, data, error) == ("short", None, "Record 1 is missing fields: vendors")
+    assert broken_data is None and broken_error.startswith("Record 2 is not valid JSON")
+    assert good == "good" and good_data['vendors'] == "Test vendors" and good_error is None
+
+def test_batch_run_reports_invalid_records_in_the_manifest(tmp_path, mock_server, monkeypatch):
+    server = mock_server(response_text=sample_document())
+    monkeypatch.setattr(config, "ANTHROPIC_BASE_URL", server.base_url)
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test-key")
+    incomplete = record(id="short")
+    del incomplete['targets']
+    path = write_jsonl(tmp_path / "in.jsonl", [record(id="x/1"), record(id="x_1"), incomplete])
+    output = tmp_path / "out"
+
+    code = batch.main([path, "-o", str(output), "--formats", "txt", "--export-processes", "0", "--no-cache",
+                       "--rpm", "0"])
+    assert code == 1
+    entries = {entry['id']: entry for entry in map(json.loads, (output / "manifest.jsonl").read_text().splitlines())}
+    assert entries['x_1']['status'] == entries['x_1-2']['status'] == "done"
+    assert entries['short']['status'] == "failed"
+    assert "missing fields: targets" in entries['short']['error']
+    assert sorted(path.name for path in output.iterdir()) == [
+        "manifest.jsonl", "x_1-2.md", "x_1-2.txt", "x_1.md", "x_1.txt"
+    ]
+    assert len(server.requests) == 2
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def test_csv_fields_longer_than_the_csv_default_are_read(tmp_path):
+    scope = "Deliver to every site in the region. " * 6000
+    assert len(scope) > 131072
+    path = write_csv(tmp_path / "in.csv", [record(id="long", scope_description=scope)])
+    [(record_id, data, error)] = batch.read_records(path)
+    assert (record_id, error) == ("long", None)
+    assert data['scope_description'] == scope
+
+
+def test_unreadable_csv_is_reported(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test-key")
+    monkeypatch.setattr(batch, "CSV_FIELD_LIMIT", 1000)
+    path = write_csv(tmp_path / "in.csv", [record(scope_description="x" * 5000)])
+    default = csv.field_size_limit(1000)
+    try:
+        assert batch.main([path, "-o", str(tmp_path / "out")]) == 2
+    finally:
+        csv.field_size_limit(default)
+    assert "Cannot read" in capsys.readouterr().err
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+
+import pytest
+
+import exporters
+from export_cache import STALE_PARTIAL_AGE, ExportCache, ExportFiles
+from mock_anthropic import sample_document
+
+
+def test_failed_background_render_is_not_repeated():
+    cache = ExportCache(workers=1)
+    calls = []
+
+    def render():
+        calls.append(1)
+        raise ValueError("broken renderer")
+
+    for _ in range(5):
+        future = cache.render_async("# Doc", "pdf", render)
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+    assert len(calls) == 1
+    assert cache.stats()['failed_renders'] == 1
+
+
+def test_failure_expires():
+    cache = ExportCache(workers=1, failure_ttl=0)
+    calls = []
+
+    def render():
+        calls.append(1)
+        raise ValueError("broken renderer")
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            cache.render_async("# Doc", "pdf", render).result(timeout=5)
+    assert len(calls) == 2
+
+
+def test_concurrent_calls_share_one_render():
+    cache = ExportCache(workers=2)
+    release = threading.Event()
+    calls = []
+
+    def render():
+        calls.append(1)
+        release.wait(5)
+        return b"data"
+
+    futures = [cache.render_async("# Doc", "txt", render) for _ in range(3)]
+    release.set()
+    assert [future.result(timeout=5) for future in futures] == [b"data"] * 3
+    assert len(calls) == 1
+    assert cache.get_or_render("# Doc", "txt", lambda: b"other") == b"data"
+
+
+def test_app_shows_render_error_and_stops_polling(mock_server, app_test, monkeypatch):
+    calls = []
+    render_export = exporters.render_export
+
+    def failing(content, fmt, *args, **kwargs):
+        if fmt == "pdf":
+            calls.append(1)
+            raise ValueError("broken renderer")
+        return render_export(content, fmt, *args, **kwargs)
+
+    monkeypatch.setattr(exporters, "render_export", failing)
+    at = app_test(mock_server())
+    at.run()
+    for area in at.text_area:
+        area.input("value for " + area.key)
+    at.button[0].click()
+    at.run()
+    assert at.session_state['show_document']
+    # Reruns until the background renders are done, then stops; a failure must not restart them
+    at.run()
+    at.run()
+
+    assert not at.session_state['exports_pending']
+    assert any("broken renderer" in error.value for error in at.error)
+    labels = [button.proto.label for button in at.get('download_button')]
+    assert "Download as PDF" in labels
+    assert len(calls) == 1
+    pdf = [button for button in at.get('download_button') if button.proto.label == "Download as PDF"][0]
+    assert pdf.proto.disabled
+
+
+def test_failed_file_render_is_not_repeated(tmp_path):
+    files = ExportFiles(str(tmp_path), workers=1)
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            # No such format: the worker process raises
+            files.render_async("# Doc", "nope").result(timeout=60)
+    assert files.stats()['renders'] == 1
+    assert files.stats()['failed_renders'] == 1
+
+
+def test_only_old_partial_files_are_removed(tmp_path):
+    old = tmp_path / "a.pdf.123.tmp"
+    recent = tmp_path / "b.pdf.456.tmp"
+    for path in (old, recent):
+        path.write_bytes(b"partial")
+    os.utime(old, (time.time() - 2 * STALE_PARTIAL_AGE,) * 2)
+    ExportFiles(str(tmp_path), workers=1)
+    assert not old.exists()
+    # Possibly another process's render still in progress
+    assert recent.exists()
+
+
+def test_disk_budget_covers_every_process_sharing_the_directory(tmp_path):
+    document = sample_document()
+    first = ExportFiles(str(tmp_path), workers=1)
+    first_path = first.render_async(document, "txt").result(timeout=60)
+    size = os.path.getsize(first_path)
+    os.utime(first_path, (time.time() - 10,) * 2)
+    # Another server process: room for one of the two files
+    second = ExportFiles(str(tmp_path), max_bytes=size + size // 2, workers=1)
+    second_path = second.render_async(document + "\nMore.", "txt").result(timeout=60)
+    assert os.path.exists(second_path)
+    assert not os.path.exists(first_path)
+    assert first.stats()['files'] == 1
@@ -0,0 +1,41 @@
+import io
+
+import pytest
+
+from exporters import EXPORT_FORMATS, parse_document, render_export
+
+LONG_CELL = " ".join(f"word{i}" for i in range(200))
+
+
+def test_numbered_headings_in_any_case():
+    blocks = parse_document("1. EXECUTIVE SUMMARY\n\nText.\n\n2. Client's BATNA Analysis\n\nMore text.")
+    assert [(block.kind, block.text) for block in blocks if block.kind == 'heading'] == [
+        ('heading', "1. EXECUTIVE SUMMARY"),
+        ('heading', "2. Client's BATNA Analysis"),
+    ]
+
+
+def test_numbered_sentences_stay_list_items():
+    blocks = parse_document("1. Negotiate the price first.\n2. Offer a pilot phase to the vendor")
+    assert [block.kind for block in blocks] == ['paragraph', 'paragraph']
+
+
+@pytest.mark.parametrize("table", [
+    f"| Option | Value | Risk |\n|---|---|---|\n| {LONG_CELL} {LONG_CELL} | high | low |",
+    # A header row cannot be split over pages
+    f"| {LONG_CELL * 4} | Value | Risk |\n|---|---|---|\n| a | b | c |",
+])
+def test_pdf_table_with_cell_taller_than_a_page(table):
+    data = render_export(f"## 1. EXECUTIVE SUMMARY\n\n{table}\n", "pdf")
+    assert data.startswith(b"%PDF")
+
+
+@pytest.mark.parametrize("fmt", sorted(EXPORT_FORMATS))
+def test_file_output_matches_bytes(fmt):
+    content = "## 1. EXECUTIVE SUMMARY\n\nSome **bold** text.\n\n| A | B |\n|---|---|\n| 1 | 2 |"
+    out = io.BytesIO()
+    EXPORT_FORMATS[fmt][0](parse_document(content), out)
+    if fmt == "txt":
+        assert out.getvalue() == render_export(content, fmt)
+    else:
+        assert out.getvalue()[:4] == render_export(content, fmt)[:4]
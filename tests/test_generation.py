@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+import config
+from generation import DRAFT_MODEL, SECTION_TITLES, generate_document, refine_document, split_sections
+from llm_client import client_from_config
+from mock_anthropic import sample_document
+
+DATA = {'negotiation_subject': "Logistics contract", 'project_value': "2M"}
+
+
+def title_case_document():
+    return "\n\n".join(
+        f"{number}. {title.title().replace('&', 'and')}\n\nWhat to do.\n\n1. Open with the price\n2. Then the terms"
+        for number, title in enumerate(SECTION_TITLES, start=1)
+    )
+
+
+def condense_requests(server):
+    return [request for request in server.requests if "Condense them" in json.dumps(request['body'])]
+
+
+@pytest.fixture
+def client():
+    clients = []
+
+    def make(server):
+        client = client_from_config("test-key", server.base_url)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.close()
+
+
+def test_title_case_headings_are_sections():
+    sections = split_sections(title_case_document())
+    assert sorted(sections) == list(range(1, len(SECTION_TITLES) + 1))
+    # The numbered list items inside each section are not headings
+    assert all("1. Open with the price" in text for text in sections.values())
+
+
+def test_complete_title_case_response_is_one_request(mock_server, client):
+    server = mock_server(response_text=title_case_document())
+    document, stats = generate_document(client(server), DATA)
+    assert len(server.requests) == 1
+    assert 'filled_sections' not in stats
+    assert document.startswith("1. Executive Summary")
+
+
+def test_finished_response_without_headings_is_kept(mock_server, client):
+    server = mock_server(response_text="A negotiation analysis in free prose.")
+    document, stats = generate_document(client(server), DATA)
+    assert len(server.requests) == 1
+    assert document == "A negotiation analysis in free prose."
+
+
+def test_missing_sections_are_filled_in(mock_server, client):
+    partial = sample_document().split("## 4.")[0]
+    server = mock_server(response_text=partial)
+    document, stats = generate_document(client(server), DATA)
+    assert sorted(stats['filled_sections']) == [4, 5, 6, 7]
+    assert len(server.requests) == 1 + 4
+
+
+def test_refine_does_not_condense_the_inputs_again(mock_server, client, monkeypatch):
+    monkeypatch.setattr(config, "INPUT_BUDGET_POLICY", "summarize")
+    monkeypatch.setattr(config, "FIELD_TOKEN_CAP", 200)
+    server = mock_server(response_text=title_case_document())
+    data = dict(DATA, scope=" ".join(f"Requirement {number} for the new lanes." for number in range(400)))
+    draft = generate_document(client(server), data, model=DRAFT_MODEL)
+    assert len(condense_requests(server)) == 1
+
+    document, stats = refine_document(client(server), data, *draft)
+    assert len(condense_requests(server)) == 1
+    assert stats['budget']['compacted']['scope'][2] == "summarized"
+
+
+def test_budget_notice_is_for_the_submitted_inputs(mock_server, app_test, monkeypatch):
+    monkeypatch.setattr(config, "FIELD_TOKEN_CAP", 200)
+    monkeypatch.setattr(config, "BACKGROUND_JOBS", False)
+    # The request fails, so the page stays on what was shown while generating
+    at = app_test(mock_server(fail_first=10, fail_status=400))
+    at.run()
+    assert not at.warning
+    for area in at.text_area:
+        area.input("value for " + area.key)
+    at.text_area(key="input_scope_description").input("Requirement for the new lanes. " * 400)
+    at.button[0].click()
+    at.run()
+    assert at.error
+    assert any("will be shortened" in warning.value and "Scope Description" in warning.value for warning in at.warning)
@@ -0,0 +1,94 @@
+import sqlite3
+
+from history_store import HistoryStore
+
+DATA = {'negotiation_subject': "Freight tender", 'project_value': "1M"}
+
+
+def test_owners_only_see_their_own_entries(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    alice, bob = store.for_owner("alice"), store.for_owner("bob")
+    mine = alice.add("## 1. EXECUTIVE SUMMARY\n\nFreight by rail", DATA)
+    theirs = bob.add("## 1. EXECUTIVE SUMMARY\n\nFreight by road", DATA)
+
+    assert [entry['id'] for entry in alice.list()] == [mine]
+    assert alice.count("freight") == 1
+    assert alice.ids("road") == []
+    assert alice.get(theirs) is None
+    assert [entry['id'] for entry in alice.similar(DATA)] == [mine]
+    # Everyone's entries without an owner, as the command-line tools see them
+    assert store.count() == 2
+
+    alice.delete(theirs)
+    assert bob.get(theirs) is not None
+
+
+def test_clear_only_removes_the_owners_entries(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    alice, bob = store.for_owner("alice"), store.for_owner("bob")
+    alice.add("Freight by rail", DATA)
+    kept = bob.add("Freight by road", DATA)
+    store.similar(DATA)
+
+    alice.clear()
+    assert alice.count() == 0
+    assert bob.ids() == [kept]
+    assert bob.ids("road") == [kept]
+    assert [entry['id'] for entry in store.similar(DATA)] == [kept]
+
+
+def test_entries_from_before_owners_are_kept(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE documents (id INTEGER PRIMARY KEY, created REAL NOT NULL, subject TEXT NOT NULL, "
+                 "value TEXT NOT NULL, document BLOB NOT NULL, data BLOB NOT NULL)")
+    conn.commit()
+    conn.close()
+    store = HistoryStore(path)
+    entry_id = store.add("Old document", DATA)
+    assert store.get(entry_id)['document'] == "Old document"
+    assert store.for_owner("alice").count() == 0
+
+
+def test_clear_history_asks_first_and_keeps_other_browsers(app_test, mock_server, tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    store.for_owner("alice").add("Freight by rail", DATA)
+    other = store.for_owner("bob").add("Freight by road", DATA)
+    at = app_test(mock_server())
+    at.query_params["owner"] = "alice"
+    at.run()
+
+    at.sidebar.button[-1].click()
+    at.run()
+    assert store.count() == 2
+    assert any("Delete all 1 of your documents" in warning.value for warning in at.sidebar.warning)
+
+    at.sidebar.button(key="confirm_clear_history_button").click()
+    at.run()
+    assert store.ids() == [other]
+
+
+def test_find_looks_up_the_owners_entry_with_the_document(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    alice = store.for_owner("alice")
+    alice.add("Freight by rail", DATA)
+    newest = alice.add("Freight by rail", DATA)
+    assert alice.find("Freight by rail") == newest
+    assert alice.find("Freight by road") is None
+    assert store.for_owner("bob").find("Freight by rail") is None
+
+
+def test_resubmitting_the_form_reuses_the_history_entry(app_test, mock_server, tmp_path):
+    at = app_test(mock_server())
+    at.query_params["owner"] = "alice"
+    at.run()
+    for attempt in range(2):
+        for area in at.text_area:
+            area.input("value for " + area.key)
+        at.button[0].click()
+        at.run()
+        assert at.session_state['show_document']
+        at.session_state['show_document'] = False
+        at.run()
+    assert at.session_state['generation_stats']['cached']
+    assert HistoryStore(str(tmp_path / "history.sqlite3")).for_owner("alice").count() == 1
@@ -0,0 +1,157 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+import config
+from export_cache import export_settings, make_export_key
+from generation import INPUT_FIELDS
+from http_api import Services, make_app
+from llm_client import client_from_config
+from mock_anthropic import sample_document
+
+INPUTS = {key: f"Test {key}" for key in INPUT_FIELDS}
+
+
+@pytest.fixture
+def api(mock_server, monkeypatch, tmp_path):
+    """Start the API on a free port against a mock model; returns (httpx client, services, mock server)"""
+    monkeypatch.setattr(config, "DATA_DIR", str(tmp_path))
+    started = []
+
+    def start(**options):
+        server = mock_server(**options)
+        client = client_from_config("test-key", server.base_url)
+        services = Services(client, max_requests=4)
+        sockets = bind_sockets(0, "127.0.0.1")
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            HTTPServer(make_app(services)).add_sockets(sockets)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        ready.wait(10)
+        http = httpx.Client(base_url=f"http://127.0.0.1:{sockets[0].getsockname()[1]}", timeout=30,
+                            headers={'X-Client-Id': "tool-a"})
+        started.append((http, client, loop, thread))
+        return http, services, server
+
+    yield start
+    for http, client, loop, thread in started:
+        http.close()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(10)
+        client.close()
+
+
+def finished_job(http, job):
+    for _ in range(300):
+        job = http.get(f"/v1/jobs/{job['id']}").json()
+        if job['status'] not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job still {job['status']}")
+
+
+def test_generate_and_export(api):
+    http, services, server = api(response_text=sample_document())
+    response = http.post("/v1/documents", json={'inputs': INPUTS})
+    assert response.status_code == 202
+    job = finished_job(http, response.json())
+    assert job['status'] == "done"
+    assert job['document'] == sample_document()
+
+    events = []
+    with http.stream("GET", f"/v1/jobs/{job['id']}/events") as stream:
+        events = [line[len("event: "):] for line in stream.iter_lines() if line.startswith("event:")]
+    assert events == ["text", "done"]
+
+    history = http.get("/v1/history").json()
+    assert history['total'] == 1
+    pdf = http.get(f"/v1/history/{job['entry_id']}/export/pdf")
+    assert pdf.status_code == 200
+    assert pdf.headers['content-type'] == "application/pdf"
+    assert pdf.content.startswith(b"%PDF")
+
+
+def test_exports_share_the_apps_cache_keys(api, monkeypatch):
+    http, services, server = api(response_text=sample_document())
+    job = finished_job(http, http.post("/v1/documents", json={'inputs': INPUTS}).json())
+    assert http.get(f"/v1/history/{job['entry_id']}/export/docx").status_code == 200
+    key = make_export_key(job['document'], "docx", export_settings("docx"))
+    assert services.exports.get(key) is not None
+
+    # A large document's export is the file the Streamlit server would look for in the shared directory
+    monkeypatch.setattr(config, "LARGE_DOCUMENT_CHARS", 10)
+    assert http.get(f"/v1/history/{job['entry_id']}/export/txt").status_code == 200
+    path = services.export_files.path_for(job['document'], "txt", export_settings("txt"))
+    with open(path, 'rb') as f:
+        assert f.read().strip()
+
+
+def test_invalid_requests(api):
+    http, services, server = api()
+    assert http.post("/v1/documents", content=b"not json").status_code == 400
+    missing = http.post("/v1/documents", json={'inputs': {'negotiation_subject': "Freight"}})
+    assert missing.status_code == 400
+    assert "Missing inputs" in missing.json()['error']
+    assert http.post("/v1/documents", json={'inputs': INPUTS, 'tier': "gold"}).status_code == 400
+    assert http.get("/v1/jobs/abc123").status_code == 404
+    assert http.get("/v1/history/999").status_code == 404
+    assert http.get("/v1/history/1/export/xls").status_code == 404
+    assert server.requests == []
+
+
+def test_cached_response_makes_no_model_request(api):
+    http, services, server = api(response_text=sample_document())
+    first = finished_job(http, http.post("/v1/documents", json={'inputs': INPUTS}).json())
+    requests = len(server.requests)
+    job = finished_job(http, http.post("/v1/documents", json={'inputs': INPUTS}).json())
+    assert job['stats']['cached']
+    assert len(server.requests) == requests
+    # The document is already in the caller's history, so no second entry is added
+    assert job['entry_id'] == first['entry_id']
+    assert http.get("/v1/history").json()['total'] == 1
+
+
+def test_flags_must_be_booleans(api):
+    http, services, server = api()
+    for name in ("parallel", "force"):
+        for value in ("false", 0, "no", None):
+            response = http.post("/v1/documents", json={'inputs': INPUTS, name: value})
+            assert response.status_code == 400
+            assert response.json()['error'] == f"'{name}' must be true or false"
+    assert server.requests == []
+
+
+def test_history_is_scoped_to_the_owner(api, monkeypatch):
+    http, services, server = api(response_text=sample_document())
+    job = finished_job(http, http.post("/v1/documents", json={'inputs': INPUTS}).json())
+    entry = f"/v1/history/{job['entry_id']}"
+    # The owner comes from X-Client-Id, or ?owner= as in a browser's page URL
+    assert http.get(entry).status_code == 200
+    assert services.history.for_owner("tool-a").count() == 1
+
+    other = {'X-Client-Id': "tool-b"}
+    assert http.get("/v1/history", headers=other).json()['total'] == 0
+    assert http.get(entry, headers=other).status_code == 404
+    assert http.get(f"{entry}/export/md", headers=other).status_code == 404
+    assert http.get(entry, params={'owner': "tool-a"}, headers=other).status_code == 200
+
+    anonymous = httpx.Client(base_url=http.base_url, timeout=30)
+    try:
+        assert anonymous.get("/v1/history").status_code == 400
+        assert anonymous.post("/v1/documents", json={'inputs': INPUTS}).status_code == 400
+        monkeypatch.setattr(config, "HISTORY_SCOPE", "shared")
+        assert anonymous.get(entry).status_code == 200
+    finally:
+        anonymous.close()
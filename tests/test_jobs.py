@@ -0,0 +1,58 @@
+from document_store import DocumentStore
+from jobs import DONE, JobQueue, run_generation_job
+from llm_client import client_from_config
+from mock_anthropic import sample_document
+
+
+class History:
+    def add(self, document, data):
+        return 1
+
+
+def wait(job):
+    job.future.result(timeout=30)
+    return job
+
+
+def test_finished_job_keeps_its_text_in_the_document_store():
+    store = DocumentStore()
+    queue = JobQueue(1, 3600, store)
+
+    def work(job):
+        job.partial.extend(["Hello, ", "world"])
+        return "Hello, world"
+
+    job = wait(queue.submit(work))
+    assert job.status == DONE
+    assert job.result == job.partial_text == "Hello, world"
+    assert job.partial == []
+    # The result and the streamed text are the same, so they are stored once
+    assert store.stats()['entries'] == 1
+    assert store.stats()['references'] == 2
+
+
+def test_pruned_jobs_release_their_texts():
+    store = DocumentStore()
+    queue = JobQueue(1, 0, store)
+    wait(queue.submit(lambda job: "First document"))
+    wait(queue.submit(lambda job: "Second document"))
+    # Only the second job is retained
+    assert store.stats()['references'] == 1
+
+
+def test_refined_job_keeps_the_draft_by_reference(mock_server):
+    server = mock_server(response_text=sample_document())
+    client = client_from_config("test-key", server.base_url)
+    store = DocumentStore()
+    queue = JobQueue(1, 3600, store)
+    try:
+        job = wait(queue.submit(run_generation_job, client, {'negotiation_subject': "Freight"}, False, 1, None,
+                                None, History(), None, None, "refine"))
+    finally:
+        client.close()
+    assert job.status == DONE
+    assert job.partial_restarts == 1
+    assert job.draft.startswith("## 1.")
+    assert job.result and job.partial_text
+    # Draft, result and the refined text streamed, all held by reference
+    assert store.stats()['references'] == 3
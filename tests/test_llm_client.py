@@ -0,0 +1,75 @@
+import time
+
+import anthropic
+import pytest
+
+from llm_client import PooledClient
+
+
+@pytest.fixture
+def client():
+    clients = []
+
+    def make(server, **options):
+        options.setdefault('backoff_base', 0.01)
+        client = PooledClient("test-key", server.base_url, **options)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.close()
+
+
+def ask(client):
+    message = client.messages.create(model="claude-3-opus-20240229", max_tokens=100,
+                                     messages=[{'role': 'user', 'content': "Hello"}])
+    return message.content[0].text
+
+
+def test_transient_errors_are_retried(mock_server, client):
+    server = mock_server(response_text="Done.", fail_first=2)
+    pooled = client(server)
+    assert ask(pooled) == "Done."
+    assert len(server.requests) == 3
+    snapshot = pooled.metrics.snapshot()
+    assert snapshot['retries'] == 2
+    assert snapshot['failures'] == 0
+    # The retries reuse the pooled keep-alive connection
+    assert snapshot['connections_opened'] == 1
+
+
+def test_retry_after_is_honoured_beyond_backoff_max(mock_server, client):
+    server = mock_server(response_text="Done.", fail_first=1, fail_status=429, retry_after=1)
+    pooled = client(server, backoff_max=0.1)
+    start = time.monotonic()
+    assert ask(pooled) == "Done."
+    assert time.monotonic() - start >= 1.0
+    assert pooled.metrics.snapshot()['retry_wait_seconds'] == 1.0
+
+
+def test_retry_after_past_the_deadline_fails_at_once(mock_server, client):
+    server = mock_server(fail_first=1, fail_status=429, retry_after=60)
+    pooled = client(server, retry_deadline=5.0)
+    start = time.monotonic()
+    with pytest.raises(anthropic.RateLimitError):
+        ask(pooled)
+    assert time.monotonic() - start < 1.0
+    assert len(server.requests) == 1
+    assert pooled.metrics.snapshot()['failures'] == 1
+
+
+def test_retries_stop_after_max_retries(mock_server, client):
+    server = mock_server(fail_first=10)
+    pooled = client(server, max_retries=2)
+    with pytest.raises(anthropic.APIStatusError):
+        ask(pooled)
+    assert len(server.requests) == 3
+
+
+def test_client_errors_are_not_retried(mock_server, client):
+    server = mock_server(fail_first=1, fail_status=400)
+    pooled = client(server)
+    with pytest.raises(anthropic.BadRequestError):
+        ask(pooled)
+    assert len(server.requests) == 1
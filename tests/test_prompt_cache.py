@@ -0,0 +1,50 @@
+from generation import _request_params, build_prompt, generate_document, generate_sections_parallel
+from llm_client import client_from_config
+
+# Long enough that the instructions and inputs together pass the caching minimum
+DATA = {
+    'negotiation_subject': "Logistics contract renewal",
+    'project_value': "2M over three years",
+    'scope_description': "Warehousing, line haul and last-mile delivery for four regions. " * 30,
+}
+
+
+def breakpoints(request):
+    body = request['body']
+    blocks = list(body['system']) if isinstance(body['system'], list) else []
+    for message in body['messages']:
+        if isinstance(message['content'], list):
+            blocks.extend(message['content'])
+    return sum('cache_control' in block for block in blocks)
+
+
+def test_single_request_writes_nothing_to_the_cache(mock_server):
+    server = mock_server()
+    client = client_from_config("test-key", server.base_url)
+    try:
+        document, stats = generate_document(client, DATA)
+    finally:
+        client.close()
+    assert len(server.requests) == 1
+    assert breakpoints(server.requests[0]) == 0
+    assert stats['cache_creation_input_tokens'] == 0
+
+
+def test_sections_read_the_shared_inputs_from_the_cache(mock_server):
+    server = mock_server()
+    client = client_from_config("test-key", server.base_url)
+    try:
+        document, stats = generate_sections_parallel(client, DATA, max_workers=1)
+    finally:
+        client.close()
+    assert len(server.requests) == 7
+    assert all(breakpoints(request) == 1 for request in server.requests)
+    # The first section writes the instructions and inputs, the other six and the summary read them
+    assert stats['cache_creation_input_tokens'] > 0
+    assert stats['cache_read_input_tokens'] == 6 * stats['cache_creation_input_tokens']
+
+
+def test_continuation_marks_the_inputs_it_resends():
+    prompt = build_prompt(DATA)
+    assert 'cache_control' not in _request_params(prompt)['messages'][0]['content'][0]
+    assert 'cache_control' in _request_params(prompt, prefill="## 1. EXECUTIVE SUMMARY")['messages'][0]['content'][0]
@@ -0,0 +1,100 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import metrics
+from llm_client import PooledClient
+from rate_limit import AdmissionController, AdmissionTimeout
+
+
+def ask(client, session, max_tokens=100):
+    metrics.set_session(session)
+    message = client.messages.create(model="claude-3-opus-20240229", max_tokens=max_tokens,
+                                     messages=[{'role': 'user', 'content': "Hello"}])
+    return message.content[0].text
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_concurrency_cap_keeps_under_the_organisation_limit(mock_server):
+    server = mock_server(response_text="Done.", latency=0.2, max_concurrent=2)
+    limiter = AdmissionController(max_concurrency=2)
+    client = PooledClient("test-key", server.base_url, max_retries=0, limiter=limiter)
+    try:
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            answers = list(pool.map(lambda number: ask(client, f"session-{number % 3}"), range(6)))
+    finally:
+        client.close()
+    assert answers == ["Done."] * 6
+    assert server.rate_limited == 0
+    assert server.peak_in_flight == 2
+    assert limiter.stats()['admitted'] == 6
+    assert limiter.stats()['active'] == 0
+
+
+def test_429_pauses_every_admission(mock_server):
+    server = mock_server(response_text="Done.", fail_first=1, fail_status=429, retry_after=1)
+    limiter = AdmissionController(requests_per_minute=600)
+    client = PooledClient("test-key", server.base_url, backoff_base=0.01, limiter=limiter)
+    try:
+        start = time.monotonic()
+        assert ask(client, "alice") == "Done."
+        assert time.monotonic() - start >= 1.0
+    finally:
+        client.close()
+    assert limiter.stats()['pauses'] == 1
+    assert len(server.requests) == 2
+
+
+def test_waiting_sessions_are_served_round_robin():
+    limiter = AdmissionController(max_concurrency=1)
+    held = limiter.acquire(session="holder")
+    granted = []
+
+    def request(session):
+        ticket = limiter.acquire(session=session)
+        granted.append(session)
+        ticket.release()
+
+    threads = []
+    for session in ("alice", "alice", "alice", "bob"):
+        waiting = limiter.stats()['waiting']
+        threads.append(threading.Thread(target=request, args=(session,)))
+        threads[-1].start()
+        wait_until(lambda: limiter.stats()['waiting'] == waiting + 1)
+    assert limiter.position("alice") == 1
+    assert limiter.position("bob") == 2
+
+    held.release()
+    for thread in threads:
+        thread.join(5)
+    assert granted == ["alice", "bob", "alice", "alice"]
+
+
+def test_request_that_cannot_be_admitted_times_out():
+    limiter = AdmissionController(max_concurrency=1, max_wait=0.2)
+    held = limiter.acquire(session="holder")
+    with pytest.raises(AdmissionTimeout):
+        limiter.acquire(session="alice")
+    held.release()
+    assert limiter.stats()['timeouts'] == 1
+    assert limiter.stats()['waiting'] == 0
+
+
+def test_unused_token_reservation_is_refunded(mock_server):
+    server = mock_server(response_text="Done.")
+    limiter = AdmissionController(tokens_per_minute=6000)
+    client = PooledClient("test-key", server.base_url, limiter=limiter)
+    try:
+        ask(client, "alice", max_tokens=2000)
+    finally:
+        client.close()
+    # Only the tokens the API reported are kept out of the bucket, not the whole max_tokens
+    assert limiter.tokens.capacity - limiter.tokens.level < 100
@@ -0,0 +1,110 @@
+import math
+import re
+
+from response_cache import normalize_field
+
+# Claude averages a little under four characters of English per token; rounding down errs on the high side
+CHARS_PER_TOKEN = 3.5
+
+# Lines shorter than this ("- Yes", "N/A") are never treated as duplicates
+MIN_DEDUPE_CHARS = 40
+
+TRUNCATION_MARK = " [...]"
+
+_SENTENCE_END_RE = re.compile(r'[.!?;:\n]\s')
+
+
+def estimate_tokens(text):
+    """Rough token count used for budgeting before a request is sent"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def dedupe_fields(data):
+    """Drop long lines repeated within a field or already given in an earlier field"""
+    seen = set()
+    result = {}
+    for key, value in data.items():
+        lines = []
+        for line in str(value).replace('\r\n', '\n').split('\n'):
+            normalized = normalize_field(line).lower()
+            if len(normalized) >= MIN_DEDUPE_CHARS:
+                if normalized in seen:
+                    continue
+                seen.add(normalized)
+            lines.append(line)
+        result[key] = re.sub(r'\n{3,}', '\n\n', "\n".join(lines)).strip()
+    return result
+
+
+def field_limit(field_tokens, available, cap):
+    """Largest per-field token limit (at most cap) that keeps the fields within available tokens.
+
+    Fields under the limit keep their full length and leave their unused
+    share to the larger ones.
+    """
+    remaining = available
+    sizes = sorted(field_tokens)
+    for index, tokens in enumerate(sizes):
+        share = remaining / (len(sizes) - index)
+        if tokens > share:
+            return max(int(min(share, cap)), 0)
+        remaining -= tokens
+    return cap
+
+
+def truncate_text(text, max_tokens):
+    """Cut text to about max_tokens, at a sentence or line end when one is close"""
+    max_chars = int(max_tokens * CHARS_PER_TOKEN) - len(TRUNCATION_MARK)
+    if len(text) <= max_chars + len(TRUNCATION_MARK):
+        return text
+    cut = text[:max(max_chars, 0)]
+    ends = [m.end() for m in _SENTENCE_END_RE.finditer(cut)]
+    if ends and ends[-1] > max_chars * 0.8:
+        cut = cut[:ends[-1]]
+    return cut.rstrip() + TRUNCATION_MARK
+
+
+def compact_inputs(data, overhead_tokens, prompt_budget, field_cap, policy="truncate", condense=None):
+    """Fit the form fields into prompt_budget tokens.
+
+    overhead_tokens is the size of the prompt without any input. Long repeated
+    lines are always removed; fields still above the per-field limit are then
+    either cut ("truncate") or passed to condense(key, text, max_tokens)
+    ("summarize"), falling back to cutting when that fails or is not short
+    enough. Returns the compacted data and {key: (tokens before, tokens
+    after, method)} for every field that was shortened.
+    """
+    if policy == "off":
+        return dict(data), {}
+
+    compacted = dedupe_fields(data)
+    notes = {}
+    for key in data:
+        before, after = estimate_tokens(str(data[key])), estimate_tokens(compacted[key])
+        if after < before:
+            notes[key] = (before, after, "deduplicated")
+
+    tokens = {key: estimate_tokens(value) for key, value in compacted.items()}
+    limit = field_limit(tokens.values(), prompt_budget - overhead_tokens, field_cap)
+    for key, value in compacted.items():
+        if tokens[key] <= limit:
+            continue
+        shortened, method = None, "truncated"
+        if policy == "summarize" and condense is not None:
+            try:
+                shortened, method = condense(key, value, limit), "summarized"
+            except Exception:
+                pass
+        if shortened is None or estimate_tokens(shortened) > limit:
+            shortened = truncate_text(shortened or value, limit)
+        compacted[key] = shortened
+        notes[key] = (estimate_tokens(str(data[key])), estimate_tokens(shortened), method)
+    return compacted, notes
+
+
+def output_budget(prompt_tokens, max_output, request_budget, context_window, min_output):
+    """max_tokens for a request: what is left of the request and context budgets, within [min_output, max_output]"""
+    remaining = context_window - prompt_tokens
+    if request_budget:
+        remaining = min(remaining, request_budget - prompt_tokens)
+    return max(min(max_output, remaining), min_output)